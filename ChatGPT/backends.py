@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import threading
+
+import aiohttp
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class BackendError(Exception):
+    # Carries what RetryPolicy needs to classify the failure and honour Retry-After
+    def __init__(self, message, http_status=None, headers=None):
+        super().__init__(message)
+        self.http_status = http_status
+        self.headers = headers or {}
+
+
+class Backend:
+    # Whether the cl100k_base label token ids can be passed as a logit bias
+    supports_logit_bias = False
+
+    def complete(self, model, messages, temperature, **parameters):
+        raise NotImplementedError
+
+    async def acomplete(self, model, messages, temperature, **parameters):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class OpenAIBackend(Backend):
+    supports_logit_bias = True
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    def complete(self, model, messages, temperature, **parameters):
+        # The SDK keeps one keep-alive session per thread of the engine
+        return openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            request_timeout=self.timeout,
+            **parameters,
+        )
+
+    async def acomplete(self, model, messages, temperature, **parameters):
+        return await openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            request_timeout=self.timeout,
+            **parameters,
+        )
+
+
+class HttpBackend(Backend):
+    # Any server that speaks the OpenAI chat completions protocol
+    def __init__(
+        self,
+        base_url,
+        api_key=None,
+        timeout=60,
+        connect_timeout=10,
+        pool_size=32,
+    ):
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.pool_size = pool_size
+
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+
+        # One pooled session for every worker thread, so connections and TLS
+        # handshakes are reused instead of paid on every call
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # An aiohttp session belongs to the event loop it was created in, so
+        # every loop that calls acomplete gets a pooled session of its own
+        self.async_sessions = {}
+        self.async_sessions_lock = threading.Lock()
+
+    @staticmethod
+    def build_payload(model, messages, temperature, **parameters):
+        return {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            **parameters,
+        }
+
+    @staticmethod
+    def parse_response(http_status, headers, body):
+        if http_status >= 400:
+            raise BackendError(
+                f"HTTP {http_status}: {body[:500]}", http_status, headers
+            )
+
+        return json.loads(body)
+
+    def complete(self, model, messages, temperature, **parameters):
+        response = self.session.post(
+            self.url,
+            json=HttpBackend.build_payload(model, messages, temperature, **parameters),
+            timeout=(self.connect_timeout, self.timeout),
+        )
+
+        return HttpBackend.parse_response(
+            response.status_code, response.headers, response.text
+        )
+
+    def async_session(self):
+        loop = asyncio.get_running_loop()
+
+        with self.async_sessions_lock:
+            session = self.async_sessions.get(loop)
+
+            if session is None or session.closed:
+                session = aiohttp.ClientSession(
+                    headers=self.headers,
+                    connector=aiohttp.TCPConnector(limit=self.pool_size),
+                    timeout=aiohttp.ClientTimeout(
+                        total=self.timeout, connect=self.connect_timeout
+                    ),
+                )
+                self.async_sessions[loop] = session
+
+        return session
+
+    async def acomplete(self, model, messages, temperature, **parameters):
+        async with self.async_session().post(
+            self.url,
+            json=HttpBackend.build_payload(model, messages, temperature, **parameters),
+        ) as response:
+            return HttpBackend.parse_response(
+                response.status, response.headers, await response.text()
+            )
+
+    def close(self):
+        self.session.close()
+
+        # Sessions whose loop is still around are closed on it. The loop of
+        # asyncio.run is gone once it returns, so those callers use aclose
+        with self.async_sessions_lock:
+            async_sessions = list(self.async_sessions.items())
+            self.async_sessions.clear()
+
+        for loop, session in async_sessions:
+            if not session.closed and not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(session.close())
+
+    async def aclose(self):
+        # Closes the session of the calling event loop, before that loop ends
+        with self.async_sessions_lock:
+            session = self.async_sessions.pop(asyncio.get_running_loop(), None)
+
+        if session is not None:
+            await session.close()
+
+
+class TogetherBackend(HttpBackend):
+    def __init__(self, base_url="https://api.together.xyz/v1", **options):
+        api_key = os.environ.get("TOGETHERAI_API_KEY")
+
+        if not api_key:
+            raise ValueError("No TogetherAI API key found!")
+
+        super().__init__(base_url, api_key, **options)
+
+
+class LocalBackend(HttpBackend):
+    # vLLM, llama.cpp server, Ollama and the like, usually without a key
+    def __init__(self, base_url="http://localhost:8000/v1", **options):
+        super().__init__(base_url, os.environ.get("LOCAL_LLM_API_KEY"), **options)
+
+
+BACKENDS = {
+    "openai": OpenAIBackend,
+    "together": TogetherBackend,
+    "local": LocalBackend,
+}
+
+
+def make_backend(name, **options):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend = {name}, expected one of {list(BACKENDS)}")
+
+    return BACKENDS[name](**options)
@@ -0,0 +1,781 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from backends import BackendError, LocalBackend
+from chatgpt import Category1, ClaimExistence, Utility
+from fewshot import ExampleBank
+from journal import PredictionJournal
+from pipeline import FusedPipeline
+from retry import CircuitBreaker, RetryPolicy
+from stream import IncrementalCsvWriter, TweetStream
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then left out of the report
+    resource = None
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    # OpenAI compatible chat completions endpoint, which is also what Together
+    # and vLLM serve. The label of a tweet is fixed by its hash, so reruns agree,
+    # while failures are drawn per request, so a retry can succeed
+    daemon_threads = True
+
+    # The default backlog of 5 drops connections when a whole pool opens at
+    # once, and their SYN retry adds a second to those requests
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        port=0,
+        latency_median_ms=200,
+        latency_sigma=0.5,
+        rate_limit_rate=0.0,
+        server_error_rate=0.0,
+        malformed_rate=0.0,
+        retry_after_seconds=0.1,
+    ):
+        super().__init__(("127.0.0.1", port), MockLLMRequestHandler)
+
+        self.latency_median_seconds = latency_median_ms / 1000
+        self.latency_sigma = latency_sigma
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.malformed_rate = malformed_rate
+        self.retry_after_seconds = retry_after_seconds
+
+        self.lock = threading.Lock()
+        self.responses = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def latency_seconds(self):
+        if self.latency_sigma == 0:
+            return self.latency_median_seconds
+
+        return random.lognormvariate(
+            math.log(self.latency_median_seconds), self.latency_sigma
+        )
+
+    def count(self, outcome):
+        with self.lock:
+            self.responses[outcome] = self.responses.get(outcome, 0) + 1
+
+    @staticmethod
+    def label_of(messages):
+        digest = hashlib.md5(messages[-1]["content"].encode("utf-8")).hexdigest()
+        return "#" if int(digest, 16) % 3 else "@"
+
+    def completion(self, payload):
+        label = MockLLMServer.label_of(payload["messages"])
+        choices = []
+
+        for index in range(payload.get("n", 1)):
+            if random.random() < self.malformed_rate:
+                content = "I cannot classify this tweet."
+            else:
+                content = label
+
+            choice = {
+                "index": index,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+
+            if payload.get("logprobs"):
+                probability = 0.9 if label == "#" else 0.1
+                choice["logprobs"] = {
+                    "content": [
+                        {
+                            "token": content,
+                            "logprob": 0.0,
+                            "top_logprobs": [
+                                {"token": "#", "logprob": math.log(probability)},
+                                {"token": "@", "logprob": math.log(1 - probability)},
+                            ],
+                        }
+                    ]
+                }
+
+            choices.append(choice)
+
+        prompt_tokens = Utility.estimate_tokens(payload["messages"])
+
+        return {
+            "id": f"mock-{random.getrandbits(64):016x}",
+            "object": "chat.completion",
+            "model": payload["model"],
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(choices),
+                "total_tokens": prompt_tokens + len(choices),
+            },
+        }
+
+
+class MockLLMRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the pooled sessions of the backends reuse connections.
+    # Headers and body go out in separate writes, which Nagle's algorithm would
+    # hold back for the client's delayed ACK on every reused connection
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if not self.path.endswith("/chat/completions"):
+            self.respond(404, {"error": {"message": f"No route for {self.path}"}})
+            return
+
+        time.sleep(self.server.latency_seconds())
+
+        draw = random.random()
+
+        if draw < self.server.rate_limit_rate:
+            self.server.count("429")
+            self.respond(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                {"Retry-After": str(self.server.retry_after_seconds)},
+            )
+        elif draw < self.server.rate_limit_rate + self.server.server_error_rate:
+            status = random.choice([500, 502, 503])
+            self.server.count(str(status))
+            self.respond(status, {"error": {"message": "Upstream failure"}})
+        else:
+            response = self.server.completion(json.loads(body))
+
+            malformed = all(
+                choice["message"]["content"] not in ("#", "@")
+                for choice in response["choices"]
+            )
+            self.server.count("malformed" if malformed else "200")
+            self.respond(200, response)
+
+    def respond(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TimedBackend(LocalBackend):
+    # Client side latency of every request, failed ones included
+    def __init__(self, base_url, **options):
+        super().__init__(base_url, **options)
+        self.latencies = []
+
+    def complete(self, model, messages, temperature, **parameters):
+        started_at = time.perf_counter()
+
+        try:
+            return super().complete(model, messages, temperature, **parameters)
+        finally:
+            self.latencies.append(time.perf_counter() - started_at)
+
+
+class IoTimer:
+    # Wall time spent in CSV and journal I/O while a run is timed. Only the
+    # outermost timed call counts, compact restoring columns is not counted twice
+    def __init__(self):
+        self.seconds = {"csv": 0.0, "journal": 0.0}
+        self.depth = threading.local()
+        self.originals = []
+
+    def timed(self, category, function):
+        def timed_function(*args, **kwargs):
+            depth = getattr(self.depth, "value", 0)
+            self.depth.value = depth + 1
+            started_at = time.perf_counter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.depth.value = depth
+                if depth == 0:
+                    self.seconds[category] += time.perf_counter() - started_at
+
+        return timed_function
+
+    def timed_iterator(self, category, function):
+        def timed_function(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+
+            while True:
+                started_at = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.seconds[category] += time.perf_counter() - started_at
+
+                yield item
+
+        return timed_function
+
+    def wrap(self, owner, name, category, iterator=False):
+        original = getattr(owner, name)
+        self.originals.append((owner, name, original))
+
+        if iterator:
+            setattr(owner, name, self.timed_iterator(category, original))
+        else:
+            setattr(owner, name, self.timed(category, original))
+
+    def __enter__(self):
+        self.wrap(pd, "read_csv", "csv")
+        self.wrap(pd.DataFrame, "to_csv", "csv")
+        self.wrap(TweetStream, "__iter__", "csv", iterator=True)
+
+        for name in ("recover", "append", "sync", "compact", "restore", "close"):
+            self.wrap(PredictionJournal, name, "journal")
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for owner, name, original in reversed(self.originals):
+            setattr(owner, name, original)
+        self.originals = []
+
+
+class SyntheticTweets:
+    SUBJECTS = [
+        "The vaccine",
+        "COVID19",
+        "The new variant",
+        "Wearing a mask",
+        "Social distancing",
+        "The lockdown",
+        "Our hospital",
+        "The health ministry",
+        "My neighbour",
+        "This study",
+    ]
+    VERBS = [
+        "reduces",
+        "causes",
+        "does not prevent",
+        "spreads through",
+        "was linked to",
+        "has nothing to do with",
+        "is the reason for",
+        "doubled",
+    ]
+    OBJECTS = [
+        "transmission in schools",
+        "severe symptoms",
+        "deaths among the elderly",
+        "the cases reported today",
+        "infections on public transit",
+        "side effects in young adults",
+        "the economy",
+        "my weekend plans",
+    ]
+    TAILS = ["", " Read the whole story here", " StaySafe", " NoVaccineForMe", " ?!"]
+
+    @staticmethod
+    def write(file_name, count, labeled_fraction=0.1, chunk_size=100000, seed=0):
+        generator = np.random.default_rng(seed)
+        writer = IncrementalCsvWriter(
+            file_name, ["id_str", "polished_text", "cat1", "Claim"]
+        )
+
+        for start in range(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+            texts = (
+                np.array(SyntheticTweets.SUBJECTS)[
+                    generator.integers(len(SyntheticTweets.SUBJECTS), size=size)
+                ]
+                + " "
+                + np.array(SyntheticTweets.VERBS)[
+                    generator.integers(len(SyntheticTweets.VERBS), size=size)
+                ]
+                + " "
+                + np.array(SyntheticTweets.OBJECTS)[
+                    generator.integers(len(SyntheticTweets.OBJECTS), size=size)
+                ]
+                + np.array(SyntheticTweets.TAILS)[
+                    generator.integers(len(SyntheticTweets.TAILS), size=size)
+                ]
+                + " #"
+                + (start + np.arange(size)).astype(str)
+            )
+
+            labeled = generator.random(size) < labeled_fraction
+            claims = generator.integers(2, size=size)
+            categories = claims * generator.integers(2, size=size)
+
+            writer.write(
+                pd.DataFrame(
+                    {
+                        "id_str": (
+                            1300000000000000000 + start + np.arange(size)
+                        ).astype(str),
+                        "polished_text": texts,
+                        "cat1": np.where(labeled, categories, np.nan),
+                        "Claim": np.where(labeled, claims, np.nan),
+                    },
+                    index=start + np.arange(size),
+                )
+            )
+
+        return file_name
+
+    @staticmethod
+    def path(directory, count):
+        # Generated once per size and reused by later runs
+        os.makedirs(directory, exist_ok=True)
+        file_name = os.path.join(directory, f"synthetic-tweets-{count}.csv")
+
+        if not os.path.exists(file_name):
+            print("Writing", count, "synthetic tweets to", file_name)
+            SyntheticTweets.write(file_name, count)
+
+        return file_name
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+
+    # Kilobytes on Linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_benchmark(
+    input_file_name,
+    server_url,
+    work_directory,
+    model_name="mock-llm",
+    concurrency=16,
+    chunk_size=None,
+    use_logprobs=False,
+    retry_base_delay_seconds=0.05,
+):
+    output_file_name = os.path.join(
+        work_directory, f"predictions-{os.path.basename(input_file_name)}"
+    )
+    journal_file_name = f"{output_file_name}.journal"
+
+    # Every run starts cold, nothing is resumed from an earlier one
+    for file_name in (output_file_name, journal_file_name):
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    backend = TimedBackend(server_url, pool_size=concurrency)
+    Utility.backends["local"] = backend
+    Utility.response_cache = None
+    Utility.retry_policy = RetryPolicy(
+        base_delay_seconds=retry_base_delay_seconds,
+        max_delay_seconds=1,
+        circuit_breaker=CircuitBreaker(cooldown_seconds=1),
+    )
+
+    io_timer = IoTimer()
+    started_at = time.perf_counter()
+
+    # The per tweet progress output is part of the cost, but not of the report
+    with io_timer, open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+        devnull
+    ):
+        if chunk_size is None:
+            pipeline = FusedPipeline(
+                ClaimExistence(model_name, input_file_name, "local"),
+                [Category1(model_name, None, "local")],
+            )
+            pipeline.generate_metrics(
+                output_file_name,
+                concurrency=concurrency,
+                journal_file_name=journal_file_name,
+                use_logprobs=use_logprobs,
+            )
+        else:
+            pipeline = FusedPipeline(
+                ClaimExistence(model_name, None, "local"),
+                [Category1(model_name, None, "local")],
+            )
+            pipeline.generate_metrics_streaming(
+                input_file_name,
+                output_file_name,
+                concurrency=concurrency,
+                journal_file_name=journal_file_name,
+                use_logprobs=use_logprobs,
+                chunk_size=chunk_size,
+            )
+
+    elapsed_seconds = time.perf_counter() - started_at
+    backend.close()
+
+    tweets = len(pd.read_csv(input_file_name, usecols=["id_str"]))
+    latencies = np.array(backend.latencies) * 1000
+
+    return {
+        "tweets": tweets,
+        "concurrency": concurrency,
+        "chunk_size": chunk_size,
+        "use_logprobs": use_logprobs,
+        "seconds": elapsed_seconds,
+        "tweets_per_second": tweets / elapsed_seconds,
+        "requests": len(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        "csv_seconds": io_timer.seconds["csv"],
+        "journal_seconds": io_timer.seconds["journal"],
+        "peak_rss_mb": peak_rss_mb(),
+        "errors": dict(Utility.retry_policy.stats()["Errors"]),
+    }
+
+
+def compare_few_shot_prompts(
+    tweet_objects,
+    model_name,
+    backend="openai",
+    tweet_content_column="polished_text",
+    k=4,
+    token_budget=150,
+    concurrency=16,
+    classify=False,
+    output_prefix="fewshot",
+):
+    # Prompt tokens, and optionally accuracy, of the built-in few-shot examples
+    # against the examples retrieved per tweet
+    if classify and backend == "openai":
+        Utility.import_api_key()
+
+    rows = []
+
+    for prompt in ["static", "dynamic"]:
+        claim_existence = ClaimExistence(model_name, None, backend)
+        categories = [Category1(model_name, None, backend)]
+
+        if prompt == "dynamic":
+            for classifier in [claim_existence] + categories:
+                classifier.use_example_bank(
+                    ExampleBank.for_classifier(
+                        classifier,
+                        tweet_objects,
+                        tweet_content_column=tweet_content_column,
+                        k=k,
+                        token_budget=token_budget,
+                    )
+                )
+
+        pipeline = FusedPipeline(claim_existence, categories)
+
+        metrics = {}
+        if classify:
+            pipeline.tweet_objects = tweet_objects.copy()
+            metrics = pipeline.generate_metrics(
+                f"{output_prefix}-{prompt}.csv",
+                tweet_content_column,
+                concurrency,
+            )
+
+        for stage in pipeline.stages:
+            prompt_tokens = [
+                Utility.estimate_tokens(stage.build_messages(tweet))
+                for tweet in tweet_objects[tweet_content_column]
+            ]
+
+            stage_metrics = dict(metrics.get(stage.task, {}))
+            stage_metrics.pop("Confusion Matrix", None)
+
+            rows.append(
+                {
+                    "Prompt": prompt,
+                    "Task": stage.task,
+                    "Tweets": len(prompt_tokens),
+                    "Mean Prompt Tokens": np.mean(prompt_tokens),
+                    "Max Prompt Tokens": np.max(prompt_tokens),
+                    **stage_metrics,
+                }
+            )
+
+    return pd.DataFrame(rows)
+
+
+def compare_transports(server_url, request_count=1000, concurrency_levels=(16,)):
+    # Raw calls of one pooled backend, from worker threads through complete and
+    # from a single event loop through acomplete, without the pipeline around them
+    backend = LocalBackend(server_url, pool_size=max(concurrency_levels))
+
+    def call(complete, number):
+        messages = [
+            {"role": "user", "content": f"Tweet = ```transport check {number}```"}
+        ]
+        started_at = time.perf_counter()
+
+        try:
+            complete("mock-llm", messages, 0)
+            error = False
+        except BackendError:
+            error = True
+
+        return time.perf_counter() - started_at, error
+
+    async def acall(number):
+        messages = [
+            {"role": "user", "content": f"Tweet = ```transport check {number}```"}
+        ]
+        started_at = time.perf_counter()
+
+        try:
+            await backend.acomplete("mock-llm", messages, 0)
+            error = False
+        except BackendError:
+            error = True
+
+        return time.perf_counter() - started_at, error
+
+    async def run_event_loop(concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded_call(number):
+            async with semaphore:
+                return await acall(number)
+
+        try:
+            return await asyncio.gather(
+                *(bounded_call(number) for number in range(request_count))
+            )
+        finally:
+            await backend.aclose()
+
+    rows = []
+
+    try:
+        for concurrency in concurrency_levels:
+            for transport in ("threads", "asyncio"):
+                started_at = time.perf_counter()
+
+                if transport == "threads":
+                    with ThreadPoolExecutor(concurrency) as executor:
+                        calls = list(
+                            executor.map(
+                                lambda number: call(backend.complete, number),
+                                range(request_count),
+                            )
+                        )
+                else:
+                    # A new event loop every time, each with a session of its own
+                    calls = asyncio.run(run_event_loop(concurrency))
+
+                elapsed_seconds = time.perf_counter() - started_at
+                latencies = np.array([latency for latency, _ in calls]) * 1000
+
+                rows.append(
+                    {
+                        "Transport": transport,
+                        "Concurrency": concurrency,
+                        "Requests": request_count,
+                        "Errors": sum(error for _, error in calls),
+                        "Requests/s": request_count / elapsed_seconds,
+                        "p50 ms": np.percentile(latencies, 50),
+                        "p99 ms": np.percentile(latencies, 99),
+                    }
+                )
+    finally:
+        backend.close()
+
+    return pd.DataFrame(rows)
+
+
+@contextlib.contextmanager
+def mock_server_process(arguments):
+    # The server runs in its own process, so it does not compete with the
+    # pipeline for the interpreter lock or count towards its peak RSS
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve"] + arguments,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+
+    try:
+        # Printed once the socket is listening
+        yield server.stdout.readline().strip()
+    finally:
+        server.terminate()
+        server.wait()
+        server.stdout.close()
+
+
+def server_arguments(args):
+    return [
+        "--latency-median-ms",
+        str(args.latency_median_ms),
+        "--latency-sigma",
+        str(args.latency_sigma),
+        "--rate-limit-rate",
+        str(args.rate_limit_rate),
+        "--server-error-rate",
+        str(args.server_error_rate),
+        "--malformed-rate",
+        str(args.malformed_rate),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Throughput of the classification pipeline against a local "
+        "mock LLM server, without API costs or network time"
+    )
+    parser.add_argument(
+        "mode", choices=["serve", "run", "suite", "fewshot", "transports"]
+    )
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--server-url", default=None)
+    parser.add_argument("--latency-median-ms", type=float, default=200)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.01)
+    parser.add_argument("--server-error-rate", type=float, default=0.01)
+    parser.add_argument("--malformed-rate", type=float, default=0.01)
+    parser.add_argument("--data-directory", default="benchmark-data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16])
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--use-logprobs", action="store_true")
+    parser.add_argument("--results", default="benchmark-results.jsonl")
+    parser.add_argument("--requests", type=int, default=1000)
+    # Few-shot prompt comparison on the labeled tweets of a real input
+    parser.add_argument("--input", default="gpt-tweets.csv")
+    parser.add_argument("--model", default="gpt-4-1106-preview")
+    parser.add_argument("--backend", default="openai")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--token-budget", type=int, default=150)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument(
+        "--classify",
+        action="store_true",
+        help="Also classify the labeled tweets with both prompts, this calls the model",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "serve":
+        server = MockLLMServer(
+            args.port,
+            args.latency_median_ms,
+            args.latency_sigma,
+            args.rate_limit_rate,
+            args.server_error_rate,
+            args.malformed_rate,
+        )
+        print(server.url, flush=True)
+        server.serve_forever()
+    elif args.mode == "run":
+        # One configuration per process, so peak RSS belongs to that run alone
+        with contextlib.ExitStack() as stack:
+            server_url = args.server_url or stack.enter_context(
+                mock_server_process(server_arguments(args))
+            )
+
+            result = run_benchmark(
+                SyntheticTweets.path(args.data_directory, args.sizes[0]),
+                server_url,
+                args.data_directory,
+                concurrency=args.concurrency[0],
+                chunk_size=args.chunk_size,
+                use_logprobs=args.use_logprobs,
+            )
+
+        print(json.dumps(result))
+    elif args.mode == "transports":
+        with contextlib.ExitStack() as stack:
+            server_url = args.server_url or stack.enter_context(
+                mock_server_process(server_arguments(args))
+            )
+
+            comparison = compare_transports(server_url, args.requests, args.concurrency)
+
+        print(comparison.to_string(index=False, float_format="%.2f"))
+    elif args.mode == "fewshot":
+        tweet_objects = Utility.get_tweet_data(args.input)
+        tweet_objects = tweet_objects[tweet_objects["Claim"].notna()]
+        if args.limit is not None:
+            tweet_objects = tweet_objects.head(args.limit)
+
+        comparison = compare_few_shot_prompts(
+            tweet_objects,
+            args.model,
+            args.backend,
+            k=args.k,
+            token_budget=args.token_budget,
+            concurrency=args.concurrency[0],
+            classify=args.classify,
+        )
+        print(comparison.to_string(index=False))
+    else:
+        results = []
+
+        with mock_server_process(server_arguments(args)) as server_url:
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    run = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__), "run"]
+                        + ["--server-url", server_url]
+                        + ["--data-directory", args.data_directory]
+                        + ["--sizes", str(size), "--concurrency", str(concurrency)]
+                        + (
+                            ["--chunk-size", str(args.chunk_size)]
+                            if args.chunk_size
+                            else []
+                        )
+                        + (["--use-logprobs"] if args.use_logprobs else []),
+                        stdout=subprocess.PIPE,
+                        text=True,
+                        check=True,
+                    )
+                    result = json.loads(run.stdout.strip().splitlines()[-1])
+                    results.append(result)
+
+                    print(
+                        size,
+                        "tweets at concurrency",
+                        concurrency,
+                        "=",
+                        f"{result['tweets_per_second']:.1f} tweets/s",
+                    )
+
+        # Appended, so successive runs can be compared for regressions
+        with open(args.results, "a", encoding="utf-8") as file:
+            for result in results:
+                file.write(json.dumps({"recorded_at": time.time(), **result}) + "\n")
+
+        print(
+            pd.DataFrame(results)
+            .drop(columns=["errors"])
+            .to_string(index=False, float_format="%.2f")
+        )
+
+
+if __name__ == "__main__":
+    main()
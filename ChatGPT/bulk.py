@@ -0,0 +1,291 @@
+import argparse
+import json
+
+from backends import BACKENDS
+from chatgpt import Category1, ClaimExistence, Utility
+from engine import ClassificationEngine
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+
+
+class BulkJob:
+    ENDPOINT = "/v1/chat/completions"
+
+    CLASSIFIERS = {"claim": ClaimExistence, "cat1": Category1}
+
+    def __init__(self, classifier, tweet_content_column="polished_text"):
+        self.classifier = classifier
+        self.tweet_content_column = tweet_content_column
+
+        self.prediction_column_name = PredictionJournal.prediction_column_name(
+            classifier.model_name, classifier.task
+        )
+        self.claim_existence_prediction_column_name = (
+            PredictionJournal.prediction_column_name(classifier.model_name, "claim")
+        )
+
+    def custom_id(self, index):
+        return f"{self.classifier.model_name}:{self.classifier.task}:{index}"
+
+    @staticmethod
+    def parse_custom_id(custom_id):
+        # Model names may contain colons themselves, so split from the right
+        model_name, task, index = custom_id.rsplit(":", 2)
+        return model_name, task, int(index)
+
+    def is_gated(self):
+        return self.classifier.task != "claim"
+
+    def restore(self, journal):
+        tweet_objects = self.classifier.tweet_objects
+
+        journal.restore(tweet_objects, self.classifier.model_name, self.classifier.task)
+
+        if self.is_gated():
+            journal.restore(tweet_objects, self.classifier.model_name, "claim")
+
+    def write_requests(self, request_file_name, journal):
+        self.restore(journal)
+
+        written = 0
+        gated = 0
+        missing_claims = 0
+
+        with open(request_file_name, "w", encoding="utf-8") as file:
+            for index, row in self.classifier.tweet_objects.iterrows():
+                if row[self.prediction_column_name] != -1:
+                    continue
+
+                if self.is_gated():
+                    claim_existence_predicted_output = int(
+                        row[self.claim_existence_prediction_column_name]
+                    )
+
+                    # Rows without a claim are filled in with 0 during ingestion
+                    if claim_existence_predicted_output == 0:
+                        gated += 1
+                        continue
+
+                    if claim_existence_predicted_output == -1:
+                        missing_claims += 1
+                        continue
+
+                request = {
+                    "custom_id": self.custom_id(index),
+                    "method": "POST",
+                    "url": BulkJob.ENDPOINT,
+                    "body": {
+                        "model": self.classifier.model_name,
+                        "messages": self.classifier.build_messages(
+                            row[self.tweet_content_column]
+                        ),
+                        "temperature": self.classifier.TEMPERATURE,
+                    },
+                }
+
+                file.write(json.dumps(request, ensure_ascii=False) + "\n")
+                written += 1
+
+        print("Requests written =", written, "to", request_file_name)
+        print("Rows gated by claim existence =", gated)
+
+        if missing_claims:
+            print("Rows skipped without a claim existence prediction =", missing_claims)
+
+        return written
+
+    def ingest_results(self, result_file_name, journal):
+        self.restore(journal)
+
+        tweet_objects = self.classifier.tweet_objects
+
+        ingested = 0
+        failed = 0
+        unparsed = 0
+
+        with open(result_file_name, encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+
+                result = json.loads(line)
+
+                model_name, task, index = BulkJob.parse_custom_id(result["custom_id"])
+
+                if (
+                    model_name != self.classifier.model_name
+                    or task != self.classifier.task
+                    or index not in tweet_objects.index
+                    or tweet_objects.loc[index, self.prediction_column_name] != -1
+                ):
+                    continue
+
+                response = result.get("response")
+
+                if (
+                    result.get("error")
+                    or not response
+                    or response["status_code"] != 200
+                ):
+                    failed += 1
+                    continue
+
+                content = response["body"]["choices"][0]["message"]["content"]
+
+                try:
+                    response_type = Utility.extract_type_from_response(content)
+                except Exception:
+                    unparsed += 1
+                    continue
+
+                prediction = 0 if response_type == "@" else 1
+
+                journal.append(
+                    index,
+                    model_name,
+                    task,
+                    prediction,
+                    content,
+                    prompt_version=self.classifier.prompt_version,
+                )
+                tweet_objects.loc[index, self.prediction_column_name] = prediction
+                ingested += 1
+
+        if self.is_gated():
+            for index, row in tweet_objects.iterrows():
+                if (
+                    row[self.prediction_column_name] == -1
+                    and row[self.claim_existence_prediction_column_name] == 0
+                ):
+                    journal.append(
+                        index,
+                        self.classifier.model_name,
+                        self.classifier.task,
+                        0,
+                        prompt_version=self.classifier.prompt_version,
+                    )
+                    tweet_objects.loc[index, self.prediction_column_name] = 0
+
+        print("Results ingested =", ingested)
+        print("Failed requests =", failed, "Unparsable responses =", unparsed)
+
+        journal.compact(tweet_objects)
+
+        return self.calculate_metrics()
+
+    def calculate_metrics(self):
+        metrics = MetricsAccumulator()
+
+        for _, row in self.classifier.tweet_objects.iterrows():
+            if row[self.prediction_column_name] == -1:
+                continue
+
+            try:
+                ground_truth = int(row[self.classifier.ground_truth_column])
+            except ValueError:
+                continue
+
+            metrics.add(ground_truth, int(row[self.prediction_column_name]))
+
+        print(
+            "Rows still pending =",
+            (self.classifier.tweet_objects[self.prediction_column_name] == -1).sum(),
+        )
+
+        return metrics.calculate_metrics()
+
+    @staticmethod
+    def run_requests_locally(
+        request_file_name, result_file_name, concurrency=1, backend="openai"
+    ):
+        # Stand-in for the bulk endpoint: answers each request with a regular call
+        def run_request(line):
+            request = json.loads(line)
+            body = request["body"]
+
+            try:
+                model_name, task, _ = BulkJob.parse_custom_id(request["custom_id"])
+
+                content = Utility.retry_policy.call(
+                    lambda: Utility.get_completion_from_messages(
+                        body["messages"],
+                        body["model"],
+                        temperature=body["temperature"],
+                        task=task,
+                        backend=backend,
+                    ),
+                    task,
+                    model_name,
+                )
+            except Exception as exception:
+                return {
+                    "custom_id": request["custom_id"],
+                    "response": None,
+                    "error": {"message": str(exception)},
+                }
+
+            return {
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "model": body["model"],
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": content},
+                            }
+                        ],
+                    },
+                },
+                "error": None,
+            }
+
+        engine = ClassificationEngine(concurrency)
+
+        with open(request_file_name, encoding="utf-8") as request_file, open(
+            result_file_name, "w", encoding="utf-8"
+        ) as result_file:
+            lines = (line for line in request_file if line.strip())
+
+            for result in engine.map(run_request, lines):
+                result_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export and ingest OpenAI Batch-style JSONL classification jobs"
+    )
+    parser.add_argument("mode", choices=["write", "ingest", "run-locally"])
+    parser.add_argument("--task", choices=sorted(BulkJob.CLASSIFIERS), default="claim")
+    parser.add_argument("--model", default="gpt-4-1106-preview")
+    parser.add_argument("--input", default="gpt-tweets.csv")
+    parser.add_argument("--output", default="gpt-tweets.csv")
+    parser.add_argument("--requests", default="batch-requests.jsonl")
+    parser.add_argument("--results", default="batch-results.jsonl")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="openai")
+    args = parser.parse_args()
+
+    if args.mode == "run-locally":
+        if args.backend == "openai":
+            Utility.import_api_key()
+
+        BulkJob.run_requests_locally(
+            args.requests, args.results, args.concurrency, args.backend
+        )
+        return
+
+    classifier = BulkJob.CLASSIFIERS[args.task](args.model, args.input)
+    bulk_job = BulkJob(classifier)
+
+    with PredictionJournal(f"{args.output}.journal") as journal:
+        if args.mode == "write":
+            bulk_job.write_requests(args.requests, journal)
+        else:
+            print("Metrics =", bulk_job.ingest_results(args.results, journal))
+            Utility.write_prediction_output(classifier.tweet_objects, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class ReplayCacheMiss(Exception):
+    pass
+
+
+class ResponseCache:
+    EVICTION_INTERVAL = 100
+
+    def __init__(
+        self,
+        file_name="llm-cache.sqlite",
+        max_entries=None,
+        max_age_seconds=None,
+        replay=False,
+    ):
+        self.file_name = file_name
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.replay = replay
+
+        self.hits = 0
+        self.misses = 0
+        self.puts_since_eviction = 0
+
+        self.lock = threading.Lock()
+
+        if replay:
+            # Replay never writes, so a missing file is an error rather than a new cache
+            self.connection = sqlite3.connect(
+                f"file:{file_name}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            self.connection = sqlite3.connect(file_name, check_same_thread=False)
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT,
+                    created_at REAL,
+                    last_accessed_at REAL
+                )
+                """
+            )
+            self.connection.commit()
+            self.evict()
+
+    @staticmethod
+    def make_key(messages, model, **params):
+        payload = json.dumps(
+            {"model": model, "messages": messages, "params": params},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is not None and self.is_expired(row[1]):
+                row = None
+
+            if row is None:
+                self.misses += 1
+
+                if self.replay:
+                    raise ReplayCacheMiss(f"No cached response for key = {key}")
+
+                return None
+
+            self.hits += 1
+
+            if not self.replay:
+                self.connection.execute(
+                    "UPDATE responses SET last_accessed_at = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                self.connection.commit()
+
+            return row[0]
+
+    def put(self, key, model, response):
+        if self.replay:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            self.connection.commit()
+
+            self.puts_since_eviction += 1
+
+        if self.puts_since_eviction >= ResponseCache.EVICTION_INTERVAL:
+            self.evict()
+
+    def delete(self, key):
+        if self.replay:
+            return
+
+        with self.lock:
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def is_expired(self, created_at):
+        return (
+            self.max_age_seconds is not None
+            and time.time() - created_at > self.max_age_seconds
+        )
+
+    def evict(self):
+        with self.lock:
+            if self.max_age_seconds is not None:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE created_at < ?",
+                    (time.time() - self.max_age_seconds,),
+                )
+
+            if self.max_entries is not None:
+                # Least recently used entries go first
+                self.connection.execute(
+                    """
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses
+                        ORDER BY last_accessed_at DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+
+            self.connection.commit()
+            self.puts_since_eviction = 0
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+
+        lookups = self.hits + self.misses
+
+        return {
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Hit Rate": self.hits / lookups if lookups else 0,
+            "Entries": entries,
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.isotonic import IsotonicRegression
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import brier_score_loss
+from sklearn.model_selection import StratifiedKFold
+
+from journal import PredictionJournal
+from stream import IncrementalCsvWriter
+
+
+class ScoreCalibrator:
+    # The label probability of a model is not the rate at which its answers
+    # are right. Platt scaling fits a logistic curve to the log odds of the
+    # scores of the labeled rows, isotonic regression any monotone step
+    # function, which needs more labels to be stable
+    def __init__(self, method="sigmoid", folds=5, min_labeled_rows=10):
+        if method not in ("sigmoid", "isotonic"):
+            raise ValueError(f"Unknown method = {method}, expected sigmoid or isotonic")
+
+        self.method = method
+        self.folds = folds
+        self.min_labeled_rows = min_labeled_rows
+
+    @staticmethod
+    def log_odds(scores):
+        clipped = np.clip(np.asarray(scores, dtype=float), 1e-6, 1 - 1e-6)
+        return np.log(clipped / (1 - clipped)).reshape(-1, 1)
+
+    def fit(self, scores, ground_truth):
+        if self.method == "isotonic":
+            model = IsotonicRegression(y_min=0, y_max=1, out_of_bounds="clip")
+        else:
+            model = LogisticRegression()
+
+        return model.fit(ScoreCalibrator.log_odds(scores), ground_truth)
+
+    def predict(self, model, scores):
+        if self.method == "isotonic":
+            return model.predict(ScoreCalibrator.log_odds(scores))
+
+        return model.predict_proba(ScoreCalibrator.log_odds(scores))[:, 1]
+
+    def calibrate(self, scores, ground_truth):
+        # Calibrated score of every scored row, or None without enough labels.
+        # Labeled rows are calibrated out of fold, so they never score themselves
+        scores = np.asarray(scores, dtype=float)
+        ground_truth = np.asarray(ground_truth, dtype=float)
+
+        scored = ~np.isnan(scores)
+        labeled = np.flatnonzero(scored & ~np.isnan(ground_truth))
+        labels = ground_truth[labeled].astype(int)
+        class_counts = np.bincount(labels, minlength=2)
+
+        if len(labeled) < self.min_labeled_rows or class_counts.min() == 0:
+            print(
+                "Score calibration needs",
+                self.min_labeled_rows,
+                "scored labeled rows of both classes, skipping",
+            )
+            return None
+
+        calibrated = np.full(len(scores), np.nan)
+        calibrated[scored] = self.predict(
+            self.fit(scores[labeled], labels), scores[scored]
+        )
+
+        folds = min(self.folds, class_counts.min())
+
+        if folds >= 2:
+            for train, test in StratifiedKFold(
+                n_splits=folds, shuffle=True, random_state=0
+            ).split(labeled, labels):
+                calibrated[labeled[test]] = self.predict(
+                    self.fit(scores[labeled[train]], labels[train]),
+                    scores[labeled[test]],
+                )
+        else:
+            print(
+                "Too few labeled examples for cross validation, labeled rows are in sample"
+            )
+
+        print(
+            "Brier score on",
+            len(labeled),
+            "labeled rows, raw =",
+            brier_score_loss(labels, scores[labeled]),
+            "calibrated =",
+            brier_score_loss(labels, calibrated[labeled]),
+        )
+
+        return calibrated
+
+    def add_calibrated_scores(self, tweet_objects, model_name, stages):
+        for stage in stages:
+            score_column = PredictionJournal.score_column_name(model_name, stage.task)
+
+            if score_column not in tweet_objects:
+                continue
+
+            print("Calibrating", score_column, "with", self.method)
+            calibrated = self.calibrate(
+                tweet_objects[score_column], tweet_objects[stage.ground_truth_column]
+            )
+
+            if calibrated is not None:
+                tweet_objects[
+                    PredictionJournal.calibrated_score_column_name(
+                        model_name, stage.task
+                    )
+                ] = calibrated
+
+        return tweet_objects
+
+    def calibrate_file(self, file_name, model_name, stages, chunk_size=10000):
+        # For outputs written chunk by chunk. Only the score and ground truth
+        # columns are read to fit, then the file is rewritten one chunk at a time
+        header = list(pd.read_csv(file_name, nrows=0).columns)
+
+        calibrated_columns = {}
+        for stage in stages:
+            score_column = PredictionJournal.score_column_name(model_name, stage.task)
+
+            if score_column not in header or stage.ground_truth_column not in header:
+                continue
+
+            columns = pd.read_csv(
+                file_name, usecols=[score_column, stage.ground_truth_column]
+            )
+
+            print("Calibrating", score_column, "with", self.method)
+            calibrated = self.calibrate(
+                columns[score_column], columns[stage.ground_truth_column]
+            )
+
+            if calibrated is not None:
+                calibrated_columns[
+                    PredictionJournal.calibrated_score_column_name(
+                        model_name, stage.task
+                    )
+                ] = calibrated
+
+        if not calibrated_columns:
+            return False
+
+        temporary_file_name = f"{file_name}.calibrating"
+        writer = IncrementalCsvWriter(
+            temporary_file_name,
+            header[1:]
+            + [column for column in calibrated_columns if column not in header],
+        )
+
+        for tweet_objects in pd.read_csv(
+            file_name, index_col=0, dtype={"id_str": str}, chunksize=chunk_size
+        ):
+            start = writer.rows_written
+            for column, calibrated in calibrated_columns.items():
+                tweet_objects[column] = calibrated[start : start + len(tweet_objects)]
+
+            writer.write(tweet_objects)
+
+        os.replace(temporary_file_name, file_name)
+
+        return True
@@ -0,0 +1,248 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold, cross_val_predict
+from sklearn.pipeline import make_pipeline
+
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+
+
+class PreClassifier:
+    def __init__(
+        self,
+        ground_truth_column,
+        tweet_content_column="polished_text",
+        threshold=0.9,
+        folds=5,
+    ):
+        self.ground_truth_column = ground_truth_column
+        self.tweet_content_column = tweet_content_column
+        self.threshold = threshold
+        self.folds = folds
+
+    @staticmethod
+    def make_model():
+        return make_pipeline(
+            TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True),
+            LogisticRegression(max_iter=1000, class_weight="balanced"),
+        )
+
+    def predict_probabilities(self, tweet_objects):
+        # Probability of label 1 for every row, or None when there is nothing to learn from
+        texts = tweet_objects[self.tweet_content_column].fillna("").astype(str)
+        # Tweets without text have nothing to learn from
+        labeled = tweet_objects[self.ground_truth_column].notna() & (
+            texts.str.strip() != ""
+        )
+
+        ground_truth = tweet_objects.loc[labeled, self.ground_truth_column].astype(int)
+        class_counts = ground_truth.value_counts()
+
+        if len(class_counts) < 2:
+            print("Pre-classifier needs labeled examples of both classes, skipping")
+            return None
+
+        model = PreClassifier.make_model().fit(texts[labeled], ground_truth)
+
+        probabilities = pd.Series(np.nan, index=tweet_objects.index)
+
+        if (~labeled).any():
+            probabilities[~labeled] = model.predict_proba(texts[~labeled])[:, 1]
+
+        # Labeled rows are scored out of fold, so they are never answered from memory
+        folds = min(self.folds, class_counts.min())
+
+        if folds >= 2:
+            probabilities[labeled] = cross_val_predict(
+                PreClassifier.make_model(),
+                texts[labeled],
+                ground_truth,
+                cv=StratifiedKFold(n_splits=folds, shuffle=True, random_state=0),
+                method="predict_proba",
+            )[:, 1]
+        else:
+            print(
+                "Too few labeled examples for cross validation, labeled rows escalate"
+            )
+
+        return probabilities
+
+    def is_confident(self, probability):
+        return not np.isnan(probability) and max(probability, 1 - probability) >= (
+            self.threshold
+        )
+
+    def answer_confident_rows(
+        self,
+        tweet_objects,
+        model_name,
+        task,
+        journal,
+        prediction_column,
+        eligible=None,
+        prompt_version=None,
+    ):
+        probabilities = self.predict_probabilities(tweet_objects)
+
+        pending = tweet_objects[prediction_column] == -1
+        if eligible is not None:
+            pending &= eligible
+
+        if probabilities is None:
+            return 0
+
+        # Kept apart from the model's own scores, which its ROC and PR AUC are
+        # computed from. Labeled rows hold their out of fold probability
+        tweet_objects[
+            PredictionJournal.pre_classifier_score_column_name(model_name, task)
+        ] = probabilities
+
+        if not pending.any():
+            return 0
+
+        answered = 0
+        answered_metrics = MetricsAccumulator()
+
+        for index in tweet_objects.index[pending]:
+            probability = probabilities[index]
+
+            if not self.is_confident(probability):
+                continue
+
+            prediction = int(probability >= 0.5)
+
+            tweet_objects.loc[index, prediction_column] = prediction
+            journal.append(
+                index,
+                model_name,
+                task,
+                prediction,
+                f"pre-classifier probability = {probability:.4f}",
+                prompt_version=prompt_version,
+            )
+            answered += 1
+
+            ground_truth = tweet_objects.loc[index, self.ground_truth_column]
+            if not pd.isna(ground_truth):
+                answered_metrics.add(int(ground_truth), prediction)
+
+        print(
+            "Pre-classifier answered",
+            answered,
+            "of",
+            int(pending.sum()),
+            "pending rows, escalation rate =",
+            1 - answered / pending.sum(),
+        )
+
+        if len(answered_metrics):
+            print(
+                "Pre-classifier out of fold metrics on answered labeled rows =",
+                answered_metrics.calculate_metrics(),
+            )
+
+        return answered
+
+    @staticmethod
+    def score_metrics(tweet_objects, ground_truth_column, model_name, task):
+        score_metrics = MetricsAccumulator.calculate_score_metrics(
+            tweet_objects,
+            ground_truth_column,
+            PredictionJournal.pre_classifier_score_column_name(model_name, task),
+        )
+
+        return {
+            f"Pre-classifier {name}": value for name, value in score_metrics.items()
+        }
+
+    def threshold_curve(
+        self, tweet_objects, llm_prediction_column, thresholds=None, probabilities=None
+    ):
+        # Compares the cascade against an existing LLM-only run on the labeled rows
+        if probabilities is None:
+            probabilities = self.predict_probabilities(tweet_objects)
+
+        if probabilities is None:
+            return None
+
+        thresholds = thresholds or [0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99]
+
+        evaluated = (
+            tweet_objects[self.ground_truth_column].notna()
+            & (tweet_objects[llm_prediction_column] != -1)
+            & tweet_objects[llm_prediction_column].notna()
+        )
+
+        ground_truth = tweet_objects.loc[evaluated, self.ground_truth_column].astype(
+            int
+        )
+        llm_predictions = tweet_objects.loc[evaluated, llm_prediction_column].astype(
+            int
+        )
+        local_probabilities = probabilities[evaluated]
+
+        llm_metrics = MetricsAccumulator()
+        for truth, predicted in zip(ground_truth, llm_predictions):
+            llm_metrics.add(truth, predicted)
+
+        llm_only = llm_metrics.calculate_metrics()
+
+        rows = []
+        for threshold in thresholds:
+            confident = np.maximum(local_probabilities, 1 - local_probabilities) >= (
+                threshold
+            )
+            cascade_predictions = llm_predictions.where(
+                ~confident, (local_probabilities >= 0.5).astype(int)
+            )
+
+            cascade_metrics = MetricsAccumulator()
+            for truth, predicted in zip(ground_truth, cascade_predictions):
+                cascade_metrics.add(truth, predicted)
+
+            cascade = cascade_metrics.calculate_metrics()
+
+            rows.append(
+                {
+                    "Threshold": threshold,
+                    "Escalation Rate": 1 - confident.mean(),
+                    "Cascade Accuracy": cascade["Accuracy"],
+                    "Cascade F1": cascade["F1"],
+                    "Accuracy Delta": cascade["Accuracy"] - llm_only["Accuracy"],
+                    "F1 Delta": cascade["F1"] - llm_only["F1"],
+                }
+            )
+
+        print("LLM only metrics =", llm_only)
+
+        return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Escalation rate and accuracy of the pre-classifier cascade "
+        "against an existing LLM prediction column"
+    )
+    parser.add_argument("--input", default="gpt-tweets.csv")
+    parser.add_argument("--model", default="gpt-4-1106-preview")
+    parser.add_argument("--task", default="claim")
+    parser.add_argument("--ground-truth-column", default="Claim")
+    args = parser.parse_args()
+
+    tweet_objects = pd.read_csv(args.input, index_col=0)
+    pre_classifier = PreClassifier(args.ground_truth_column)
+
+    curve = pre_classifier.threshold_curve(
+        tweet_objects, PredictionJournal.prediction_column_name(args.model, args.task)
+    )
+
+    if curve is not None:
+        print(curve.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
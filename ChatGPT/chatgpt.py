@@ -1,8 +1,26 @@
+import hashlib
+import json
+import math
 import os
+import re
+import threading
 import time
+from concurrent.futures import Future
 import pandas as pd
-import openai
 
+from backends import make_backend
+from cache import ResponseCache
+from calibration import ScoreCalibrator
+from cascade import PreClassifier
+from dedup import TweetDeduplicator
+from engine import ClassificationEngine, RateLimiter
+from instrumentation import Instrumentation
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+from pipeline import FusedPipeline
+from results import ResultsStore
+from retry import RetryPolicy, UnparsableResponse
+from voting import SelfConsistency
 from sklearn.metrics import (
     accuracy_score,
     confusion_matrix,
@@ -11,6 +29,25 @@ from sklearn.metrics import (
 
 
 class Utility:
+    # cl100k_base token ids of the two label characters
+    LABEL_TOKEN_IDS = {"@": 31, "#": 2}
+
+    rate_limiter = None
+    response_cache = None
+
+    # Model name -> RateLimiter, for models with their own quota
+    rate_limiters = {}
+
+    # Cache key -> Future of the identical call currently being made
+    in_flight_calls = {}
+    in_flight_lock = threading.Lock()
+
+    # Backend name -> instance, filled on first use unless configured up front
+    backends = {}
+    backends_lock = threading.Lock()
+    retry_policy = RetryPolicy()
+    instrumentation = None
+
     def import_api_key():
         OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
@@ -26,7 +63,93 @@ class Utility:
                 print("Inside last search!")
                 return c
 
-        raise Exception(f"No @ or # found in response = {response}")
+        raise UnparsableResponse(f"No @ or # found in response = {response}")
+
+    @staticmethod
+    def build_packed_tweet_message(tweets, delimiter):
+        numbered_tweets = "\n".join(
+            f"{number}. Tweet = {delimiter}{tweet}{delimiter}"
+            for number, tweet in enumerate(tweets, start=1)
+        )
+
+        return (
+            f"Classify each of the following {len(tweets)} tweets independently.\n"
+            f"{numbered_tweets}\n\n"
+            "Respond with exactly one line per tweet in the format "
+            "<tweet number>: <# or @>, and nothing else."
+        )
+
+    @staticmethod
+    def extract_types_from_packed_response(response, tweet_count):
+        # Maps tweet number to the (@ or #, response line) found for it
+        types = {}
+
+        for line in response.splitlines():
+            match = re.match(r"\s*(\d+)\s*[:.)\-]", line)
+
+            if match is None:
+                continue
+
+            number = int(match.group(1))
+
+            if number < 1 or number > tweet_count or number in types:
+                continue
+
+            try:
+                types[number] = (
+                    Utility.extract_type_from_response(line[match.end() :]),
+                    line.strip(),
+                )
+            except Exception:
+                continue
+
+        return types
+
+    @staticmethod
+    def get_packed_types(
+        system_message,
+        tweets,
+        delimiter,
+        model,
+        temperature,
+        task=None,
+        backend="openai",
+    ):
+        messages = [
+            {"role": "system", "content": system_message},
+            {
+                "role": "user",
+                "content": Utility.build_packed_tweet_message(tweets, delimiter),
+            },
+        ]
+
+        try:
+            response = Utility.retry_policy.call(
+                lambda: Utility.get_completion_from_messages(
+                    messages,
+                    model,
+                    temperature=temperature,
+                    task=task,
+                    backend=backend,
+                ),
+                task,
+                model,
+                tweet_count=0,
+            )
+            print("Packed response = ", response)
+
+            types = Utility.extract_types_from_packed_response(response, len(tweets))
+
+            # Tweets left without a verdict are retried on their own by the caller
+            if Utility.instrumentation is not None:
+                Utility.instrumentation.record_success(task, model, len(types))
+                for _ in range(len(tweets) - len(types)):
+                    Utility.instrumentation.record_error(task, model, "unparsable")
+
+            return types
+        except Exception as exception:
+            print("Packed request failed, falling back to single tweets:", exception)
+            return {}
 
     @staticmethod
     def calculate_metrics(ground_truth, predicted):
@@ -50,7 +173,8 @@ class Utility:
 
     @staticmethod
     def get_tweet_data(file_name):
-        df = pd.read_csv(file_name, index_col=0)
+        # Tweet ids are kept as text, parsing them as floats rounds them
+        df = pd.read_csv(file_name, index_col=0, dtype={"id_str": str})
         return df
 
     @staticmethod
@@ -58,13 +182,232 @@ class Utility:
         tweet_objects.to_csv(file_name_to_write)
 
     @staticmethod
-    def get_completion_from_messages(messages, model="gpt-3.5-turbo", temperature=0):
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
+    def prompt_version(system_message):
+        # Any edit to the prompt gives its results a new version in the results store
+        return hashlib.sha256(system_message.encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def estimate_tokens(messages):
+        # Roughly four characters per token, plus the per-message framing overhead
+        return sum(len(message["content"]) // 4 + 4 for message in messages)
+
+    @staticmethod
+    def invalidate_cached_completion(messages, model, temperature, **parameters):
+        # Keeps a retry after an unusable answer from being served the same answer,
+        # parameters are those of the request, as they are part of the cache key
+        if Utility.response_cache is not None:
+            Utility.response_cache.delete(
+                ResponseCache.make_key(
+                    messages, model, temperature=temperature, **parameters
+                )
+            )
+
+    @staticmethod
+    def get_completion_from_messages(
+        messages, model="gpt-3.5-turbo", temperature=0, task=None, backend="openai"
+    ):
+        return Utility.request_completion(
+            messages,
+            model,
+            temperature,
+            task,
+            lambda response: response["choices"][0]["message"]["content"],
+            backend,
         )
-        return response.choices[0].message["content"]
+
+    @staticmethod
+    def extract_label_logprobs(response):
+        top_logprobs = response["choices"][0]["logprobs"]["content"][0]["top_logprobs"]
+
+        return json.dumps(
+            {
+                "content": response["choices"][0]["message"]["content"],
+                "logprobs": {
+                    entry["token"]: entry["logprob"] for entry in top_logprobs
+                },
+            },
+            ensure_ascii=False,
+        )
+
+    @staticmethod
+    def label_probability(label_logprobs):
+        # Probability of # renormalized over the two label tokens
+        probabilities = {"@": 0.0, "#": 0.0}
+
+        for token, logprob in label_logprobs.items():
+            if token.strip() in probabilities:
+                probabilities[token.strip()] += math.exp(logprob)
+
+        total = probabilities["@"] + probabilities["#"]
+
+        if total == 0:
+            raise UnparsableResponse(
+                f"No @ or # among the top logprobs = {label_logprobs}"
+            )
+
+        return probabilities["#"] / total
+
+    @staticmethod
+    def get_label_probability(messages, model, task=None, backend="openai"):
+        original_messages = messages
+        messages = messages[:-1] + [
+            {
+                "role": messages[-1]["role"],
+                "content": messages[-1]["content"]
+                + "\nAnswer with a single character, # or @.",
+            }
+        ]
+
+        parameters = {"max_tokens": 1, "logprobs": True, "top_logprobs": 5}
+
+        # The label token ids are only known for the OpenAI tokenizer
+        if Utility.get_backend(backend).supports_logit_bias:
+            parameters["logit_bias"] = {
+                str(token_id): 100 for token_id in Utility.LABEL_TOKEN_IDS.values()
+            }
+
+        response = Utility.request_completion(
+            messages,
+            model,
+            0,
+            task,
+            Utility.extract_label_logprobs,
+            backend,
+            **parameters,
+        )
+
+        print("Response = ", response)
+
+        label_logprobs = json.loads(response)
+
+        try:
+            return Utility.label_probability(label_logprobs["logprobs"]), response
+        except UnparsableResponse:
+            pass
+
+        # Without a logit bias both labels can fall out of the top logprobs, and
+        # at temperature 0 every retry would get the same answer. The answer,
+        # or else a free-text answer, still gives a label, with a hard score
+        try:
+            answer = label_logprobs["content"]
+            response_type = Utility.extract_type_from_response(answer)
+        except UnparsableResponse:
+            answer = Utility.get_completion_from_messages(
+                original_messages, model, 0, task, backend
+            )
+
+            try:
+                response_type = Utility.extract_type_from_response(answer)
+            except UnparsableResponse:
+                Utility.invalidate_cached_completion(original_messages, model, 0)
+                raise
+
+        return 1.0 if response_type == "#" else 0.0, json.dumps(
+            {**label_logprobs, "fallback": answer}, ensure_ascii=False
+        )
+
+    @staticmethod
+    def get_backend(name):
+        # Workers starting together must not each build a pooled session
+        if name not in Utility.backends:
+            with Utility.backends_lock:
+                if name not in Utility.backends:
+                    Utility.backends[name] = make_backend(name)
+
+        return Utility.backends[name]
+
+    @staticmethod
+    def request_completion(
+        messages,
+        model,
+        temperature,
+        task,
+        extract_result,
+        backend="openai",
+        **parameters,
+    ):
+        cache_key = ResponseCache.make_key(
+            messages, model, temperature=temperature, **parameters
+        )
+
+        if Utility.response_cache is not None:
+            cached_response = Utility.response_cache.get(cache_key)
+
+            if cached_response is not None:
+                if Utility.instrumentation is not None:
+                    Utility.instrumentation.record_call(task, model, 0, cached=True)
+
+                return cached_response
+
+        # An identical call already in flight, for instance from another cell of
+        # an experiment grid, is waited for instead of being paid for twice
+        with Utility.in_flight_lock:
+            in_flight_call = Utility.in_flight_calls.get(cache_key)
+            is_first_call = in_flight_call is None
+
+            if is_first_call:
+                in_flight_call = Future()
+                Utility.in_flight_calls[cache_key] = in_flight_call
+
+        if not is_first_call:
+            result = in_flight_call.result()
+
+            if Utility.instrumentation is not None:
+                Utility.instrumentation.record_call(task, model, 0, cached=True)
+
+            return result
+
+        try:
+            result = Utility.call_backend(
+                messages,
+                model,
+                temperature,
+                task,
+                extract_result,
+                backend,
+                **parameters,
+            )
+        except Exception as exception:
+            in_flight_call.set_exception(exception)
+            raise
+        else:
+            in_flight_call.set_result(result)
+        finally:
+            with Utility.in_flight_lock:
+                del Utility.in_flight_calls[cache_key]
+
+        if Utility.response_cache is not None:
+            Utility.response_cache.put(cache_key, model, result)
+
+        return result
+
+    @staticmethod
+    def call_backend(
+        messages, model, temperature, task, extract_result, backend, **parameters
+    ):
+        rate_limiter = Utility.rate_limiters.get(model, Utility.rate_limiter)
+
+        if rate_limiter is not None:
+            rate_limiter.acquire(Utility.estimate_tokens(messages))
+
+        started_at = time.monotonic()
+
+        response = Utility.get_backend(backend).complete(
+            model, messages, temperature, **parameters
+        )
+        result = extract_result(response)
+
+        if Utility.instrumentation is not None:
+            usage = response.get("usage") or {}
+            Utility.instrumentation.record_call(
+                task,
+                model,
+                time.monotonic() - started_at,
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0),
+            )
+
+        return result
 
 
 class Default(dict):
@@ -72,43 +415,223 @@ class Default(dict):
         return f"{{{key}}}"
 
 
-class ClaimExistence:
+class PromptOptions:
+    # Shared by the classifiers, each brings its own format_system_message,
+    # EXAMPLE_HEADINGS, DELIMITER and system_message
+
+    # Picks the few-shot examples per tweet instead of the built-in ones
+    example_bank = None
+
+    # Majority vote over sampled answers instead of a single answer
+    self_consistency = None
+
+    def use_example_bank(self, example_bank):
+        self.example_bank = example_bank
+        self.update_prompt_version()
+
+    def use_self_consistency(self, self_consistency):
+        self.self_consistency = self_consistency
+        self.update_prompt_version()
+
+    def update_prompt_version(self):
+        self.prompt_version = Utility.prompt_version(
+            self.system_message
+            + "".join(
+                option.describe()
+                for option in (self.example_bank, self.self_consistency)
+                if option is not None
+            )
+        )
+
+    def system_message_for(self, tweet):
+        if self.example_bank is None:
+            return self.system_message
+
+        return self.format_system_message(
+            *self.example_bank.example_blocks(tweet, *self.EXAMPLE_HEADINGS)
+        )
+
+    def build_messages(self, tweet):
+        return [
+            {"role": "system", "content": self.system_message_for(tweet)},
+            {
+                "role": "user",
+                "content": f"Tweet = {self.DELIMITER}{tweet}{self.DELIMITER}",
+            },
+        ]
+
+    def predict_by_vote(self, tweet):
+        # Utility is handed over rather than imported by voting.py, which would
+        # get a second copy of it when this file runs as a script
+        try:
+            return self.self_consistency.predict(
+                Utility,
+                self.build_messages(tweet),
+                self.model_name,
+                self.task,
+                self.backend,
+            )
+        except Exception as exception:
+            raise Exception(
+                f"Did not get predicted output for tweet = {tweet}"
+            ) from exception
+
+
+class ClaimExistence(PromptOptions):
     INPUT_VARIABLES = ["delimiter", "tweet"]
 
     DELIMITER = "```"
 
-    def __init__(self, model_name, input_file_name):
+    TEMPERATURE = 0.2
+
+    EXAMPLE_HEADINGS = (
+        "Some examples of tweets that contain scientific claims about COVID-19 (expected response #):",
+        "Some examples of tweets that do not contain scientific claims about COVID-19 (expected response @):",
+    )
+
+    EXAMPLE_CONDITION_COLUMN = None
+
+    def __init__(self, model_name, input_file_name, backend="openai"):
         (
             self.system_message,
             self.tweet_objects,
         ) = ClaimExistence.generate_system_prompt_for_claim_existence(input_file_name)
 
+        self.prompt_version = Utility.prompt_version(self.system_message)
         self.model_name = model_name
+        self.backend = backend
+        self.task = "claim"
+        self.ground_truth_column = "Claim"
 
-    def does_tweet_contain_claim(self, tweet):
-        messages = [
-            {"role": "system", "content": self.system_message},
-            {
-                "role": "user",
-                "content": f"Tweet = {Category.DELIMITER}{tweet}{Category.DELIMITER}",
-            },
-        ]
-
+    def get_claim_existence_response(self, tweet):
         response = Utility.get_completion_from_messages(
-            messages, self.model_name, temperature=0.2
+            self.build_messages(tweet),
+            self.model_name,
+            temperature=ClaimExistence.TEMPERATURE,
+            task=self.task,
+            backend=self.backend,
         )
 
         print("Response = ", response)
 
+        return response
+
+    def does_tweet_contain_claim(self, tweet):
+        response = self.get_claim_existence_response(tweet)
+
         response_number = Utility.extract_type_from_response(response)
 
         return response_number
 
+    def predict_claim_existence(self, tweet):
+        if self.self_consistency is not None:
+            return self.predict_by_vote(tweet)
+
+        def attempt():
+            response = self.get_claim_existence_response(tweet)
+
+            try:
+                response_type = Utility.extract_type_from_response(response)
+            except UnparsableResponse:
+                Utility.invalidate_cached_completion(
+                    self.build_messages(tweet),
+                    self.model_name,
+                    ClaimExistence.TEMPERATURE,
+                )
+                raise
+
+            return 0 if response_type == "@" else 1, response, None
+
+        try:
+            return Utility.retry_policy.call(attempt, self.task, self.model_name)
+        except Exception as exception:
+            raise Exception(
+                f"Did not get predicted output for tweet = {tweet}"
+            ) from exception
+
+    def predict_claim_existence_with_logprobs(self, tweet):
+        try:
+            probability, response = Utility.retry_policy.call(
+                lambda: Utility.get_label_probability(
+                    self.build_messages(tweet), self.model_name, self.task, self.backend
+                ),
+                self.task,
+                self.model_name,
+            )
+        except Exception as exception:
+            raise Exception(
+                f"Did not get predicted output for tweet = {tweet}"
+            ) from exception
+
+        return int(probability >= 0.5), response, probability
+
+    def predict_claim_existence_batch(self, tweets):
+        types = Utility.get_packed_types(
+            self.system_message,
+            tweets,
+            ClaimExistence.DELIMITER,
+            self.model_name,
+            temperature=ClaimExistence.TEMPERATURE,
+            task=self.task,
+            backend=self.backend,
+        )
+
+        predictions = []
+
+        for number, tweet in enumerate(tweets, start=1):
+            if number in types:
+                response_type, response_line = types[number]
+                predictions.append(
+                    (0 if response_type == "@" else 1, response_line, None)
+                )
+            else:
+                print("No verdict for packed tweet# =", number, ", asking separately")
+                predictions.append(self.predict_claim_existence(tweet))
+
+        return predictions
+
     def generate_claim_existence_metrics(
-        self, output_file_name, tweet_content_column="polished_text"
+        self,
+        output_file_name,
+        tweet_content_column="polished_text",
+        concurrency=1,
+        journal_file_name=None,
+        batch_size=1,
+        use_logprobs=False,
+        pre_classifier=None,
+        deduplicator=None,
+    ):
+        if use_logprobs and batch_size != 1:
+            raise ValueError("Logprob classification only supports batch_size = 1")
+
+        with PredictionJournal(
+            journal_file_name or f"{output_file_name}.journal"
+        ) as journal:
+            return self.generate_claim_existence_metrics_with_journal(
+                output_file_name,
+                tweet_content_column,
+                concurrency,
+                journal,
+                batch_size,
+                use_logprobs,
+                pre_classifier,
+                deduplicator,
+            )
+
+    def generate_claim_existence_metrics_with_journal(
+        self,
+        output_file_name,
+        tweet_content_column,
+        concurrency,
+        journal,
+        batch_size,
+        use_logprobs,
+        pre_classifier,
+        deduplicator,
     ):
         claim_existence_ground_truths = []
         claim_existence_predicted_outputs = []
+        claim_existence_metrics = MetricsAccumulator()
 
         print(
             "<======= Generating metrics for Claim Existence =======>",
@@ -116,9 +639,50 @@ class ClaimExistence:
         print()
 
         claim_existence_prediction_column_name = f"{self.model_name}-predicted-claim"
+        claim_existence_score_column_name = PredictionJournal.score_column_name(
+            self.model_name, self.task
+        )
+
+        print(
+            "Restored predictions from journal =",
+            journal.restore(self.tweet_objects, self.model_name, "claim"),
+        )
+
+        if pre_classifier is not None:
+            pre_classifier.answer_confident_rows(
+                self.tweet_objects,
+                self.model_name,
+                self.task,
+                journal,
+                claim_existence_prediction_column_name,
+                prompt_version=self.prompt_version,
+            )
+
+        # Only one tweet per cluster of near duplicates goes to the model
+        if deduplicator is not None:
+            deduplicator.assign(self.tweet_objects, tweet_content_column)
 
-        if claim_existence_prediction_column_name not in self.tweet_objects:
-            self.tweet_objects[claim_existence_prediction_column_name] = -1
+        pending_tweets = [
+            row[tweet_content_column]
+            for index, row in self.tweet_objects.iterrows()
+            if row[claim_existence_prediction_column_name] == -1
+            and (deduplicator is None or deduplicator.duplicate_of(index) is None)
+        ]
+
+        engine = ClassificationEngine(concurrency)
+
+        if use_logprobs:
+            pending_predictions = engine.map(
+                self.predict_claim_existence_with_logprobs, pending_tweets
+            )
+        elif batch_size == 1:
+            pending_predictions = engine.map(
+                self.predict_claim_existence, pending_tweets
+            )
+        else:
+            pending_predictions = engine.map_batches(
+                self.predict_claim_existence_batch, pending_tweets, batch_size
+            )
 
         for index, row in self.tweet_objects.iterrows():
             print("Processing tweet with index# =", index)
@@ -138,44 +702,57 @@ class ClaimExistence:
                 claim_existence_predicted_outputs.append(
                     int(row[claim_existence_prediction_column_name])
                 )
+                claim_existence_metrics.add(
+                    claim_existence_ground_truth,
+                    int(row[claim_existence_prediction_column_name]),
+                )
                 continue
 
-            for _ in range(10):
-                try:
-                    claim_existence_predicted_output = self.does_tweet_contain_claim(
-                        tweet
-                    )
-
-                    claim_existence_predicted_output = (
-                        0 if claim_existence_predicted_output == "@" else 1
-                    )
-
-                    if claim_existence_predicted_output is None:
-                        continue
-                    else:
-                        break
-                except:
-                    continue
+            representative = (
+                None if deduplicator is None else deduplicator.duplicate_of(index)
+            )
 
-            if claim_existence_predicted_output is None:
-                print("None for index# = ", index, "and tweet content =", tweet)
-                raise Exception("Did not get predicted output for tweet")
+            if representative is not None:
+                (
+                    claim_existence_predicted_output,
+                    response,
+                    score,
+                ) = deduplicator.answer_from_representative(
+                    self.tweet_objects,
+                    representative,
+                    claim_existence_prediction_column_name,
+                    claim_existence_score_column_name,
+                )
+            else:
+                try:
+                    (
+                        claim_existence_predicted_output,
+                        response,
+                        score,
+                    ) = next(pending_predictions)
+                except Exception:
+                    print("None for index# = ", index, "and tweet content =", tweet)
+                    raise
 
             if index > 0 and index % 5 == 0:
                 print(
                     "Metrics till now =",
-                    Utility.calculate_metrics(
-                        claim_existence_ground_truths, claim_existence_predicted_outputs
-                    ),
+                    claim_existence_metrics.calculate_metrics(),
                 )
 
             claim_existence_ground_truths.append(claim_existence_ground_truth)
             claim_existence_predicted_outputs.append(claim_existence_predicted_output)
+            claim_existence_metrics.add(
+                claim_existence_ground_truth, claim_existence_predicted_output
+            )
 
             self.tweet_objects.loc[
                 index, claim_existence_prediction_column_name
             ] = claim_existence_predicted_output
 
+            if score is not None:
+                self.tweet_objects.loc[index, claim_existence_score_column_name] = score
+
             print(
                 "Ground truth =",
                 claim_existence_ground_truth,
@@ -185,20 +762,44 @@ class ClaimExistence:
             print("Finished Processing tweet with index# =", index)
             print()
 
-            Utility.write_prediction_output(self.tweet_objects, output_file_name)
-
-            time.sleep(0.1)
+            journal.append(
+                index,
+                self.model_name,
+                "claim",
+                claim_existence_predicted_output,
+                response,
+                score,
+                self.prompt_version,
+            )
 
         print("<======= Finished generating metrics for claim existence =======>")
 
         print("Ground truths = ", claim_existence_ground_truths)
         print("Predictions = ", claim_existence_predicted_outputs)
 
-        Utility.write_prediction_output(self.tweet_objects, output_file_name)
+        if deduplicator is not None:
+            deduplicator.report_disagreements(
+                self.tweet_objects,
+                [self.ground_truth_column, claim_existence_prediction_column_name],
+            )
 
-        return Utility.calculate_metrics(
-            claim_existence_ground_truths, claim_existence_predicted_outputs
+        journal.compact(self.tweet_objects)
+        ScoreCalibrator().add_calibrated_scores(
+            self.tweet_objects, self.model_name, [self]
         )
+        Utility.write_prediction_output(self.tweet_objects, output_file_name)
+
+        return {
+            **claim_existence_metrics.calculate_metrics(),
+            **MetricsAccumulator.calculate_score_metrics(
+                self.tweet_objects,
+                self.ground_truth_column,
+                PredictionJournal.score_column_name(self.model_name, self.task),
+            ),
+            **PreClassifier.score_metrics(
+                self.tweet_objects, self.ground_truth_column, self.model_name, self.task
+            ),
+        }
 
     @staticmethod
     def generate_system_prompt_for_claim_existence(input_file_name):
@@ -216,7 +817,24 @@ class ClaimExistence:
             c) "The Centre is gearing up for the roll out of COVID19 vaccine across the country, with four States all set to initiate a dryrun for vaccine administration next week, the Union Health Ministry said."
         """
 
-        system_message = """
+        system_message = ClaimExistence.format_system_message(
+            tweet_examples_for_claim_existence, tweet_examples_for_non_claim_existence
+        )
+
+        # Streaming runs feed the tweets chunk by chunk instead
+        tweet_objects = None
+
+        if input_file_name is not None:
+            tweet_objects = Utility.get_tweet_data(input_file_name)
+            print("Length of tweet objects = ", len(tweet_objects))
+
+        return system_message, tweet_objects
+
+    @staticmethod
+    def format_system_message(
+        tweet_examples_for_claim_existence, tweet_examples_for_non_claim_existence
+    ):
+        return """
         Imagine you're a COVID-19 tweets classifier. You need to determine whether tweets contain a scientific claim about COVID-19.
         
         The tweets will be delimited with {delimiter} characters.
@@ -243,48 +861,177 @@ class ClaimExistence:
             )
         )
 
-        tweet_objects = Utility.get_tweet_data(input_file_name)
 
-        print("Length of tweet objects = ", len(tweet_objects))
-
-        return system_message, tweet_objects
-
-
-class Category:
+class Category(PromptOptions):
     INPUT_VARIABLES = ["delimiter", "tweet"]
 
     DELIMITER = "```"
 
     CATEGORY_DESCRIPTIONS = {1: "Scientifically Verifiable"}
 
-    def __init__(self, category_type, model_name):
+    TEMPERATURE = 0
+
+    # Categories are only asked about tweets that contain a claim
+    EXAMPLE_CONDITION_COLUMN = "Claim"
+
+    def __init__(self, category_type, model_name, backend="openai"):
         self.category_type = category_type
         self.model_name = model_name
+        self.backend = backend
+        self.task = f"cat{category_type}"
+        self.ground_truth_column = f"cat{category_type}"
 
-    def does_tweet_fall_into_category(self, tweet):
-        messages = [
-            {"role": "system", "content": self.system_message},
-            {
-                "role": "user",
-                "content": f"Tweet = {Category.DELIMITER}{tweet}{Category.DELIMITER}",
-            },
-        ]
-
+    def get_category_response(self, tweet):
         response = Utility.get_completion_from_messages(
-            messages, self.model_name, temperature=0
+            self.build_messages(tweet),
+            self.model_name,
+            temperature=Category.TEMPERATURE,
+            task=self.task,
+            backend=self.backend,
         )
 
         print("Response = ", response)
 
+        return response
+
+    def does_tweet_fall_into_category(self, tweet):
+        response = self.get_category_response(tweet)
+
         response_number = Utility.extract_type_from_response(response)
 
         return response_number
 
+    def predict_category(self, pending_row):
+        claim_existence_predicted_output, tweet = pending_row
+
+        if claim_existence_predicted_output == 0:
+            return 0, None, None
+
+        if self.self_consistency is not None:
+            return self.predict_by_vote(tweet)
+
+        def attempt():
+            response = self.get_category_response(tweet)
+
+            try:
+                response_type = Utility.extract_type_from_response(response)
+            except UnparsableResponse:
+                Utility.invalidate_cached_completion(
+                    self.build_messages(tweet), self.model_name, Category.TEMPERATURE
+                )
+                raise
+
+            return 0 if response_type == "@" else 1, response, None
+
+        try:
+            return Utility.retry_policy.call(attempt, self.task, self.model_name)
+        except Exception as exception:
+            raise Exception(
+                f"Did not get predicted output for tweet = {tweet}"
+            ) from exception
+
+    def predict_category_with_logprobs(self, pending_row):
+        claim_existence_predicted_output, tweet = pending_row
+
+        if claim_existence_predicted_output == 0:
+            return 0, None, 0.0
+
+        try:
+            probability, response = Utility.retry_policy.call(
+                lambda: Utility.get_label_probability(
+                    self.build_messages(tweet), self.model_name, self.task, self.backend
+                ),
+                self.task,
+                self.model_name,
+            )
+        except Exception as exception:
+            raise Exception(
+                f"Did not get predicted output for tweet = {tweet}"
+            ) from exception
+
+        return int(probability >= 0.5), response, probability
+
+    def predict_category_batch(self, pending_rows):
+        predictions = [None] * len(pending_rows)
+        claim_positions = []
+
+        for position, pending_row in enumerate(pending_rows):
+            claim_existence_predicted_output, _ = pending_row
+
+            if claim_existence_predicted_output == 0:
+                predictions[position] = (0, None, None)
+            else:
+                claim_positions.append(position)
+
+        if not claim_positions:
+            return predictions
+
+        types = Utility.get_packed_types(
+            self.system_message,
+            [pending_rows[position][1] for position in claim_positions],
+            Category.DELIMITER,
+            self.model_name,
+            temperature=Category.TEMPERATURE,
+            task=self.task,
+            backend=self.backend,
+        )
+
+        for number, position in enumerate(claim_positions, start=1):
+            if number in types:
+                response_type, response_line = types[number]
+                predictions[position] = (
+                    0 if response_type == "@" else 1,
+                    response_line,
+                    None,
+                )
+            else:
+                print("No verdict for packed tweet# =", number, ", asking separately")
+                predictions[position] = self.predict_category(pending_rows[position])
+
+        return predictions
+
     def generate_cat_metrics(
-        self, output_file_name, tweet_content_column="polished_text"
+        self,
+        output_file_name,
+        tweet_content_column="polished_text",
+        concurrency=1,
+        journal_file_name=None,
+        batch_size=1,
+        use_logprobs=False,
+        pre_classifier=None,
+        deduplicator=None,
+    ):
+        if use_logprobs and batch_size != 1:
+            raise ValueError("Logprob classification only supports batch_size = 1")
+
+        with PredictionJournal(
+            journal_file_name or f"{output_file_name}.journal"
+        ) as journal:
+            return self.generate_cat_metrics_with_journal(
+                output_file_name,
+                tweet_content_column,
+                concurrency,
+                journal,
+                batch_size,
+                use_logprobs,
+                pre_classifier,
+                deduplicator,
+            )
+
+    def generate_cat_metrics_with_journal(
+        self,
+        output_file_name,
+        tweet_content_column,
+        concurrency,
+        journal,
+        batch_size,
+        use_logprobs,
+        pre_classifier,
+        deduplicator,
     ):
         category_ground_truths = []
         category_predicted_outputs = []
+        category_metrics = MetricsAccumulator()
 
         print(
             "<======= Generating metrics for category type =",
@@ -296,9 +1043,69 @@ class Category:
         category_type_prediction_column_name = (
             f"{self.model_name}-predicted-cat{self.category_type}"
         )
+        category_type_score_column_name = PredictionJournal.score_column_name(
+            self.model_name, self.task
+        )
 
-        if category_type_prediction_column_name not in self.tweet_objects:
-            self.tweet_objects[category_type_prediction_column_name] = -1
+        print(
+            "Restored predictions from journal =",
+            journal.restore(
+                self.tweet_objects, self.model_name, f"cat{self.category_type}"
+            ),
+        )
+
+        # Claim predictions journaled by an earlier run may not be in the CSV yet
+        journal.restore(self.tweet_objects, self.model_name, "claim")
+
+        claim_existence_prediction_column_name = f"{self.model_name}-predicted-claim"
+
+        # Tweets without a claim are answered for free, so only the rest may skip the LLM
+        if pre_classifier is not None:
+            pre_classifier.answer_confident_rows(
+                self.tweet_objects,
+                self.model_name,
+                self.task,
+                journal,
+                category_type_prediction_column_name,
+                eligible=self.tweet_objects[claim_existence_prediction_column_name]
+                != 0,
+                prompt_version=self.prompt_version,
+            )
+
+        # Only one tweet per cluster of near duplicates goes to the model
+        if deduplicator is not None:
+            deduplicator.assign(self.tweet_objects, tweet_content_column)
+
+        def duplicate_of(index):
+            if deduplicator is None:
+                return None
+
+            return deduplicator.duplicate_of(
+                index, self.tweet_objects, claim_existence_prediction_column_name
+            )
+
+        pending_rows = [
+            (
+                int(row[claim_existence_prediction_column_name]),
+                row[tweet_content_column],
+            )
+            for index, row in self.tweet_objects.iterrows()
+            if row[category_type_prediction_column_name] == -1
+            and duplicate_of(index) is None
+        ]
+
+        engine = ClassificationEngine(concurrency)
+
+        if use_logprobs:
+            pending_predictions = engine.map(
+                self.predict_category_with_logprobs, pending_rows
+            )
+        elif batch_size == 1:
+            pending_predictions = engine.map(self.predict_category, pending_rows)
+        else:
+            pending_predictions = engine.map_batches(
+                self.predict_category_batch, pending_rows, batch_size
+            )
 
         for index, row in self.tweet_objects.iterrows():
             print("Processing tweet with index# =", index)
@@ -318,55 +1125,51 @@ class Category:
                 category_predicted_outputs.append(
                     int(row[category_type_prediction_column_name])
                 )
+                category_metrics.add(
+                    category_ground_truth,
+                    int(row[category_type_prediction_column_name]),
+                )
                 continue
 
-            claim_existence_prediction_column_name = (
-                f"{self.model_name}-predicted-claim"
-            )
-
-            claim_existence_predicted_output = int(
-                row[claim_existence_prediction_column_name]
-            )
-
-            if claim_existence_predicted_output == 0:
-                category_predicted_output = 0
+            representative = duplicate_of(index)
+
+            if representative is not None:
+                (
+                    category_predicted_output,
+                    response,
+                    score,
+                ) = deduplicator.answer_from_representative(
+                    self.tweet_objects,
+                    representative,
+                    category_type_prediction_column_name,
+                    category_type_score_column_name,
+                )
             else:
-                for _ in range(10):
-                    try:
-                        category_predicted_output = self.does_tweet_fall_into_category(
-                            tweet
-                        )
-
-                        category_predicted_output = (
-                            0 if category_predicted_output == "@" else 1
-                        )
-
-                        if category_predicted_output is None:
-                            continue
-                        else:
-                            break
-                    except:
-                        continue
-
-            if category_predicted_output is None:
-                print("None for index# = ", index, "and tweet content =", tweet)
-                raise Exception("Did not get predicted output for tweet")
+                try:
+                    category_predicted_output, response, score = next(
+                        pending_predictions
+                    )
+                except Exception:
+                    print("None for index# = ", index, "and tweet content =", tweet)
+                    raise
 
             if index > 0 and index % 5 == 0:
                 print(
                     "Metrics till now =",
-                    Utility.calculate_metrics(
-                        category_ground_truths, category_predicted_outputs
-                    ),
+                    category_metrics.calculate_metrics(),
                 )
 
             category_ground_truths.append(category_ground_truth)
             category_predicted_outputs.append(category_predicted_output)
+            category_metrics.add(category_ground_truth, category_predicted_output)
 
             self.tweet_objects.loc[
                 index, category_type_prediction_column_name
             ] = category_predicted_output
 
+            if score is not None:
+                self.tweet_objects.loc[index, category_type_score_column_name] = score
+
             print(
                 "Ground truth =",
                 category_ground_truth,
@@ -376,33 +1179,63 @@ class Category:
             print("Finished Processing tweet with index# =", index)
             print()
 
-            Utility.write_prediction_output(self.tweet_objects, output_file_name)
-
-            time.sleep(0.1)
+            journal.append(
+                index,
+                self.model_name,
+                f"cat{self.category_type}",
+                category_predicted_output,
+                response,
+                score,
+                self.prompt_version,
+            )
 
         print("<======= Finished generating metrics for claim existence =======>")
 
         print("Ground truths = ", category_ground_truths)
         print("Predictions = ", category_predicted_outputs)
 
-        Utility.write_prediction_output(self.tweet_objects, output_file_name)
+        if deduplicator is not None:
+            deduplicator.report_disagreements(
+                self.tweet_objects,
+                [self.ground_truth_column, category_type_prediction_column_name],
+            )
 
-        return Utility.calculate_metrics(
-            category_ground_truths, category_predicted_outputs
+        journal.compact(self.tweet_objects)
+        ScoreCalibrator().add_calibrated_scores(
+            self.tweet_objects, self.model_name, [self]
         )
+        Utility.write_prediction_output(self.tweet_objects, output_file_name)
+
+        return {
+            **category_metrics.calculate_metrics(),
+            **MetricsAccumulator.calculate_score_metrics(
+                self.tweet_objects,
+                self.ground_truth_column,
+                PredictionJournal.score_column_name(self.model_name, self.task),
+            ),
+            **PreClassifier.score_metrics(
+                self.tweet_objects, self.ground_truth_column, self.model_name, self.task
+            ),
+        }
 
 
 class Category1(Category):
     CATEGORY_TYPE = 1
     CATEGORY_DESCRIPTION = ""
 
-    def __init__(self, model_name, input_file_name):
+    EXAMPLE_HEADINGS = (
+        "Some examples of tweets that ARE scientifically verifiable (expected response #):",
+        "Some examples of tweets ARE NOT scientifically verifiable (expected response @):",
+    )
+
+    def __init__(self, model_name, input_file_name, backend="openai"):
         (
             self.system_message,
             self.tweet_objects,
         ) = Category1.generate_system_prompt_for_category1(input_file_name)
 
-        super().__init__(Category1.CATEGORY_TYPE, model_name)
+        self.prompt_version = Utility.prompt_version(self.system_message)
+        super().__init__(Category1.CATEGORY_TYPE, model_name, backend)
 
     @staticmethod
     def generate_system_prompt_for_category1(input_file_name):
@@ -420,7 +1253,24 @@ class Category1(Category):
             c) ": I wouldnt trust anything this man touches. NoVaccineForMe"
         """
 
-        system_message = """
+        system_message = Category1.format_system_message(
+            tweet_examples_of_category1, tweet_examples_of_non_category1
+        )
+
+        # Streaming runs feed the tweets chunk by chunk instead
+        tweet_objects = None
+
+        if input_file_name is not None:
+            tweet_objects = Utility.get_tweet_data(input_file_name)
+            print("Length of tweet objects = ", len(tweet_objects))
+
+        return system_message, tweet_objects
+
+    @staticmethod
+    def format_system_message(
+        tweet_examples_of_category1, tweet_examples_of_non_category1
+    ):
+        return """
         Imagine you're a COVID-19 tweets classifier. You need to determine whether tweets fall into scientifically verifiable claim category.
         
         The tweets will be delimited with {delimiter} characters.
@@ -453,12 +1303,6 @@ class Category1(Category):
             )
         )
 
-        tweet_objects = Utility.get_tweet_data(input_file_name)
-
-        print("Length of tweet objects = ", len(tweet_objects))
-
-        return system_message, tweet_objects
-
 
 # def does_tweet_contain_claim(tweet, delimiter="```"):
 #     system_message = f"""
@@ -498,18 +1342,173 @@ class Category1(Category):
 
 
 def main():
-    Utility.import_api_key()
+    # "openai", "together" or "local", any OpenAI-compatible server such as vLLM
+    backend = "openai"
+
+    if backend == "openai":
+        Utility.import_api_key()
 
     model_name = "gpt-4-1106-preview"
 
     input_file_name = "gpt-tweets.csv"
     output_file_name = "gpt-tweets.csv"
 
-    # claim_existence = ClaimExistence(model_name, input_file_name)
-    # claim_existence.generate_claim_existence_metrics(output_file_name)
+    # Number of tweets classified in parallel, 1 keeps the original serial loop
+    concurrency = 16
+
+    # Llama 2 through a local server, sized so every worker keeps a connection
+    # model_name = "meta-llama/Llama-2-70b-chat-hf"
+    # Utility.backends["local"] = make_backend(
+    #     "local", base_url="http://localhost:8000/v1", timeout=120, pool_size=concurrency
+    # )
+
+    # Number of tweets packed into one request, 1 sends every tweet on its own
+    batch_size = 1
+
+    # Ask for a single label token and keep the probability of # as a score column.
+    # It is renormalized over the two label tokens, not calibrated
+    use_logprobs = False
+
+    # Answer confident tweets with a local TF-IDF model and send the rest to the
+    # LLM. None sends every tweet to the LLM, 0.9 is a reasonable threshold
+    pre_classifier_threshold = None
+    pre_classifier = None
+    if pre_classifier_threshold is not None:
+        pre_classifier = PreClassifier("Claim", threshold=pre_classifier_threshold)
+
+    # Classify one tweet per cluster of duplicates and give the rest of the cluster
+    # its label. None classifies every tweet, "exact" only merges tweets that are
+    # the same after normalization, such as retweets, "near" also merges
+    # near-identical posts
+    deduplication = None
+    deduplicator = None
+    if deduplication == "exact":
+        deduplicator = TweetDeduplicator(similarity_threshold=None)
+    elif deduplication == "near":
+        deduplicator = TweetDeduplicator(similarity_threshold=0.8)
+
+    # Send the labeled tweets most similar to each tweet as its few-shot examples,
+    # instead of the built-in ones, see benchmark.py fewshot for the token
+    # comparison
+    dynamic_few_shot = False
+
+    # Majority vote over sampled answers for the borderline category, stopping as
+    # soon as the remaining samples cannot change the outcome. mode="n" asks for
+    # the samples of a round in a single request instead of parallel calls. None
+    # asks once per tweet, 5 is a reasonable number of samples
+    self_consistency_samples = None
+    self_consistency = None
+    if self_consistency_samples is not None:
+        self_consistency = SelfConsistency(
+            samples=self_consistency_samples, temperature=0.7, mode="parallel"
+        )
+
+    # Number of tweets read per chunk when streaming inputs too large to load
+    # whole, None loads the input at once
+    chunk_size = None
+
+    Utility.rate_limiter = RateLimiter(
+        requests_per_minute=500, tokens_per_minute=300000
+    )
+
+    Utility.instrumentation = Instrumentation(summary_interval_seconds=30)
+    Utility.retry_policy.listeners.append(Utility.instrumentation)
+
+    # Set replay=True to rerun purely from previously cached responses
+    Utility.response_cache = ResponseCache(
+        "llm-cache.sqlite", max_age_seconds=30 * 24 * 60 * 60, replay=False
+    )
+
+    # claim_existence = ClaimExistence(model_name, input_file_name, backend)
+    # claim_existence.generate_claim_existence_metrics(
+    #     output_file_name,
+    #     concurrency=concurrency,
+    #     batch_size=batch_size,
+    #     pre_classifier=pre_classifier,
+    #     deduplicator=deduplicator,
+    # )
+
+    # cat1 = Category1(model_name, input_file_name, backend)
+    # cat1.generate_cat_metrics(
+    #     output_file_name,
+    #     concurrency=concurrency,
+    #     batch_size=batch_size,
+    #     deduplicator=deduplicator,
+    # )
+
+    # Claim existence feeds every category in a single pass over the tweets
+    if chunk_size is None:
+        journal_file_name = f"{output_file_name}.journal"
+        run_start = PredictionJournal.end_offset(journal_file_name)
+
+        # The categories work on the tweets loaded by the claim stage
+        pipeline = FusedPipeline(
+            ClaimExistence(model_name, input_file_name, backend),
+            [Category1(model_name, None, backend)],
+        )
+        if dynamic_few_shot:
+            pipeline.use_example_banks(pipeline.tweet_objects)
+        if self_consistency is not None:
+            pipeline.use_self_consistency(self_consistency, tasks=["cat1"])
+
+        print(
+            "Metrics =",
+            pipeline.generate_metrics(
+                output_file_name,
+                concurrency=concurrency,
+                use_logprobs=use_logprobs,
+                deduplicator=deduplicator,
+                pre_classifier=pre_classifier,
+                batch_size=batch_size,
+            ),
+        )
+    else:
+        streaming_output_file_name = "gpt-tweets-predictions.csv"
+        journal_file_name = f"{streaming_output_file_name}.journal"
+        run_start = PredictionJournal.end_offset(journal_file_name)
+
+        pipeline = FusedPipeline(
+            ClaimExistence(model_name, None, backend),
+            [Category1(model_name, None, backend)],
+        )
+        if dynamic_few_shot:
+            pipeline.use_example_banks(
+                pipeline.read_labeled_tweets(input_file_name, chunk_size=chunk_size)
+            )
+        if self_consistency is not None:
+            pipeline.use_self_consistency(self_consistency, tasks=["cat1"])
+
+        print(
+            "Metrics =",
+            pipeline.generate_metrics_streaming(
+                input_file_name,
+                streaming_output_file_name,
+                concurrency=concurrency,
+                use_logprobs=use_logprobs,
+                deduplicator=deduplicator,
+                chunk_size=chunk_size,
+                pre_classifier=pre_classifier,
+                batch_size=batch_size,
+            ),
+        )
+
+    # Long format copy of the predictions made by this run, keyed by tweet id,
+    # model, task and the prompt version each was made with. Earlier runs are
+    # already in the store, and restored rows keep their own prompt version there
+    ResultsStore("results-store").write_records(
+        PredictionJournal.read_records(journal_file_name, run_start),
+        ResultsStore.read_tweet_ids(input_file_name),
+    )
+
+    print("Response cache =", Utility.response_cache.stats())
+    print("Retries =", Utility.retry_policy.stats())
+
+    if self_consistency is not None:
+        print("Self-consistency =", self_consistency.stats())
 
-    cat1 = Category1(model_name, input_file_name)
-    cat1.generate_cat_metrics(output_file_name)
+    print("Instrumentation =", Utility.instrumentation.summary_line())
+    Utility.instrumentation.write_snapshot("llm-metrics.json")
+    Utility.instrumentation.write_snapshot("llm-metrics.prom")
 
 
 if __name__ == "__main__":
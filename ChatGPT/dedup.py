@@ -0,0 +1,258 @@
+import argparse
+import hashlib
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+
+class TweetDeduplicator:
+    # Largest prime below 2**32, so a * x + b never overflows 64 bits
+    PRIME = 4294967291
+
+    def __init__(
+        self,
+        shingle_size=5,
+        num_permutations=128,
+        bands=32,
+        similarity_threshold=0.8,
+        seed=0,
+    ):
+        if num_permutations % bands != 0:
+            raise ValueError("num_permutations must be a multiple of bands")
+
+        self.shingle_size = shingle_size
+        self.num_permutations = num_permutations
+        self.bands = bands
+        self.rows_per_band = num_permutations // bands
+        self.similarity_threshold = similarity_threshold
+
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, TweetDeduplicator.PRIME, num_permutations, np.uint64)
+        self.b = rng.integers(0, TweetDeduplicator.PRIME, num_permutations, np.uint64)
+
+        # Row index -> index of the first row of its cluster
+        self.representatives = None
+
+    @staticmethod
+    def normalize(text):
+        if not isinstance(text, str):
+            return ""
+
+        text = text.lower()
+        text = re.sub(r"^rt @\w+:?", " ", text)
+        text = re.sub(r"https?://\S+", " ", text)
+        text = re.sub(r"@\w+", " ", text)
+        text = re.sub(r"[^\w\s]", " ", text)
+
+        return " ".join(text.split())
+
+    def shingles(self, normalized_text):
+        if len(normalized_text) <= self.shingle_size:
+            return {normalized_text}
+
+        return {
+            normalized_text[start : start + self.shingle_size]
+            for start in range(len(normalized_text) - self.shingle_size + 1)
+        }
+
+    def signature(self, normalized_text):
+        hashes = np.fromiter(
+            (
+                zlib.crc32(shingle.encode("utf-8")) % TweetDeduplicator.PRIME
+                for shingle in self.shingles(normalized_text)
+            ),
+            dtype=np.uint64,
+        )
+
+        return (
+            (self.a[:, None] * hashes[None, :] + self.b[:, None])
+            % TweetDeduplicator.PRIME
+        ).min(axis=1)
+
+    def cluster(self, texts):
+        normalized_texts = [TweetDeduplicator.normalize(text) for text in texts]
+
+        # Exact duplicates after normalization share a digest
+        first_position_by_digest = {}
+        exact_representatives = []
+        for position, normalized_text in enumerate(normalized_texts):
+            digest = hashlib.sha1(normalized_text.encode("utf-8")).digest()
+            exact_representatives.append(
+                first_position_by_digest.setdefault(digest, position)
+            )
+
+        # None keeps to exact duplicates, such as retweets of the same post
+        if self.similarity_threshold is None:
+            return exact_representatives
+
+        unique_positions = [
+            position
+            for position, representative in enumerate(exact_representatives)
+            if position == representative and normalized_texts[position]
+        ]
+
+        parents = {position: position for position in unique_positions}
+
+        def find(position):
+            while parents[position] != position:
+                parents[position] = parents[parents[position]]
+                position = parents[position]
+            return position
+
+        signatures = {
+            position: self.signature(normalized_texts[position])
+            for position in unique_positions
+        }
+
+        # Near duplicates collide in at least one band, then the full signature confirms
+        for band in range(self.bands):
+            start = band * self.rows_per_band
+            buckets = defaultdict(list)
+
+            for position in unique_positions:
+                key = signatures[position][start : start + self.rows_per_band]
+                buckets[key.tobytes()].append(position)
+
+            for bucket in buckets.values():
+                first = bucket[0]
+                for position in bucket[1:]:
+                    similarity = np.mean(signatures[first] == signatures[position])
+                    if similarity >= self.similarity_threshold:
+                        root, other_root = find(first), find(position)
+                        parents[max(root, other_root)] = min(root, other_root)
+
+        representatives = []
+        for position, representative in enumerate(exact_representatives):
+            if representative in parents:
+                representative = find(representative)
+            representatives.append(representative)
+
+        return representatives
+
+    def assign(self, tweet_objects, tweet_content_column="polished_text"):
+        positions = self.cluster(tweet_objects[tweet_content_column].tolist())
+        self.representatives = pd.Series(
+            tweet_objects.index[positions], index=tweet_objects.index
+        )
+
+        clusters = self.representatives.nunique()
+        exact_duplicates = len(tweet_objects) - len(
+            set(
+                TweetDeduplicator.normalize(text)
+                for text in tweet_objects[tweet_content_column]
+            )
+        )
+
+        print(
+            "Deduplicated",
+            len(tweet_objects),
+            "tweets into",
+            clusters,
+            "clusters,",
+            exact_duplicates,
+            "exact and",
+            len(tweet_objects) - clusters - exact_duplicates,
+            "near duplicates, saving",
+            len(tweet_objects) - clusters,
+            "calls per task",
+        )
+
+        return self.representatives
+
+    def duplicate_of(self, index, tweet_objects=None, agree_column=None):
+        # Representative to copy the answer from, or None when the row must be classified
+        if self.representatives is None or index not in self.representatives.index:
+            return None
+
+        representative = self.representatives[index]
+        if representative == index:
+            return None
+
+        # Both rows have to take the same path through a gated stage
+        if agree_column is not None and (
+            tweet_objects.loc[index, agree_column]
+            != tweet_objects.loc[representative, agree_column]
+        ):
+            return None
+
+        return representative
+
+    def answer_from_representative(
+        self, tweet_objects, representative, prediction_column, score_column
+    ):
+        prediction = int(tweet_objects.loc[representative, prediction_column])
+
+        score = None
+        if score_column in tweet_objects:
+            score = tweet_objects.loc[representative, score_column]
+            score = None if pd.isna(score) else float(score)
+
+        return prediction, f"duplicate of tweet index# = {representative}", score
+
+    def disagreements(self, tweet_objects, column):
+        # Clusters whose members do not share a single value of column
+        if self.representatives is None:
+            return pd.DataFrame()
+
+        labeled = tweet_objects[column].notna() & (tweet_objects[column] != -1)
+        members = pd.DataFrame(
+            {
+                "Representative": self.representatives[labeled],
+                column: tweet_objects.loc[labeled, column],
+            }
+        )
+
+        values = members.groupby("Representative")[column].agg(
+            lambda labels: sorted(set(labels))
+        )
+        sizes = members.groupby("Representative").size()
+
+        report = pd.DataFrame({"Size": sizes, "Labels": values})
+        return report[report["Labels"].map(len) > 1]
+
+    def report_disagreements(self, tweet_objects, columns):
+        for column in columns:
+            if column not in tweet_objects:
+                continue
+
+            report = self.disagreements(tweet_objects, column)
+            print(
+                "Clusters with disagreeing",
+                column,
+                "labels =",
+                len(report),
+            )
+
+            if len(report):
+                print(report.to_string())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cluster near-duplicate tweets and report label disagreements"
+    )
+    parser.add_argument("--input", default="tweets.csv")
+    parser.add_argument("--tweet-content-column", default="polished_text")
+    parser.add_argument("--similarity-threshold", type=float, default=0.8)
+    parser.add_argument(
+        "--exact-only",
+        action="store_true",
+        help="Only cluster tweets that are the same after normalization",
+    )
+    parser.add_argument("--columns", nargs="*", default=["Claim", "cat1"])
+    args = parser.parse_args()
+
+    tweet_objects = pd.read_csv(args.input, index_col=0)
+
+    deduplicator = TweetDeduplicator(
+        similarity_threshold=None if args.exact_only else args.similarity_threshold
+    )
+    deduplicator.assign(tweet_objects, args.tweet_content_column)
+    deduplicator.report_disagreements(tweet_objects, args.columns)
+
+
+if __name__ == "__main__":
+    main()
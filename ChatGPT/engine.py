@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self.request_allowance = requests_per_minute or 0
+        self.token_allowance = tokens_per_minute or 0
+        self.last_refill = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+
+        if self.requests_per_minute:
+            self.request_allowance = min(
+                self.requests_per_minute,
+                self.request_allowance + elapsed_minutes * self.requests_per_minute,
+            )
+
+        if self.tokens_per_minute:
+            self.token_allowance = min(
+                self.tokens_per_minute,
+                self.token_allowance + elapsed_minutes * self.tokens_per_minute,
+            )
+
+    def acquire(self, tokens=0):
+        while True:
+            with self.lock:
+                self.refill(time.monotonic())
+
+                wait_seconds = 0
+
+                if self.requests_per_minute and self.request_allowance < 1:
+                    wait_seconds = max(
+                        wait_seconds,
+                        (1 - self.request_allowance) * 60 / self.requests_per_minute,
+                    )
+
+                if self.tokens_per_minute:
+                    # A request larger than the whole budget only waits for a full bucket
+                    needed_tokens = min(tokens, self.tokens_per_minute)
+                    if self.token_allowance < needed_tokens:
+                        wait_seconds = max(
+                            wait_seconds,
+                            (needed_tokens - self.token_allowance)
+                            * 60
+                            / self.tokens_per_minute,
+                        )
+
+                if wait_seconds == 0:
+                    if self.requests_per_minute:
+                        self.request_allowance -= 1
+                    if self.tokens_per_minute:
+                        self.token_allowance -= tokens
+                    return
+
+            time.sleep(wait_seconds)
+
+
+class ClassificationEngine:
+    def __init__(self, concurrency=1, max_in_flight=None):
+        self.concurrency = max(1, concurrency)
+        self.max_in_flight = max_in_flight or self.concurrency * 4
+
+    def map(self, function, items):
+        # Results are yielded in the same order as items, whatever order the workers finish in
+        if self.concurrency == 1:
+            for item in items:
+                yield function(item)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = deque()
+
+            try:
+                for item in items:
+                    in_flight.append(executor.submit(function, item))
+
+                    if len(in_flight) >= self.max_in_flight:
+                        yield in_flight.popleft().result()
+
+                while in_flight:
+                    yield in_flight.popleft().result()
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+    def map_batches(self, function, items, batch_size):
+        # function receives a list of items and returns one result per item
+        for results in self.map(
+            function, ClassificationEngine.chunk(items, batch_size)
+        ):
+            yield from results
+
+    @staticmethod
+    def chunk(items, size):
+        items = iter(items)
+
+        while True:
+            batch = list(islice(items, size))
+
+            if not batch:
+                return
+
+            yield batch
@@ -0,0 +1,365 @@
+import argparse
+import json
+import os
+import queue
+import threading
+from collections import defaultdict
+
+import pandas as pd
+
+from backends import make_backend
+from cache import ResponseCache
+from chatgpt import Category1, ClaimExistence, Utility
+from engine import ClassificationEngine, RateLimiter
+from instrumentation import Instrumentation
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+from pipeline import FusedPipeline
+from results import ResultsStore
+
+
+class ExperimentCell:
+    def __init__(self, model, version_name, prompt_files, tasks):
+        self.model_name = model["model"]
+        self.backend = model.get("backend", "openai")
+
+        # The backend instance of this model, registered by the grid
+        backend_name = ExperimentCell.backend_name(model)
+
+        claim_existence = ClaimExistence(self.model_name, None, backend_name)
+        categories = []
+        if "cat1" in tasks:
+            categories.append(Category1(self.model_name, None, backend_name))
+
+        # Tasks without a prompt file of their own keep the built-in prompt, so
+        # cells sharing it make identical calls that are only paid for once
+        for classifier in [claim_existence] + categories:
+            if classifier.task in prompt_files:
+                with open(prompt_files[classifier.task], encoding="utf-8") as file:
+                    classifier.system_message = file.read()
+
+            # Named after the config entry, hashed like every other prompt
+            # version, so an edited prompt file gets a version of its own
+            classifier.prompt_version = (
+                f"{version_name}-{Utility.prompt_version(classifier.system_message)}"
+            )
+
+        # Categories are gated by the claim prediction, so claim always runs
+        self.pipeline = FusedPipeline(claim_existence, categories)
+        self.stages = self.pipeline.stages
+
+        # Journal name of every task, as in ResultsStore.pivot. A prompt edit
+        # changes it, so the old prompt's predictions are never taken as done
+        self.prompt_versions = {
+            stage.task: stage.prompt_version for stage in self.stages
+        }
+        self.journal_names = {
+            task: f"{self.model_name}@{prompt_version}"
+            for task, prompt_version in self.prompt_versions.items()
+        }
+
+    @staticmethod
+    def backend_name(model):
+        return f"{model.get('backend', 'openai')}:{model['model']}"
+
+
+class ExperimentGrid:
+    def __init__(self, config, base_directory="."):
+        self.config = config
+        self.base_directory = base_directory
+
+        self.input_file_name = self.path(config["input"])
+        self.output_file_name = self.path(config.get("output", "experiments.csv"))
+        self.journal_file_name = self.path(
+            config.get("journal", f"{self.output_file_name}.journal")
+        )
+
+        self.tweet_content_column = config.get("tweet_content_column", "polished_text")
+        self.concurrency = config.get("concurrency", 16)
+        self.use_logprobs = config.get("use_logprobs", False)
+
+        tasks = config.get("tasks", ["claim", "cat1"])
+        prompt_versions = config.get("prompt_versions", {"default": {}})
+
+        self.cells = [
+            ExperimentCell(
+                model,
+                prompt_version,
+                {
+                    task: self.path(file_name)
+                    for task, file_name in prompt_files.items()
+                },
+                tasks,
+            )
+            for model in config["models"]
+            for prompt_version, prompt_files in prompt_versions.items()
+        ]
+
+        # Every model draws on its own quota and its own workers, whatever the
+        # number of its cells
+        self.model_concurrency = {
+            model["model"]: model.get("concurrency", self.concurrency)
+            for model in config["models"]
+        }
+
+        for model in config["models"]:
+            # Its own backend instance too, so models of the same backend can use
+            # other servers, timeouts and connection pools
+            backend_options = dict(model.get("backend_options", {}))
+            if model.get("backend", "openai") != "openai":
+                backend_options.setdefault(
+                    "pool_size", self.model_concurrency[model["model"]]
+                )
+
+            Utility.backends[ExperimentCell.backend_name(model)] = make_backend(
+                model.get("backend", "openai"), **backend_options
+            )
+
+            if "requests_per_minute" in model or "tokens_per_minute" in model:
+                Utility.rate_limiters[model["model"]] = RateLimiter(
+                    requests_per_minute=model.get("requests_per_minute"),
+                    tokens_per_minute=model.get("tokens_per_minute"),
+                )
+
+    @staticmethod
+    def from_file(file_name):
+        with open(file_name, encoding="utf-8") as file:
+            config = json.load(file)
+
+        return ExperimentGrid(config, os.path.dirname(os.path.abspath(file_name)))
+
+    def path(self, file_name):
+        return os.path.join(self.base_directory, file_name)
+
+    def pending_units(self, tweet_objects, journal):
+        units = []
+        blank_rows = 0
+
+        # Tweet-major order interleaves the prompt versions of a model, which
+        # share its workers and its rate limit, so they progress at the same pace
+        for index, row in tweet_objects.iterrows():
+            # Blank lines of the input have neither an index nor a tweet to send
+            if pd.isna(index) or pd.isna(row[self.tweet_content_column]):
+                blank_rows += 1
+                continue
+
+            for cell in self.cells:
+                claim_existence_predicted_output = journal.predictions_for(
+                    cell.journal_names["claim"], "claim"
+                ).get(index, -1)
+                pending_categories = [
+                    category
+                    for category in cell.pipeline.categories
+                    if index
+                    not in journal.predictions_for(
+                        cell.journal_names[category.task], category.task
+                    )
+                ]
+
+                if claim_existence_predicted_output == -1 or pending_categories:
+                    units.append(
+                        (
+                            cell,
+                            index,
+                            (
+                                row[self.tweet_content_column],
+                                claim_existence_predicted_output,
+                                pending_categories,
+                                self.use_logprobs,
+                            ),
+                        )
+                    )
+
+        if blank_rows:
+            print("Rows skipped without an index or a tweet =", blank_rows)
+
+        return units
+
+    def run(self):
+        tweet_objects = Utility.get_tweet_data(self.input_file_name)
+
+        # Identical calls of different cells are answered once, even without a
+        # cache file, rather than only when they happen to overlap in time
+        if Utility.response_cache is None:
+            Utility.response_cache = ResponseCache(":memory:")
+
+        with PredictionJournal(self.journal_file_name) as journal:
+            units = self.pending_units(tweet_objects, journal)
+
+            units_by_model = defaultdict(list)
+            for unit in units:
+                units_by_model[unit[0].model_name].append(unit)
+
+            print(
+                "Running",
+                len(self.cells),
+                "cells,",
+                len(units),
+                "pending rows over",
+                {
+                    model_name: self.model_concurrency[model_name]
+                    for model_name in units_by_model
+                },
+                "workers per model",
+            )
+
+            # Every model runs on its own engine, so a model held back by its rate
+            # limit or a slow server only stalls its own workers. The journal is
+            # only written from this thread
+            results = queue.Queue()
+            threads = [
+                threading.Thread(
+                    target=ExperimentGrid.run_model,
+                    args=(model_units, self.model_concurrency[model_name], results),
+                    daemon=True,
+                )
+                for model_name, model_units in units_by_model.items()
+            ]
+            for thread in threads:
+                thread.start()
+
+            running = len(threads)
+            while running:
+                result = results.get()
+
+                if result is None:
+                    running -= 1
+                    continue
+
+                if isinstance(result, Exception):
+                    raise result
+
+                cell, index, predictions = result
+                for task, (predicted_output, response, score) in predictions.items():
+                    journal.append(
+                        index,
+                        cell.journal_names[task],
+                        task,
+                        predicted_output,
+                        response,
+                        score,
+                        cell.prompt_versions[task],
+                    )
+
+            comparison = self.comparison_table(tweet_objects, journal)
+
+            if "results_store" in self.config:
+                self.write_results_store(journal)
+
+        comparison.to_csv(self.output_file_name, index=False)
+        print(comparison.to_string(index=False))
+
+        return comparison
+
+    @staticmethod
+    def run_model(units, concurrency, results):
+        try:
+            engine = ClassificationEngine(concurrency)
+            pending_predictions = engine.map(
+                lambda unit: unit[0].pipeline.predict_row(unit[2]), units
+            )
+
+            for (cell, index, _), predictions in zip(units, pending_predictions):
+                results.put((cell, index, predictions))
+        except Exception as exception:
+            results.put(exception)
+        finally:
+            results.put(None)
+
+    def comparison_table(self, tweet_objects, journal):
+        rows = []
+
+        for cell in self.cells:
+            for stage in cell.stages:
+                predictions = journal.predictions_for(
+                    cell.journal_names[stage.task], stage.task
+                )
+                scores = journal.scores_for(cell.journal_names[stage.task], stage.task)
+
+                labeled = tweet_objects[
+                    tweet_objects[stage.ground_truth_column].notna()
+                    & tweet_objects.index.isin(list(predictions))
+                ]
+
+                metrics = MetricsAccumulator()
+                for index, ground_truth in labeled[stage.ground_truth_column].items():
+                    metrics.add(int(ground_truth), predictions[index])
+
+                if not len(metrics):
+                    continue
+
+                scored = pd.DataFrame(
+                    {
+                        "ground_truth": labeled[stage.ground_truth_column],
+                        "score": [
+                            scores.get(index, float("nan")) for index in labeled.index
+                        ],
+                    },
+                    index=labeled.index,
+                )
+
+                cell_metrics = {
+                    **metrics.calculate_metrics(),
+                    **MetricsAccumulator.calculate_score_metrics(
+                        scored, "ground_truth", "score"
+                    ),
+                }
+                cell_metrics.pop("Confusion Matrix")
+
+                rows.append(
+                    {
+                        "Model": cell.model_name,
+                        "Backend": cell.backend,
+                        "Prompt Version": stage.prompt_version,
+                        "Task": stage.task,
+                        "Tweets": len(metrics),
+                        **cell_metrics,
+                    }
+                )
+
+        return pd.DataFrame(rows)
+
+    def write_results_store(self, journal):
+        results_store = ResultsStore(self.path(self.config["results_store"]))
+        tweet_ids = ResultsStore.read_tweet_ids(self.input_file_name)
+
+        for cell in self.cells:
+            for stage in cell.stages:
+                results_store.write(
+                    cell.model_name,
+                    stage.task,
+                    stage.prompt_version,
+                    journal.predictions_for(cell.journal_names[stage.task], stage.task),
+                    journal.scores_for(cell.journal_names[stage.task], stage.task),
+                    tweet_ids,
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a grid of models x prompt versions x tasks in one job"
+    )
+    parser.add_argument("config", nargs="?", default="experiments.json")
+    args = parser.parse_args()
+
+    grid = ExperimentGrid.from_file(args.config)
+
+    if any(cell.backend == "openai" for cell in grid.cells):
+        Utility.import_api_key()
+
+    Utility.instrumentation = Instrumentation(summary_interval_seconds=30)
+    Utility.retry_policy.listeners.append(Utility.instrumentation)
+
+    if "cache" in grid.config:
+        Utility.response_cache = ResponseCache(grid.path(grid.config["cache"]))
+
+    grid.run()
+
+    if Utility.response_cache is not None:
+        print("Response cache =", Utility.response_cache.stats())
+
+    print("Instrumentation =", Utility.instrumentation.summary_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import string
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from dedup import TweetDeduplicator
+
+
+class ExampleBank:
+    def __init__(
+        self,
+        tweet_objects,
+        ground_truth_column,
+        tweet_content_column="polished_text",
+        k=4,
+        token_budget=150,
+        eligible=None,
+    ):
+        self.ground_truth_column = ground_truth_column
+        self.k = k
+        self.token_budget = token_budget
+
+        labeled = (
+            tweet_objects[ground_truth_column].notna()
+            & tweet_objects[tweet_content_column].notna()
+        )
+        if eligible is not None:
+            labeled &= eligible
+
+        examples = tweet_objects[labeled]
+
+        self.texts = examples[tweet_content_column].astype(str).str.strip().tolist()
+        self.labels = examples[ground_truth_column].astype(int).to_numpy()
+        self.normalized_texts = np.array(
+            [TweetDeduplicator.normalize(text) for text in self.texts], dtype=object
+        )
+
+        # Same four characters per token rule as Utility.estimate_tokens, plus
+        # the quotes and the list marker of the example line
+        self.token_counts = np.array([len(text) // 4 + 3 for text in self.texts])
+
+        # Fitted once on the bank, so selecting is a sparse dot product per tweet
+        self.vectorizer = TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True)
+        self.vectors = (
+            self.vectorizer.fit_transform(self.normalized_texts)
+            if len(self.texts)
+            else None
+        )
+
+        print(
+            "Example bank for",
+            ground_truth_column,
+            "=",
+            len(self.texts),
+            "labeled tweets",
+        )
+
+    @staticmethod
+    def for_classifier(classifier, tweet_objects, **options):
+        # Category examples only come from tweets that contain a claim, as the
+        # category prompt is only ever asked about those
+        eligible = None
+        if classifier.EXAMPLE_CONDITION_COLUMN is not None:
+            eligible = tweet_objects[classifier.EXAMPLE_CONDITION_COLUMN] == 1
+
+        return ExampleBank(
+            tweet_objects, classifier.ground_truth_column, eligible=eligible, **options
+        )
+
+    def describe(self):
+        return f"dynamic k={self.k} budget={self.token_budget} bank={len(self.texts)}"
+
+    def select(self, tweet):
+        if self.vectors is None:
+            return []
+
+        normalized_tweet = TweetDeduplicator.normalize(tweet)
+        similarities = (
+            (self.vectors @ self.vectorizer.transform([normalized_tweet]).T)
+            .toarray()
+            .ravel()
+        )
+
+        # The tweet itself and its copies would give the answer away
+        similarities[self.normalized_texts == normalized_tweet] = -np.inf
+
+        # The closest example of each label goes first, so both answers are shown
+        candidates = [
+            int(np.argmax(np.where(self.labels == label, similarities, -np.inf)))
+            for label in (1, 0)
+            if (self.labels == label).any()
+        ]
+
+        top = min(len(similarities), self.k + len(candidates))
+        nearest = np.argpartition(-similarities, top - 1)[:top]
+        candidates += [
+            int(position)
+            for position in nearest[np.argsort(-similarities[nearest], kind="stable")]
+        ]
+
+        selected = []
+        used_tokens = 0
+
+        for position in dict.fromkeys(candidates):
+            if len(selected) == self.k:
+                break
+
+            if similarities[position] == -np.inf:
+                continue
+
+            if used_tokens + self.token_counts[position] > self.token_budget:
+                continue
+
+            selected.append(position)
+            used_tokens += self.token_counts[position]
+
+        selected.sort(key=lambda position: -similarities[position])
+
+        return [
+            (self.texts[position], int(self.labels[position])) for position in selected
+        ]
+
+    @staticmethod
+    def format_examples(heading, texts):
+        if not texts:
+            return ""
+
+        lines = [
+            f'            {letter}) "{text}"'
+            for letter, text in zip(string.ascii_lowercase, texts)
+        ]
+
+        return "\n        " + heading + "\n" + "\n".join(lines) + "\n        "
+
+    def example_blocks(self, tweet, positive_heading, negative_heading):
+        examples = self.select(tweet)
+
+        return (
+            ExampleBank.format_examples(
+                positive_heading, [text for text, label in examples if label == 1]
+            ),
+            ExampleBank.format_examples(
+                negative_heading, [text for text, label in examples if label == 0]
+            ),
+        )
@@ -0,0 +1,244 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return 0
+
+        rank = q * self.count
+        seen = 0
+        for bucket, count in zip(self.buckets + [float("inf")], self.counts):
+            seen += count
+            if seen >= rank:
+                return bucket
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bucket, count in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += count
+            buckets["+Inf" if bucket == float("inf") else str(bucket)] = cumulative
+
+        return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+
+class CallStats:
+    LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+    TOKEN_BUCKETS = [16, 64, 256, 512, 1024, 2048, 4096, 8192]
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.tweets = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.errors = defaultdict(int)
+
+        self.latency_seconds = Histogram(CallStats.LATENCY_BUCKETS)
+        self.prompt_tokens_per_call = Histogram(CallStats.TOKEN_BUCKETS)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "tweets": self.tweets,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": self.cost,
+            "cost_per_tweet": self.cost / self.tweets if self.tweets else 0,
+            "retries": sum(
+                count
+                for error_class, count in self.errors.items()
+                if error_class != "fatal"
+            ),
+            "parse_failures": self.errors["unparsable"],
+            "errors": dict(self.errors),
+            "latency_seconds": self.latency_seconds.to_dict(),
+            "prompt_tokens_per_call": self.prompt_tokens_per_call.to_dict(),
+        }
+
+
+class Instrumentation:
+    # USD per 1K (prompt, completion) tokens
+    PRICES_PER_1K_TOKENS = {
+        "gpt-4-1106-preview": (0.01, 0.03),
+        "gpt-4": (0.03, 0.06),
+        "gpt-3.5-turbo": (0.0015, 0.002),
+    }
+
+    def __init__(self, summary_interval_seconds=60):
+        self.summary_interval_seconds = summary_interval_seconds
+        self.started_at = time.monotonic()
+        self.last_summary_at = self.started_at
+
+        self.stats = defaultdict(CallStats)
+        self.lock = threading.Lock()
+
+    def record_call(
+        self,
+        task,
+        model,
+        latency_seconds,
+        prompt_tokens=0,
+        completion_tokens=0,
+        cached=False,
+    ):
+        prompt_price, completion_price = Instrumentation.PRICES_PER_1K_TOKENS.get(
+            model, (0, 0)
+        )
+
+        with self.lock:
+            stats = self.stats[(task, model)]
+
+            if cached:
+                stats.cache_hits += 1
+            else:
+                stats.calls += 1
+                stats.prompt_tokens += prompt_tokens
+                stats.completion_tokens += completion_tokens
+                stats.cost += (
+                    prompt_tokens * prompt_price + completion_tokens * completion_price
+                ) / 1000
+                stats.latency_seconds.observe(latency_seconds)
+                stats.prompt_tokens_per_call.observe(prompt_tokens)
+
+        self.maybe_print_summary()
+
+    def record_error(self, task, model, error_class):
+        with self.lock:
+            self.stats[(task, model)].errors[error_class] += 1
+
+    def record_success(self, task, model, tweet_count):
+        with self.lock:
+            self.stats[(task, model)].tweets += tweet_count
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "elapsed_seconds": time.monotonic() - self.started_at,
+                "series": [
+                    {"task": task, "model": model, **stats.to_dict()}
+                    for (task, model), stats in sorted(
+                        self.stats.items(), key=lambda item: str(item[0])
+                    )
+                ],
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        # Samples of a metric family must follow its TYPE line together, so
+        # they are grouped by family rather than by task and model
+        families = {}
+
+        def add(name, metric_type, sample):
+            families.setdefault(name, (metric_type, []))[1].append(sample)
+
+        for series in self.snapshot()["series"]:
+            labels = f'task="{series["task"]}",model="{series["model"]}"'
+
+            for name in (
+                "calls",
+                "cache_hits",
+                "tweets",
+                "prompt_tokens",
+                "completion_tokens",
+                "cost",
+                "retries",
+                "parse_failures",
+            ):
+                add(
+                    f"llm_{name}_total",
+                    "counter",
+                    f"llm_{name}_total{{{labels}}} {series[name]}",
+                )
+
+            for error_class, count in series["errors"].items():
+                add(
+                    "llm_errors_total",
+                    "counter",
+                    f'llm_errors_total{{{labels},class="{error_class}"}} {count}',
+                )
+
+            for name in ("latency_seconds", "prompt_tokens_per_call"):
+                histogram = series[name]
+
+                for bucket, count in histogram["buckets"].items():
+                    add(
+                        f"llm_{name}",
+                        "histogram",
+                        f'llm_{name}_bucket{{{labels},le="{bucket}"}} {count}',
+                    )
+
+                add(
+                    f"llm_{name}",
+                    "histogram",
+                    f"llm_{name}_sum{{{labels}}} {histogram['sum']}",
+                )
+                add(
+                    f"llm_{name}",
+                    "histogram",
+                    f"llm_{name}_count{{{labels}}} {histogram['count']}",
+                )
+
+        lines = []
+        for name, (metric_type, samples) in families.items():
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines += samples
+
+        return "\n".join(lines) + "\n"
+
+    def summary_line(self):
+        with self.lock:
+            elapsed_seconds = time.monotonic() - self.started_at
+            parts = []
+
+            for (task, model), stats in self.stats.items():
+                parts.append(
+                    f"{task}/{model}: {stats.tweets} tweets "
+                    f"({stats.tweets / elapsed_seconds:.1f}/s), "
+                    f"{stats.calls} calls, {stats.cache_hits} cached, "
+                    f"p50 {stats.latency_seconds.quantile(0.5)}s "
+                    f"p99 {stats.latency_seconds.quantile(0.99)}s, "
+                    f"{stats.prompt_tokens + stats.completion_tokens} tokens, "
+                    f"${stats.cost:.4f}"
+                )
+
+        return "; ".join(parts)
+
+    def maybe_print_summary(self):
+        now = time.monotonic()
+
+        with self.lock:
+            if now - self.last_summary_at < self.summary_interval_seconds:
+                return
+
+            self.last_summary_at = now
+
+        print("Instrumentation =", self.summary_line())
+
+    def write_snapshot(self, file_name):
+        with open(file_name, "w", encoding="utf-8") as file:
+            if file_name.endswith(".prom"):
+                file.write(self.to_prometheus())
+            else:
+                file.write(self.to_json())
@@ -0,0 +1,350 @@
+import json
+import os
+import sqlite3
+from collections import defaultdict
+
+
+class PredictionJournal:
+    def __init__(self, file_name, fsync_every=50, in_memory=True):
+        self.file_name = file_name
+        self.fsync_every = fsync_every
+        self.unsynced_records = 0
+
+        # (model, task) -> {index: prediction}, the responses stay on disk only
+        self.predictions = defaultdict(dict)
+        self.scores = defaultdict(dict)
+
+        # Otherwise the records are indexed in a temporary SQLite database, so
+        # a streaming run keeps its memory flat however long the journal gets.
+        # An empty name gives a private database on disk, deleted on close
+        self.index = None
+        if not in_memory:
+            self.index = sqlite3.connect("")
+            self.index.execute(
+                """
+                CREATE TABLE records (
+                    model TEXT,
+                    task TEXT,
+                    row_index INTEGER,
+                    prediction INTEGER,
+                    score REAL,
+                    PRIMARY KEY (model, task, row_index)
+                )
+                """
+            )
+
+        self.recover()
+        self.file = open(file_name, "a", encoding="utf-8")
+
+    def recover(self):
+        recovered_records = 0
+        corrupt_lines = 0
+
+        if not os.path.exists(self.file_name):
+            return recovered_records
+
+        valid_length = 0
+
+        with open(self.file_name, "rb") as file:
+            for line in file:
+                # A crash can leave a partially written last line behind
+                if not line.endswith(b"\n"):
+                    break
+
+                valid_length += len(line)
+
+                # A damaged line further up only costs its own record, the
+                # ones after it are still good
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    corrupt_lines += 1
+                    continue
+
+                self.add_record(record)
+                recovered_records += 1
+
+        if corrupt_lines:
+            print("Skipped", corrupt_lines, "corrupt lines of journal", self.file_name)
+
+        if valid_length != os.path.getsize(self.file_name):
+            print(
+                "Truncating partially written journal",
+                self.file_name,
+                "to",
+                valid_length,
+                "bytes",
+            )
+            with open(self.file_name, "r+b") as file:
+                file.truncate(valid_length)
+
+        return recovered_records
+
+    @staticmethod
+    def end_offset(file_name):
+        # Where the records of the next run start. A partially written last line
+        # is dropped first, as recover would
+        if not os.path.exists(file_name):
+            return 0
+
+        with open(file_name, "r+b") as file:
+            size = file.seek(0, os.SEEK_END)
+            valid_length = 0
+            position = size
+
+            while position > 0:
+                start = max(0, position - 65536)
+                file.seek(start)
+                newline = file.read(position - start).rfind(b"\n")
+
+                if newline != -1:
+                    valid_length = start + newline + 1
+                    break
+
+                position = start
+
+            if valid_length != size:
+                print(
+                    "Truncating partially written journal",
+                    file_name,
+                    "to",
+                    valid_length,
+                    "bytes",
+                )
+                file.truncate(valid_length)
+
+        return valid_length
+
+    @staticmethod
+    def read_records(file_name, offset=0):
+        # Records from offset on, such as those of a single run
+        if not os.path.exists(file_name):
+            return
+
+        with open(file_name, "rb") as file:
+            file.seek(offset)
+
+            for line in file:
+                if not line.endswith(b"\n"):
+                    return
+
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+
+                yield record
+
+    def add_record(self, record):
+        if self.index is not None:
+            # A later record without a score keeps the earlier score, as below
+            self.index.execute(
+                """
+                INSERT INTO records VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (model, task, row_index) DO UPDATE SET
+                    prediction = excluded.prediction,
+                    score = COALESCE(excluded.score, score)
+                """,
+                (
+                    record["model"],
+                    record["task"],
+                    record["index"],
+                    record["prediction"],
+                    record.get("score"),
+                ),
+            )
+            return
+
+        key = (record["model"], record["task"])
+        self.predictions[key][record["index"]] = record["prediction"]
+
+        if record.get("score") is not None:
+            self.scores[key][record["index"]] = record["score"]
+
+    @staticmethod
+    def prediction_column_name(model_name, task):
+        return f"{model_name}-predicted-{task}"
+
+    @staticmethod
+    def score_column_name(model_name, task):
+        return f"{model_name}-predicted-{task}-score"
+
+    @staticmethod
+    def margin_column_name(model_name, task):
+        return f"{model_name}-predicted-{task}-margin"
+
+    @staticmethod
+    def calibrated_score_column_name(model_name, task):
+        return f"{model_name}-predicted-{task}-calibrated-score"
+
+    @staticmethod
+    def pre_classifier_score_column_name(model_name, task):
+        return f"{model_name}-pre-classifier-{task}-score"
+
+    def predictions_for(self, model_name, task):
+        if self.index is not None:
+            return dict(
+                self.index.execute(
+                    "SELECT row_index, prediction FROM records "
+                    "WHERE model = ? AND task = ?",
+                    (model_name, task),
+                )
+            )
+
+        return self.predictions.get((model_name, task), {})
+
+    def scores_for(self, model_name, task):
+        if self.index is not None:
+            return dict(
+                self.index.execute(
+                    "SELECT row_index, score FROM records "
+                    "WHERE model = ? AND task = ? AND score IS NOT NULL",
+                    (model_name, task),
+                )
+            )
+
+        return self.scores.get((model_name, task), {})
+
+    def keys(self):
+        if self.index is not None:
+            return self.index.execute(
+                "SELECT DISTINCT model, task FROM records ORDER BY model, task"
+            ).fetchall()
+
+        return sorted(self.predictions)
+
+    def records_for(self, model_name, task, tweet_objects):
+        # Predictions and scores of the rows of tweet_objects only
+        if self.index is None:
+            return (
+                PredictionJournal.restricted_to(
+                    self.predictions_for(model_name, task), tweet_objects
+                ),
+                PredictionJournal.restricted_to(
+                    self.scores_for(model_name, task), tweet_objects
+                ),
+            )
+
+        predictions = {}
+        scores = {}
+
+        if len(tweet_objects) == 0:
+            return predictions, scores
+
+        # A chunk is a contiguous run of row indices, so the range reads little
+        # more than the chunk itself
+        for index, prediction, score in self.index.execute(
+            "SELECT row_index, prediction, score FROM records "
+            "WHERE model = ? AND task = ? AND row_index BETWEEN ? AND ?",
+            (
+                model_name,
+                task,
+                int(tweet_objects.index.min()),
+                int(tweet_objects.index.max()),
+            ),
+        ):
+            if index in tweet_objects.index:
+                predictions[index] = prediction
+                if score is not None:
+                    scores[index] = score
+
+        return predictions, scores
+
+    @staticmethod
+    def restricted_to(values, tweet_objects):
+        # Walks whichever side is smaller, so restoring one chunk of a long
+        # journal does not scan every record
+        if len(values) <= len(tweet_objects):
+            return {
+                index: value
+                for index, value in values.items()
+                if index in tweet_objects.index
+            }
+
+        return {
+            index: values[index]
+            for index in tweet_objects.index.unique()
+            if index in values
+        }
+
+    def restore(self, tweet_objects, model_name, task):
+        column_name = PredictionJournal.prediction_column_name(model_name, task)
+
+        if column_name not in tweet_objects:
+            tweet_objects[column_name] = -1
+
+        predictions, scores = self.records_for(model_name, task, tweet_objects)
+
+        if predictions:
+            tweet_objects.loc[list(predictions), column_name] = list(
+                predictions.values()
+            )
+
+        if scores:
+            tweet_objects.loc[
+                list(scores), PredictionJournal.score_column_name(model_name, task)
+            ] = list(scores.values())
+
+        return len(predictions)
+
+    def append(
+        self,
+        index,
+        model_name,
+        task,
+        prediction,
+        response=None,
+        score=None,
+        prompt_version=None,
+    ):
+        record = {
+            "index": int(index),
+            "model": model_name,
+            "task": task,
+            "prediction": int(prediction),
+            "response": response,
+        }
+
+        if score is not None:
+            record["score"] = float(score)
+
+        if prompt_version is not None:
+            record["prompt_version"] = prompt_version
+
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.add_record(record)
+
+        self.unsynced_records += 1
+        if self.unsynced_records >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced_records = 0
+
+        if self.index is not None:
+            self.index.commit()
+
+    def compact(self, tweet_objects):
+        self.sync()
+
+        for model_name, task in self.keys():
+            self.restore(tweet_objects, model_name, task)
+
+        return tweet_objects
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
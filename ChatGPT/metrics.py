@@ -0,0 +1,98 @@
+from collections import Counter
+
+import numpy as np
+from sklearn.metrics import average_precision_score, roc_auc_score
+
+
+class MetricsAccumulator:
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, ground_truth, predicted):
+        self.counts[(ground_truth, predicted)] += 1
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        return self
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def labels(self):
+        return sorted({label for pair in self.counts for label in pair})
+
+    def confusion_matrix(self):
+        labels = self.labels()
+
+        return np.array(
+            [
+                [self.counts[(ground_truth, predicted)] for predicted in labels]
+                for ground_truth in labels
+            ]
+        )
+
+    def calculate_metrics(self):
+        # Weighted averages computed the same way as sklearn's classification_report
+        labels = self.labels()
+        total = len(self)
+
+        if total == 0:
+            raise ValueError("No predictions have been accumulated yet")
+
+        support = Counter()
+        predicted_count = Counter()
+        for (ground_truth, predicted), count in self.counts.items():
+            support[ground_truth] += count
+            predicted_count[predicted] += count
+
+        correct = sum(self.counts[(label, label)] for label in labels)
+
+        precision = recall = f1 = 0.0
+
+        for label in labels:
+            true_positives = self.counts[(label, label)]
+
+            label_precision = (
+                true_positives / predicted_count[label]
+                if predicted_count[label]
+                else 0.0
+            )
+            label_recall = true_positives / support[label] if support[label] else 0.0
+            label_f1 = (
+                2 * label_precision * label_recall / (label_precision + label_recall)
+                if label_precision + label_recall
+                else 0.0
+            )
+
+            weight = support[label] / total
+            precision += weight * label_precision
+            recall += weight * label_recall
+            f1 += weight * label_f1
+
+        return {
+            "Accuracy": correct / total,
+            "Precision": precision,
+            "Recall": recall,
+            "F1": f1,
+            "Confusion Matrix": self.confusion_matrix(),
+        }
+
+    @staticmethod
+    def calculate_score_metrics(tweet_objects, ground_truth_column, score_column):
+        if score_column not in tweet_objects:
+            return {}
+
+        scored = tweet_objects[
+            tweet_objects[score_column].notna()
+            & tweet_objects[ground_truth_column].notna()
+        ]
+        ground_truth = scored[ground_truth_column].astype(int)
+
+        # Both curves need positive and negative examples
+        if ground_truth.nunique() < 2:
+            return {}
+
+        return {
+            "ROC AUC": roc_auc_score(ground_truth, scored[score_column]),
+            "PR AUC": average_precision_score(ground_truth, scored[score_column]),
+        }
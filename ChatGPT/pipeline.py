@@ -0,0 +1,623 @@
+import os
+
+import pandas as pd
+
+from calibration import ScoreCalibrator
+from cascade import PreClassifier
+from engine import ClassificationEngine
+from fewshot import ExampleBank
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+from stream import IncrementalCsvWriter, TweetStream
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class FusedPipeline:
+    def __init__(self, claim_existence, categories):
+        self.claim_existence = claim_existence
+        self.categories = categories
+
+        self.model_name = claim_existence.model_name
+        self.tweet_objects = claim_existence.tweet_objects
+
+        self.stages = [claim_existence] + categories
+
+    def use_example_banks(self, tweet_objects, **options):
+        # Every stage draws its few-shot examples from the labeled tweets
+        for stage in self.stages:
+            stage.use_example_bank(
+                ExampleBank.for_classifier(stage, tweet_objects, **options)
+            )
+
+    def read_labeled_tweets(
+        self, input_file_name, tweet_content_column="polished_text", chunk_size=10000
+    ):
+        # Only the text and label columns of labeled tweets, read in chunks, so
+        # a streaming run does not load the whole input for its example banks
+        label_columns = list(
+            dict.fromkeys(
+                column
+                for stage in self.stages
+                for column in (
+                    stage.ground_truth_column,
+                    stage.EXAMPLE_CONDITION_COLUMN,
+                )
+                if column is not None
+            )
+        )
+        stream = TweetStream(
+            input_file_name,
+            [tweet_content_column],
+            chunk_size,
+            optional_columns=label_columns,
+        )
+
+        return pd.concat(
+            [
+                tweet_objects[tweet_objects[label_columns].notna().any(axis=1)]
+                for tweet_objects in stream
+            ]
+        )
+
+    def use_self_consistency(self, self_consistency, tasks=None):
+        for stage in self.stages:
+            if tasks is None or stage.task in tasks:
+                stage.use_self_consistency(self_consistency)
+
+    def voting_stages(self):
+        return [stage for stage in self.stages if stage.self_consistency is not None]
+
+    def add_vote_margins(self, tweet_objects):
+        # Winner minus runner-up votes over the samples drawn, 1 is unanimous
+        for stage in self.voting_stages():
+            score_column = PredictionJournal.score_column_name(
+                self.model_name, stage.task
+            )
+
+            if score_column in tweet_objects:
+                tweet_objects[
+                    PredictionJournal.margin_column_name(self.model_name, stage.task)
+                ] = (2 * tweet_objects[score_column] - 1).abs()
+
+    def pre_classified_stages(self, pre_classifier):
+        # The stage whose ground truth the pre-classifier was trained on
+        if pre_classifier is None:
+            return []
+
+        return [
+            stage
+            for stage in self.stages
+            if stage.ground_truth_column == pre_classifier.ground_truth_column
+        ]
+
+    def prediction_column_name(self, stage):
+        return PredictionJournal.prediction_column_name(self.model_name, stage.task)
+
+    def predict_row(self, pending_row):
+        (
+            tweet,
+            claim_existence_predicted_output,
+            pending_categories,
+            use_logprobs,
+        ) = pending_row
+
+        predictions = {}
+
+        if claim_existence_predicted_output == -1:
+            if use_logprobs and self.claim_existence.self_consistency is None:
+                predict_claim_existence = (
+                    self.claim_existence.predict_claim_existence_with_logprobs
+                )
+            else:
+                predict_claim_existence = self.claim_existence.predict_claim_existence
+
+            predictions[self.claim_existence.task] = predict_claim_existence(tweet)
+            claim_existence_predicted_output = predictions[self.claim_existence.task][0]
+
+        # Categories only call the model when the tweet contains a claim
+        for category in pending_categories:
+            if use_logprobs and category.self_consistency is None:
+                predict_category = category.predict_category_with_logprobs
+            else:
+                predict_category = category.predict_category
+
+            predictions[category.task] = predict_category(
+                (claim_existence_predicted_output, tweet)
+            )
+
+        return predictions
+
+    def predict_rows(self, pending_rows):
+        # Packs the claim question of the batch into one request, then each
+        # category question of the tweets that still need it into another
+        predictions = [{} for _ in pending_rows]
+        claim_existence_predicted_outputs = [
+            claim_existence_predicted_output
+            for _, claim_existence_predicted_output, _, _ in pending_rows
+        ]
+
+        claim_positions = [
+            position
+            for position, claim_existence_predicted_output in enumerate(
+                claim_existence_predicted_outputs
+            )
+            if claim_existence_predicted_output == -1
+        ]
+
+        if claim_positions:
+            claim_predictions = self.claim_existence.predict_claim_existence_batch(
+                [pending_rows[position][0] for position in claim_positions]
+            )
+
+            for position, prediction in zip(claim_positions, claim_predictions):
+                predictions[position][self.claim_existence.task] = prediction
+                claim_existence_predicted_outputs[position] = prediction[0]
+
+        for category in self.categories:
+            category_positions = [
+                position
+                for position, (_, _, pending_categories, _) in enumerate(pending_rows)
+                if category in pending_categories
+            ]
+
+            if not category_positions:
+                continue
+
+            category_predictions = category.predict_category_batch(
+                [
+                    (
+                        claim_existence_predicted_outputs[position],
+                        pending_rows[position][0],
+                    )
+                    for position in category_positions
+                ]
+            )
+
+            for position, prediction in zip(category_positions, category_predictions):
+                predictions[position][category.task] = prediction
+
+        return predictions
+
+    def check_batch_size(self, batch_size, use_logprobs):
+        # A packed prompt carries the built-in examples and asks for one answer
+        if batch_size == 1:
+            return
+
+        if use_logprobs:
+            raise ValueError("Logprob classification only supports batch_size = 1")
+
+        for stage in self.stages:
+            if stage.example_bank is not None or stage.self_consistency is not None:
+                raise ValueError(
+                    "Dynamic few-shot examples and self-consistency only support "
+                    "batch_size = 1"
+                )
+
+    def generate_metrics(
+        self,
+        output_file_name,
+        tweet_content_column="polished_text",
+        concurrency=1,
+        journal_file_name=None,
+        use_logprobs=False,
+        deduplicator=None,
+        pre_classifier=None,
+        batch_size=1,
+        should_stop=None,
+    ):
+        self.check_batch_size(batch_size, use_logprobs)
+
+        with PredictionJournal(
+            journal_file_name or f"{output_file_name}.journal"
+        ) as journal:
+            return self.generate_metrics_with_journal(
+                output_file_name,
+                tweet_content_column,
+                concurrency,
+                journal,
+                use_logprobs,
+                deduplicator,
+                pre_classifier,
+                batch_size,
+                should_stop,
+            )
+
+    def generate_metrics_with_journal(
+        self,
+        output_file_name,
+        tweet_content_column,
+        concurrency,
+        journal,
+        use_logprobs,
+        deduplicator,
+        pre_classifier=None,
+        batch_size=1,
+        should_stop=None,
+    ):
+        stage_metrics = {stage.task: MetricsAccumulator() for stage in self.stages}
+
+        print(
+            "<======= Generating metrics for",
+            ", ".join(stage.task for stage in self.stages),
+            "in a single pass =======>",
+        )
+        print()
+
+        self.classify_tweets(
+            tweet_content_column,
+            concurrency,
+            journal,
+            use_logprobs,
+            deduplicator,
+            stage_metrics,
+            pre_classifier,
+            batch_size,
+            should_stop,
+        )
+
+        print("<======= Finished generating metrics in a single pass =======>")
+
+        journal.compact(self.tweet_objects)
+        ScoreCalibrator().add_calibrated_scores(
+            self.tweet_objects, self.model_name, self.stages
+        )
+        self.tweet_objects.to_csv(output_file_name)
+
+        return self.calculate_stage_metrics(stage_metrics, self.tweet_objects)
+
+    def generate_metrics_streaming(
+        self,
+        input_file_name,
+        output_file_name,
+        tweet_content_column="polished_text",
+        concurrency=1,
+        journal_file_name=None,
+        use_logprobs=False,
+        deduplicator=None,
+        chunk_size=10000,
+        pre_classifier=None,
+        batch_size=1,
+    ):
+        # Reads, classifies and writes one chunk at a time, so memory stays flat
+        # however many tweets the input holds
+        self.check_batch_size(batch_size, use_logprobs)
+
+        if os.path.abspath(input_file_name) == os.path.abspath(output_file_name):
+            raise ValueError("Streaming output cannot overwrite its own input")
+
+        stage_metrics = {stage.task: MetricsAccumulator() for stage in self.stages}
+        scored_rows = []
+
+        stream = TweetStream(
+            input_file_name,
+            [tweet_content_column],
+            chunk_size,
+            optional_columns=[stage.ground_truth_column for stage in self.stages],
+            column_prefixes=[
+                PredictionJournal.prediction_column_name(self.model_name, "")
+            ],
+        )
+
+        output_columns = list(stream.columns)
+        for stage in self.stages:
+            stage_columns = [self.prediction_column_name(stage)]
+            if use_logprobs or stage in self.voting_stages():
+                stage_columns.append(
+                    PredictionJournal.score_column_name(self.model_name, stage.task)
+                )
+            if stage in self.voting_stages():
+                stage_columns.append(
+                    PredictionJournal.margin_column_name(self.model_name, stage.task)
+                )
+            if stage in self.pre_classified_stages(pre_classifier):
+                stage_columns.append(
+                    PredictionJournal.pre_classifier_score_column_name(
+                        self.model_name, stage.task
+                    )
+                )
+
+            output_columns += [
+                column for column in stage_columns if column not in output_columns
+            ]
+
+        writer = IncrementalCsvWriter(output_file_name, output_columns)
+
+        print(
+            "<======= Streaming",
+            ", ".join(stage.task for stage in self.stages),
+            "from",
+            input_file_name,
+            "in chunks of",
+            chunk_size,
+            "tweets =======>",
+        )
+        print()
+
+        with PredictionJournal(
+            journal_file_name or f"{output_file_name}.journal", in_memory=False
+        ) as journal:
+            for tweet_objects in stream:
+                self.tweet_objects = tweet_objects
+
+                self.classify_tweets(
+                    tweet_content_column,
+                    concurrency,
+                    journal,
+                    use_logprobs,
+                    deduplicator,
+                    stage_metrics,
+                    pre_classifier,
+                    batch_size,
+                )
+
+                for stage in self.stages:
+                    score_columns = [
+                        PredictionJournal.score_column_name(
+                            self.model_name, stage.task
+                        ),
+                        PredictionJournal.pre_classifier_score_column_name(
+                            self.model_name, stage.task
+                        ),
+                    ]
+                    # Only labeled rows count towards the score metrics, so
+                    # only those are kept across chunks
+                    for score_column in score_columns:
+                        if score_column in tweet_objects:
+                            scored_rows.append(
+                                tweet_objects.loc[
+                                    tweet_objects[score_column].notna()
+                                    & tweet_objects[stage.ground_truth_column].notna(),
+                                    [stage.ground_truth_column, score_column],
+                                ]
+                            )
+
+                journal.sync()
+                writer.write(tweet_objects)
+
+                print("Streamed", writer.rows_written, "tweets to", output_file_name)
+
+        print("<======= Finished streaming metrics =======>")
+
+        ScoreCalibrator().calibrate_file(
+            output_file_name, self.model_name, self.stages, chunk_size
+        )
+
+        scored_tweet_objects = (
+            pd.concat(scored_rows) if scored_rows else pd.DataFrame(index=[])
+        )
+
+        return self.calculate_stage_metrics(stage_metrics, scored_tweet_objects)
+
+    def calculate_stage_metrics(self, stage_metrics, tweet_objects):
+        return {
+            stage.task: {
+                **stage_metrics[stage.task].calculate_metrics(),
+                **MetricsAccumulator.calculate_score_metrics(
+                    tweet_objects,
+                    stage.ground_truth_column,
+                    PredictionJournal.score_column_name(self.model_name, stage.task),
+                ),
+                **PreClassifier.score_metrics(
+                    tweet_objects,
+                    stage.ground_truth_column,
+                    self.model_name,
+                    stage.task,
+                ),
+            }
+            for stage in self.stages
+            if len(stage_metrics[stage.task])
+        }
+
+    def classify_tweets(
+        self,
+        tweet_content_column,
+        concurrency,
+        journal,
+        use_logprobs,
+        deduplicator,
+        stage_metrics,
+        pre_classifier=None,
+        batch_size=1,
+        should_stop=None,
+    ):
+        # should_stop is polled before every request and every journal write, a
+        # True answer aborts the pass with PipelineStopped
+        def check_stop():
+            if should_stop is not None and should_stop():
+                raise PipelineStopped("Classification stopped by its caller")
+
+        def predict_row(pending_row):
+            check_stop()
+            return self.predict_row(pending_row)
+
+        def predict_rows(pending_rows):
+            check_stop()
+            return self.predict_rows(pending_rows)
+
+        for stage in self.stages:
+            print(
+                "Restored",
+                stage.task,
+                "predictions from journal =",
+                journal.restore(self.tweet_objects, self.model_name, stage.task),
+            )
+
+        claim_existence_prediction_column_name = self.prediction_column_name(
+            self.claim_existence
+        )
+
+        # Confident tweets are answered locally and never become pending rows.
+        # Tweets without a claim are answered for free, so only the rest may
+        # skip the model for a category
+        for stage in self.pre_classified_stages(pre_classifier):
+            pre_classifier.answer_confident_rows(
+                self.tweet_objects,
+                self.model_name,
+                stage.task,
+                journal,
+                self.prediction_column_name(stage),
+                prompt_version=stage.prompt_version,
+                eligible=None
+                if stage is self.claim_existence
+                else self.tweet_objects[claim_existence_prediction_column_name] != 0,
+            )
+
+        # Only one tweet per cluster of near duplicates goes to the model, the
+        # rest copy its answers as long as they agree on the claim gate
+        duplicates = {}
+        if deduplicator is not None:
+            deduplicator.assign(self.tweet_objects, tweet_content_column)
+
+            for index, row in self.tweet_objects.iterrows():
+                representative = deduplicator.duplicate_of(index)
+
+                if representative is not None and row[
+                    claim_existence_prediction_column_name
+                ] in (
+                    -1,
+                    self.tweet_objects.loc[
+                        representative, claim_existence_prediction_column_name
+                    ],
+                ):
+                    duplicates[index] = representative
+
+        pending_rows = []
+        for index, row in self.tweet_objects.iterrows():
+            if index in duplicates:
+                continue
+
+            pending_categories = [
+                category
+                for category in self.categories
+                if row[self.prediction_column_name(category)] == -1
+            ]
+            claim_existence_predicted_output = int(
+                row[claim_existence_prediction_column_name]
+            )
+
+            if claim_existence_predicted_output == -1 or pending_categories:
+                pending_rows.append(
+                    (
+                        row[tweet_content_column],
+                        claim_existence_predicted_output,
+                        pending_categories,
+                        use_logprobs,
+                    )
+                )
+
+        prompt_versions = {stage.task: stage.prompt_version for stage in self.stages}
+
+        engine = ClassificationEngine(concurrency)
+
+        if batch_size == 1:
+            pending_predictions = engine.map(predict_row, pending_rows)
+        else:
+            pending_predictions = engine.map_batches(
+                predict_rows, pending_rows, batch_size
+            )
+
+        for index, row in self.tweet_objects.iterrows():
+            is_pending = row[claim_existence_prediction_column_name] == -1 or any(
+                row[self.prediction_column_name(category)] == -1
+                for category in self.categories
+            )
+
+            if is_pending:
+                print("Processing tweet with index# =", index)
+                print("Tweet content = ", row[tweet_content_column])
+
+                if index in duplicates:
+                    predictions = {
+                        stage.task: deduplicator.answer_from_representative(
+                            self.tweet_objects,
+                            duplicates[index],
+                            self.prediction_column_name(stage),
+                            PredictionJournal.score_column_name(
+                                self.model_name, stage.task
+                            ),
+                        )
+                        for stage in self.stages
+                        if row[self.prediction_column_name(stage)] == -1
+                    }
+                else:
+                    try:
+                        predictions = next(pending_predictions)
+                    except Exception:
+                        print(
+                            "None for index# = ",
+                            index,
+                            "and tweet content =",
+                            row[tweet_content_column],
+                        )
+                        raise
+
+                check_stop()
+
+                for task, (predicted_output, response, score) in predictions.items():
+                    self.tweet_objects.loc[
+                        index,
+                        PredictionJournal.prediction_column_name(self.model_name, task),
+                    ] = predicted_output
+
+                    if score is not None:
+                        self.tweet_objects.loc[
+                            index,
+                            PredictionJournal.score_column_name(self.model_name, task),
+                        ] = score
+
+                    journal.append(
+                        index,
+                        self.model_name,
+                        task,
+                        predicted_output,
+                        response,
+                        score,
+                        prompt_versions[task],
+                    )
+
+                    print(task, "predicted output =", predicted_output)
+
+                print("Finished Processing tweet with index# =", index)
+                print()
+
+            for stage in self.stages:
+                try:
+                    ground_truth = int(row[stage.ground_truth_column])
+                except ValueError:
+                    continue
+
+                stage_metrics[stage.task].add(
+                    ground_truth,
+                    int(
+                        self.tweet_objects.loc[
+                            index, self.prediction_column_name(stage)
+                        ]
+                    ),
+                )
+
+            if is_pending and index > 0 and index % 5 == 0:
+                for stage in self.stages:
+                    if len(stage_metrics[stage.task]):
+                        print(
+                            stage.task,
+                            "metrics till now =",
+                            stage_metrics[stage.task].calculate_metrics(),
+                        )
+
+        self.add_vote_margins(self.tweet_objects)
+
+        if deduplicator is not None:
+            deduplicator.report_disagreements(
+                self.tweet_objects,
+                [
+                    column
+                    for stage in self.stages
+                    for column in (
+                        stage.ground_truth_column,
+                        self.prediction_column_name(stage),
+                    )
+                ],
+            )
@@ -0,0 +1,319 @@
+import argparse
+import os
+import time
+import uuid
+from collections import defaultdict
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+
+
+class ResultsStore:
+    SCHEMA = pa.schema(
+        [
+            ("tweet_id", pa.int64()),
+            ("row_index", pa.int64()),
+            ("model", pa.string()),
+            ("task", pa.string()),
+            ("prompt_version", pa.string()),
+            ("label", pa.int8()),
+            ("score", pa.float64()),
+            ("written_at", pa.float64()),
+        ]
+    )
+
+    KEY_COLUMNS = ["row_index", "model", "task", "prompt_version"]
+
+    def __init__(self, directory="results-store"):
+        self.directory = directory
+
+    @staticmethod
+    def parse_tweet_id(value):
+        # Ids rounded to floats such as 1.32611E+18 cannot be recovered exactly
+        if isinstance(value, str) and value.strip().isdigit():
+            return int(value)
+
+        return None
+
+    @staticmethod
+    def read_tweet_ids(file_name, id_column="id_str"):
+        # Reads only the id column, as strings, so no float round trip happens
+        header = pd.read_csv(file_name, nrows=0).columns
+
+        if id_column not in header:
+            return pd.Series(dtype="Int64")
+
+        ids = pd.read_csv(
+            file_name,
+            index_col=0,
+            usecols=[header[0], id_column],
+            dtype={id_column: str},
+        )[id_column]
+
+        return ResultsStore.exact_tweet_ids(ids)
+
+    @staticmethod
+    def exact_tweet_ids(ids):
+        tweet_ids = pd.Series(
+            pd.array([ResultsStore.parse_tweet_id(value) for value in ids], "Int64"),
+            index=ids.index,
+        )
+
+        inexact_ids = int(tweet_ids.isna().sum() - ids.isna().sum())
+        if inexact_ids:
+            print(
+                inexact_ids,
+                "tweet ids were already rounded in the source and are stored as null,",
+                "those rows stay keyed by their row index",
+            )
+
+        return tweet_ids
+
+    def write(
+        self, model_name, task, prompt_version, predictions, scores=None, tweet_ids=None
+    ):
+        # predictions and scores map the source row index to a label and a score
+        predictions = {
+            index: label for index, label in predictions.items() if label != -1
+        }
+        if not predictions:
+            return None
+
+        scores = scores or {}
+        row_indices = list(predictions)
+
+        if tweet_ids is None:
+            tweet_ids = pd.Series(dtype="Int64")
+
+        known_tweet_ids = tweet_ids[tweet_ids.index.isin(row_indices)]
+        known_tweet_ids = known_tweet_ids[~known_tweet_ids.index.duplicated()]
+
+        table = pa.table(
+            {
+                "tweet_id": pa.array(
+                    [
+                        None if pd.isna(tweet_id) else int(tweet_id)
+                        for tweet_id in known_tweet_ids.reindex(row_indices)
+                    ],
+                    pa.int64(),
+                ),
+                "row_index": pa.array(row_indices, pa.int64()),
+                "model": pa.array([model_name] * len(row_indices), pa.string()),
+                "task": pa.array([task] * len(row_indices), pa.string()),
+                "prompt_version": pa.array(
+                    [prompt_version] * len(row_indices), pa.string()
+                ),
+                "label": pa.array(list(predictions.values()), pa.int8()),
+                "score": pa.array(
+                    [scores.get(index) for index in row_indices], pa.float64()
+                ),
+                "written_at": pa.array([time.time()] * len(row_indices), pa.float64()),
+            },
+            schema=ResultsStore.SCHEMA,
+        )
+
+        # Every write is a new part file, the source data is never rewritten
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = os.path.join(
+            self.directory, f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        )
+        pq.write_table(table, file_name)
+
+        print(
+            "Wrote", len(row_indices), task, "results of", model_name, "to", file_name
+        )
+
+        return file_name
+
+    def write_records(self, records, tweet_ids=None, default_prompt_version="default"):
+        # Journal records, one part file per model, task and prompt version. A
+        # later record of a row replaces an earlier one, as in the journal
+        predictions = defaultdict(dict)
+        scores = defaultdict(dict)
+
+        for record in records:
+            key = (
+                record["model"],
+                record["task"],
+                record.get("prompt_version") or default_prompt_version,
+            )
+            predictions[key][record["index"]] = record["prediction"]
+
+            if record.get("score") is not None:
+                scores[key][record["index"]] = record["score"]
+
+        return [
+            self.write(
+                model_name,
+                task,
+                prompt_version,
+                predictions[model_name, task, prompt_version],
+                scores[model_name, task, prompt_version],
+                tweet_ids,
+            )
+            for model_name, task, prompt_version in sorted(predictions)
+        ]
+
+    def read(self, models=None, tasks=None, prompt_versions=None):
+        if not os.path.isdir(self.directory):
+            return pd.DataFrame(columns=ResultsStore.SCHEMA.names)
+
+        filters = [
+            (column, "in", values)
+            for column, values in (
+                ("model", models),
+                ("task", tasks),
+                ("prompt_version", prompt_versions),
+            )
+            if values is not None
+        ]
+
+        # Part files are memory mapped rather than copied into buffers
+        results = pq.read_table(
+            self.directory,
+            schema=ResultsStore.SCHEMA,
+            filters=filters or None,
+            memory_map=True,
+        ).to_pandas(
+            # Nullable Int64 keeps tweet ids exact where float64 would round them
+            types_mapper={pa.int64(): pd.Int64Dtype()}.get
+        )
+        results["row_index"] = results["row_index"].astype("int64")
+
+        # A later write of the same row, model, task and prompt version wins
+        return (
+            results.sort_values("written_at", kind="stable")
+            .drop_duplicates(ResultsStore.KEY_COLUMNS, keep="last")
+            .sort_values(ResultsStore.KEY_COLUMNS)
+            .reset_index(drop=True)
+        )
+
+    def pivot(self, models=None, tasks=None, prompt_versions=None, index="row_index"):
+        # The wide view uses the CSV column names, so existing metrics code applies.
+        # Pivot on tweet_id to line up runs over differently ordered inputs
+        results = self.read(models, tasks, prompt_versions)
+
+        if index == "tweet_id":
+            results = results[results["tweet_id"].notna()]
+
+        several_prompt_versions = (
+            results.groupby(["model", "task"])["prompt_version"].nunique() > 1
+        ).any()
+
+        model_labels = results["model"]
+        if several_prompt_versions:
+            model_labels = model_labels + "@" + results["prompt_version"]
+
+        results = results.assign(
+            prediction_column=[
+                PredictionJournal.prediction_column_name(model_label, task)
+                for model_label, task in zip(model_labels, results["task"])
+            ]
+        )
+
+        labels = results.pivot_table(
+            index=index, columns="prediction_column", values="label", aggfunc="last"
+        )
+        scores = results.pivot_table(
+            index=index, columns="prediction_column", values="score", aggfunc="last"
+        )
+        scores.columns = [f"{column}-score" for column in scores.columns]
+
+        wide = labels.join(scores, how="left")
+
+        if index == "row_index":
+            tweet_ids = results.drop_duplicates("row_index").set_index("row_index")[
+                "tweet_id"
+            ]
+            wide.insert(0, "tweet_id", tweet_ids.astype("Int64"))
+
+        wide.columns.name = None
+        wide.index.name = None
+
+        return wide
+
+    def calculate_metrics(self, tweet_objects, ground_truth_columns, **filters):
+        # ground_truth_columns maps a task to its label column in tweet_objects
+        wide = self.pivot(**filters)
+        metrics = {}
+
+        for column in wide.columns:
+            if column == "tweet_id" or column.endswith("-score"):
+                continue
+
+            task = column.rsplit("-predicted-", 1)[1]
+            if task not in ground_truth_columns:
+                continue
+
+            ground_truth_column = ground_truth_columns[task]
+            score_column = f"{column}-score"
+
+            joined = wide[
+                [column] + ([score_column] if score_column in wide else [])
+            ].join(tweet_objects[[ground_truth_column]], how="inner")
+            joined = joined[joined[ground_truth_column].notna()]
+
+            accumulator = MetricsAccumulator()
+            for ground_truth, label in zip(
+                joined[ground_truth_column].astype(int), joined[column].astype(int)
+            ):
+                accumulator.add(ground_truth, label)
+
+            if len(accumulator):
+                metrics[column] = {
+                    **accumulator.calculate_metrics(),
+                    **MetricsAccumulator.calculate_score_metrics(
+                        joined, ground_truth_column, score_column
+                    ),
+                }
+
+        return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Long format Parquet store of model predictions"
+    )
+    parser.add_argument("mode", choices=["ingest", "pivot", "metrics"])
+    parser.add_argument("--store", default="results-store")
+    parser.add_argument("--input", default="gpt-tweets.csv")
+    parser.add_argument("--journal", default=None)
+    parser.add_argument("--output", default="results-wide.csv")
+    parser.add_argument("--model", default="gpt-4-1106-preview")
+    parser.add_argument("--tasks", nargs="*", default=["claim", "cat1"])
+    parser.add_argument("--prompt-version", default="default")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+
+    if args.mode == "ingest":
+        tweet_ids = ResultsStore.read_tweet_ids(args.input)
+
+        # Records journaled without a prompt version get --prompt-version
+        store.write_records(
+            (
+                record
+                for record in PredictionJournal.read_records(
+                    args.journal or f"{args.input}.journal"
+                )
+                if record["model"] == args.model and record["task"] in args.tasks
+            ),
+            tweet_ids,
+            args.prompt_version,
+        )
+    elif args.mode == "pivot":
+        store.pivot().to_csv(args.output)
+    else:
+        tweet_objects = pd.read_csv(args.input, index_col=0)
+        print(
+            "Metrics =",
+            store.calculate_metrics(tweet_objects, {"claim": "Claim", "cat1": "cat1"}),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import random
+import threading
+import time
+from collections import Counter
+
+import aiohttp
+import openai
+import requests
+
+from cache import ReplayCacheMiss
+
+
+class UnparsableResponse(Exception):
+    pass
+
+
+class RetriesExhausted(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.trips = 0
+
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                remaining_seconds = self.open_until - time.monotonic()
+
+            if remaining_seconds <= 0:
+                return
+
+            time.sleep(remaining_seconds)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.open_until = max(self.open_until, time.monotonic() + seconds)
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+
+            if self.consecutive_failures < self.failure_threshold:
+                return
+
+            self.consecutive_failures = 0
+            self.trips += 1
+            self.open_until = max(
+                self.open_until, time.monotonic() + self.cooldown_seconds
+            )
+
+        print(
+            "Circuit breaker open, pausing all requests for",
+            self.cooldown_seconds,
+            "seconds",
+        )
+
+
+class RetryPolicy:
+    RETRYABLE = {"rate_limit", "timeout", "server", "connection", "unparsable", "other"}
+
+    # Failures that say the service is struggling, as opposed to a bad answer
+    SERVICE_FAILURES = {"rate_limit", "timeout", "server", "connection"}
+
+    def __init__(
+        self,
+        max_attempts=10,
+        base_delay_seconds=1,
+        max_delay_seconds=60,
+        circuit_breaker=None,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+
+        self.error_counts = Counter()
+        self.lock = threading.Lock()
+
+        # Objects with record_error(task, model, error_class) and
+        # record_success(task, model, tweet_count), such as Instrumentation
+        self.listeners = []
+
+    @staticmethod
+    def classify(exception):
+        if isinstance(exception, UnparsableResponse):
+            return "unparsable"
+
+        if isinstance(exception, ReplayCacheMiss):
+            return "fatal"
+
+        if isinstance(exception, openai.error.RateLimitError):
+            return "rate_limit"
+
+        if isinstance(exception, openai.error.Timeout):
+            return "timeout"
+
+        if isinstance(exception, openai.error.APIConnectionError):
+            return "connection"
+
+        # Failures of the pooled HTTP backends
+        if isinstance(exception, (requests.Timeout, TimeoutError)):
+            return "timeout"
+
+        if isinstance(
+            exception, (requests.ConnectionError, aiohttp.ClientConnectionError)
+        ):
+            return "connection"
+
+        if isinstance(
+            exception,
+            (
+                openai.error.AuthenticationError,
+                openai.error.PermissionError,
+                openai.error.InvalidRequestError,
+            ),
+        ):
+            return "fatal"
+
+        http_status = getattr(exception, "http_status", None)
+
+        if http_status == 429:
+            return "rate_limit"
+
+        if http_status is not None and http_status >= 500:
+            return "server"
+
+        if http_status is not None and http_status >= 400:
+            return "fatal"
+
+        if isinstance(exception, (openai.error.APIError, openai.error.TryAgain)):
+            return "server"
+
+        return "other"
+
+    @staticmethod
+    def retry_after_seconds(exception):
+        headers = getattr(exception, "headers", None) or {}
+
+        for name in ("retry-after", "Retry-After"):
+            if name in headers:
+                try:
+                    return float(headers[name])
+                except ValueError:
+                    return None
+
+        return None
+
+    def delay_seconds(self, attempt, error_class, exception):
+        # A bad answer is simply resampled, there is nothing to wait for
+        if error_class == "unparsable":
+            return 0
+
+        retry_after = RetryPolicy.retry_after_seconds(exception)
+        if retry_after is not None:
+            return retry_after
+
+        # Full jitter keeps the workers of the pool from retrying in lockstep
+        return random.uniform(
+            0,
+            min(self.max_delay_seconds, self.base_delay_seconds * 2**attempt),
+        )
+
+    def call(self, function, task=None, model=None, tweet_count=1):
+        last_exception = None
+
+        for attempt in range(self.max_attempts):
+            self.circuit_breaker.wait()
+
+            try:
+                result = function()
+            except Exception as exception:
+                error_class = RetryPolicy.classify(exception)
+
+                with self.lock:
+                    self.error_counts[error_class] += 1
+
+                for listener in self.listeners:
+                    listener.record_error(task, model, error_class)
+
+                print(
+                    "Attempt",
+                    attempt + 1,
+                    "failed with",
+                    error_class,
+                    "error:",
+                    exception,
+                )
+
+                if error_class not in RetryPolicy.RETRYABLE:
+                    raise
+
+                last_exception = exception
+
+                if error_class in RetryPolicy.SERVICE_FAILURES:
+                    self.circuit_breaker.record_failure()
+
+                delay_seconds = self.delay_seconds(attempt, error_class, exception)
+
+                if error_class == "rate_limit":
+                    self.circuit_breaker.pause(delay_seconds)
+                else:
+                    time.sleep(delay_seconds)
+
+                continue
+
+            self.circuit_breaker.record_success()
+
+            for listener in self.listeners:
+                listener.record_success(task, model, tweet_count)
+
+            return result
+
+        raise RetriesExhausted(
+            f"Giving up after {self.max_attempts} attempts"
+        ) from last_exception
+
+    def stats(self):
+        with self.lock:
+            error_counts = dict(self.error_counts)
+
+        return {
+            "Errors": error_counts,
+            "Circuit Breaker Trips": self.circuit_breaker.trips,
+        }
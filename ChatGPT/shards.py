@@ -0,0 +1,506 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from calibration import ScoreCalibrator
+from chatgpt import Category1, ClaimExistence, Utility
+from engine import RateLimiter
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+from pipeline import FusedPipeline, PipelineStopped
+from stream import IncrementalCsvWriter, TweetStream
+
+
+class ShardLease:
+    # A lease is a small JSON file on the shared filesystem. Creating it with
+    # O_EXCL is atomic, so only one worker creates a shard's lease. An expired
+    # lease is only removed while it is still the expired one. A worker whose
+    # lease is removed anyway, by a reclaim racing that check, notices on its
+    # next renewal and stops before its next tweet
+    def __init__(self, file_name, worker_id, lease_seconds=300):
+        self.file_name = file_name
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+
+        self.lost = False
+        self.stopped = threading.Event()
+        self.renewer = None
+
+    @staticmethod
+    def read(file_name):
+        try:
+            with open(file_name, encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def is_expired(lease):
+        return lease["expires_at"] < time.time()
+
+    def record(self):
+        return {
+            "worker": self.worker_id,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "expires_at": time.time() + self.lease_seconds,
+        }
+
+    def acquire(self):
+        lease = ShardLease.read(self.file_name)
+
+        if lease is not None:
+            if not ShardLease.is_expired(lease):
+                return False
+
+            # Another worker that reclaimed it in between has written a lease of
+            # its own, which is left alone
+            if ShardLease.read(self.file_name) != lease:
+                return False
+
+            try:
+                os.remove(self.file_name)
+            except FileNotFoundError:
+                return False
+
+            print(
+                "Lease of worker",
+                lease["worker"],
+                "on",
+                self.file_name,
+                "expired, reclaiming its rows",
+            )
+
+        try:
+            descriptor = os.open(
+                self.file_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644
+            )
+        except FileExistsError:
+            return False
+
+        with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+            json.dump(self.record(), file)
+
+        self.renewer = threading.Thread(target=self.keep_renewing, daemon=True)
+        self.renewer.start()
+
+        return True
+
+    def is_held(self):
+        lease = ShardLease.read(self.file_name)
+        return not self.lost and lease is not None and lease["worker"] == self.worker_id
+
+    def renew(self):
+        if not self.is_held():
+            self.lost = True
+            return False
+
+        # Written aside and renamed over, so readers never see half a lease
+        temporary_file_name = f"{self.file_name}.{self.worker_id}.tmp"
+        with open(temporary_file_name, "w", encoding="utf-8") as file:
+            json.dump(self.record(), file)
+        os.replace(temporary_file_name, self.file_name)
+
+        return True
+
+    def keep_renewing(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            if not self.renew():
+                print("Lost lease", self.file_name, "to another worker")
+                return
+
+    def release(self):
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+
+        if self.is_held():
+            os.remove(self.file_name)
+
+
+class ShardedRun:
+    def __init__(
+        self,
+        input_file_name,
+        work_directory,
+        model_name,
+        backend="openai",
+        tweet_content_column="polished_text",
+        shard_size=1000,
+        lease_seconds=300,
+        worker_id=None,
+    ):
+        self.input_file_name = input_file_name
+        self.work_directory = work_directory
+        self.tweet_content_column = tweet_content_column
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or ShardedRun.default_worker_id()
+
+        self.pipeline = FusedPipeline(
+            ClaimExistence(model_name, None, backend),
+            [Category1(model_name, None, backend)],
+        )
+        self.model_name = model_name
+
+        self.stream = TweetStream(
+            input_file_name,
+            [tweet_content_column],
+            optional_columns=[
+                stage.ground_truth_column for stage in self.pipeline.stages
+            ],
+            column_prefixes=[PredictionJournal.prediction_column_name(model_name, "")],
+        )
+
+        os.makedirs(self.path("leases"), exist_ok=True)
+        os.makedirs(self.path("outputs"), exist_ok=True)
+        os.makedirs(self.path("journals"), exist_ok=True)
+
+        self.manifest = self.load_manifest(shard_size)
+
+    @staticmethod
+    def default_worker_id():
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+        if "SLURM_ARRAY_TASK_ID" in os.environ:
+            worker_id = f"task{os.environ['SLURM_ARRAY_TASK_ID']}-{worker_id}"
+
+        return worker_id
+
+    def path(self, *names):
+        return os.path.join(self.work_directory, *names)
+
+    def load_manifest(self, shard_size):
+        # The first worker lays out the shards, every other one reuses that
+        # layout so all of them agree on which rows a shard holds
+        manifest_file_name = self.path("manifest.json")
+
+        if not os.path.exists(manifest_file_name):
+            offsets, rows = self.stream.record_offsets(shard_size)
+            manifest = {
+                "input": os.path.abspath(self.input_file_name),
+                "rows": rows,
+                "shard_size": shard_size,
+                "offsets": offsets,
+            }
+
+            temporary_file_name = f"{manifest_file_name}.{self.worker_id}.tmp"
+            with open(temporary_file_name, "w", encoding="utf-8") as file:
+                json.dump(manifest, file)
+
+            try:
+                # Fails if another worker got there first, its layout is the same
+                os.link(temporary_file_name, manifest_file_name)
+            except FileExistsError:
+                pass
+            os.remove(temporary_file_name)
+
+        with open(manifest_file_name, encoding="utf-8") as file:
+            manifest = json.load(file)
+
+        if manifest["shard_size"] != shard_size:
+            raise ValueError(
+                f"{self.work_directory} was laid out with shards of "
+                f"{manifest['shard_size']} rows, not {shard_size}"
+            )
+
+        return manifest
+
+    @property
+    def shard_count(self):
+        return len(self.manifest["offsets"])
+
+    def shard_name(self, shard):
+        return f"shard-{shard:05d}"
+
+    def output_file_name(self, shard):
+        return self.path("outputs", f"{self.shard_name(shard)}.csv")
+
+    def is_done(self, shard):
+        return os.path.exists(self.output_file_name(shard))
+
+    def claim(self, first_shard=0):
+        # Workers start their scan at different shards, so they rarely contend
+        for step in range(self.shard_count):
+            shard = (first_shard + step) % self.shard_count
+            if self.is_done(shard):
+                continue
+
+            lease = ShardLease(
+                self.path("leases", f"{self.shard_name(shard)}.lease"),
+                self.worker_id,
+                self.lease_seconds,
+            )
+            if lease.acquire():
+                return shard, lease
+
+        return None, None
+
+    def next_lease_expiry(self):
+        leases = [
+            ShardLease.read(self.path("leases", f"{self.shard_name(shard)}.lease"))
+            for shard in range(self.shard_count)
+            if not self.is_done(shard)
+        ]
+
+        expiries = [lease["expires_at"] for lease in leases if lease is not None]
+        return min(expiries) if expiries else None
+
+    def journal_file_name(self, shard):
+        # Every worker journals a shard in a file of its own. A worker that has
+        # not noticed its lost lease yet never appends to the new owner's file,
+        # where writes of both could interleave on NFS
+        return self.path(
+            "journals", f"{self.shard_name(shard)}.{self.worker_id}.journal"
+        )
+
+    def merge_journals(self, shard, journal_file_name):
+        # Starts the new owner from the predictions of every earlier one. Lines
+        # a still running worker has only half written are left out
+        merged = 0
+
+        with PredictionJournal(journal_file_name) as journal:
+            for file_name in sorted(os.listdir(self.path("journals"))):
+                other_file_name = self.path("journals", file_name)
+
+                if (
+                    not file_name.startswith(f"{self.shard_name(shard)}.")
+                    or not file_name.endswith(".journal")
+                    or other_file_name == journal_file_name
+                ):
+                    continue
+
+                for record in PredictionJournal.read_records(other_file_name):
+                    if record["index"] in journal.predictions_for(
+                        record["model"], record["task"]
+                    ):
+                        continue
+
+                    journal.append(
+                        record["index"],
+                        record["model"],
+                        record["task"],
+                        record["prediction"],
+                        record.get("response"),
+                        record.get("score"),
+                        record.get("prompt_version"),
+                    )
+                    merged += 1
+
+        if merged:
+            print("Merged", merged, "journaled predictions of earlier workers")
+
+    def run_shard(self, shard, lease, concurrency, use_logprobs):
+        offset = self.manifest["offsets"][shard]
+        count = min(
+            self.manifest["shard_size"],
+            self.manifest["rows"] - shard * self.manifest["shard_size"],
+        )
+
+        print("Worker", self.worker_id, "classifying", self.shard_name(shard))
+
+        self.pipeline.tweet_objects = self.stream.read_rows(offset, count)
+
+        # The journals live on the shared filesystem, so whoever reclaims the
+        # shard of a crashed worker resumes from its last answered tweet
+        partial_file_name = f"{self.output_file_name(shard)}.{self.worker_id}.partial"
+        journal_file_name = self.journal_file_name(shard)
+        self.merge_journals(shard, journal_file_name)
+
+        # A worker that stalled past its lease leaves the shard to the new owner,
+        # and stops at its next tweet rather than writing to the journal too
+        try:
+            self.pipeline.generate_metrics(
+                partial_file_name,
+                self.tweet_content_column,
+                concurrency,
+                journal_file_name=journal_file_name,
+                use_logprobs=use_logprobs,
+                should_stop=lambda: lease.lost,
+            )
+        except PipelineStopped:
+            pass
+
+        if not lease.is_held():
+            if os.path.exists(partial_file_name):
+                os.remove(partial_file_name)
+            print("Discarding", self.shard_name(shard), "after losing its lease")
+            return False
+
+        os.replace(partial_file_name, self.output_file_name(shard))
+        return True
+
+    def work(self, concurrency=16, use_logprobs=False, poll_seconds=30):
+        # Array tasks start spread evenly over the shards
+        first_shard = (
+            int(os.environ.get("SLURM_ARRAY_TASK_ID", 0))
+            * self.shard_count
+            // int(os.environ.get("SLURM_ARRAY_TASK_COUNT", 1))
+        )
+        completed_shards = 0
+
+        while True:
+            shard, lease = self.claim(first_shard % max(self.shard_count, 1))
+
+            if shard is None:
+                # Shards leased by live workers may still come back if one of
+                # them crashes, so wait for the next lease to expire
+                next_expiry = self.next_lease_expiry()
+                if next_expiry is None:
+                    break
+
+                time.sleep(min(max(next_expiry - time.time(), 1), poll_seconds))
+                continue
+
+            try:
+                if self.run_shard(shard, lease, concurrency, use_logprobs):
+                    completed_shards += 1
+            finally:
+                lease.release()
+
+            first_shard = shard + 1
+
+        print("Worker", self.worker_id, "completed", completed_shards, "shards")
+        return completed_shards
+
+    def merge(self, output_file_name):
+        missing_shards = [
+            self.shard_name(shard)
+            for shard in range(self.shard_count)
+            if not self.is_done(shard)
+        ]
+        if missing_shards:
+            raise ValueError(f"Shards {missing_shards} are not finished yet")
+
+        stages = self.pipeline.stages
+        stage_metrics = {stage.task: MetricsAccumulator() for stage in stages}
+        scored_rows = []
+        writer = None
+
+        # One shard in memory at a time, metrics are summed from exact counts
+        for shard in range(self.shard_count):
+            tweet_objects = pd.read_csv(
+                self.output_file_name(shard), index_col=0, dtype={"id_str": str}
+            )
+
+            if writer is None:
+                writer = IncrementalCsvWriter(
+                    output_file_name, list(tweet_objects.columns)
+                )
+            writer.write(tweet_objects)
+
+            for stage in stages:
+                prediction_column = self.pipeline.prediction_column_name(stage)
+                labeled = tweet_objects[
+                    tweet_objects[stage.ground_truth_column].notna()
+                    & (tweet_objects[prediction_column] != -1)
+                ]
+
+                shard_metrics = MetricsAccumulator()
+                for ground_truth, predicted_output in zip(
+                    labeled[stage.ground_truth_column].astype(int),
+                    labeled[prediction_column].astype(int),
+                ):
+                    shard_metrics.add(ground_truth, predicted_output)
+                stage_metrics[stage.task].merge(shard_metrics)
+
+                score_column = PredictionJournal.score_column_name(
+                    self.model_name, stage.task
+                )
+                if score_column in labeled:
+                    scored_rows.append(
+                        labeled[[stage.ground_truth_column, score_column]]
+                    )
+
+        print("Merged", writer.rows_written, "tweets into", output_file_name)
+
+        ScoreCalibrator().calibrate_file(output_file_name, self.model_name, stages)
+
+        scored_tweet_objects = (
+            pd.concat(scored_rows) if scored_rows else pd.DataFrame(index=[])
+        )
+
+        return self.pipeline.calculate_stage_metrics(
+            stage_metrics, scored_tweet_objects
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Classify tweets with several workers sharing row ranges "
+        "through lease files, then merge their outputs"
+    )
+    parser.add_argument("mode", choices=["work", "launch", "merge"])
+    parser.add_argument("--input", default="gpt-tweets.csv")
+    parser.add_argument("--work-directory", default="shards")
+    parser.add_argument("--output", default="gpt-tweets-predictions.csv")
+    parser.add_argument("--model", default="gpt-4-1106-preview")
+    parser.add_argument("--backend", default="openai")
+    parser.add_argument("--tweet-content-column", default="polished_text")
+    parser.add_argument("--shard-size", type=int, default=1000)
+    parser.add_argument("--lease-seconds", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--use-logprobs", action="store_true")
+    # Per worker, so divide the account's quota by the number of workers
+    parser.add_argument("--requests-per-minute", type=int, default=None)
+    parser.add_argument("--tokens-per-minute", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.mode == "launch":
+        # N local processes, the single machine stand-in for a Slurm job array
+        worker_arguments = [
+            argument for argument in sys.argv[1:] if argument != "launch"
+        ]
+        workers = [
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "work"] + worker_arguments,
+                env={
+                    **os.environ,
+                    "SLURM_ARRAY_TASK_ID": str(worker),
+                    "SLURM_ARRAY_TASK_COUNT": str(args.workers),
+                },
+            )
+            for worker in range(args.workers)
+        ]
+
+        failed_workers = sum(worker.wait() != 0 for worker in workers)
+        if failed_workers:
+            print(failed_workers, "workers failed, rerun to reclaim their shards")
+            sys.exit(1)
+
+        args.mode = "merge"
+
+    sharded_run = ShardedRun(
+        args.input,
+        args.work_directory,
+        args.model,
+        args.backend,
+        args.tweet_content_column,
+        args.shard_size,
+        args.lease_seconds,
+    )
+
+    if args.mode == "work":
+        if args.backend == "openai":
+            Utility.import_api_key()
+
+        if args.requests_per_minute or args.tokens_per_minute:
+            Utility.rate_limiter = RateLimiter(
+                requests_per_minute=args.requests_per_minute,
+                tokens_per_minute=args.tokens_per_minute,
+            )
+
+        sharded_run.work(args.concurrency, args.use_logprobs)
+    else:
+        print("Metrics =", sharded_run.merge(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+#!/bin/bash
+#SBATCH --job-name="GPT-Claim-Shards"	  # a name for your job
+#SBATCH --partition=peregrine-cpu		  # partition to which job should be submitted
+#SBATCH --array=0-7						  # one task per worker, all sharing the work directory
+#SBATCH --nodes=1                		  # node count per task
+#SBATCH --ntasks=1               		  # total number of tasks per array task
+#SBATCH --cpus-per-task=4        		  # cpu-cores per task (>1 if multi-threaded tasks)
+#SBATCH --mem=4G         				  # total memory per node
+#SBATCH --time=04:15:00          		  # total run time limit (HH:MM:SS)
+
+module purge
+module load python/anaconda
+
+# Every task claims shards until none is left, the work directory must be on a
+# filesystem all nodes share. Resubmitting the array picks up unfinished shards
+python shards.py work \
+	--input gpt-tweets.csv \
+	--work-directory shards \
+	--shard-size 1000 \
+	--concurrency 16 \
+	--requests-per-minute 60
+
+# After the array finishes: sbatch --dependency=afterok:<array job id> --wrap "python shards.py merge"
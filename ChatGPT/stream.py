@@ -0,0 +1,114 @@
+import pandas as pd
+
+
+class TweetStream:
+    def __init__(
+        self,
+        file_name,
+        columns,
+        chunk_size=10000,
+        optional_columns=(),
+        column_prefixes=(),
+    ):
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+
+        header = pd.read_csv(file_name, nrows=0).columns
+
+        # The first column is the unnamed tweet index
+        self.index_column = header[0]
+        self.columns = [
+            column
+            for column in header[1:]
+            if column in columns
+            or column in optional_columns
+            or column.startswith(tuple(column_prefixes))
+        ]
+
+        # Unlabeled inputs still get the ground truth columns, left empty
+        self.missing_optional_columns = [
+            column for column in optional_columns if column not in self.columns
+        ]
+
+        missing_columns = set(columns) - set(self.columns)
+        if missing_columns:
+            raise ValueError(
+                f"Columns {sorted(missing_columns)} not found in {file_name}"
+            )
+
+    def __iter__(self):
+        # Only the needed columns are parsed, the wide user columns never load
+        with pd.read_csv(
+            self.file_name,
+            index_col=0,
+            usecols=[self.index_column] + self.columns,
+            chunksize=self.chunk_size,
+        ) as reader:
+            for chunk in reader:
+                for column in self.missing_optional_columns:
+                    chunk[column] = float("nan")
+
+                yield chunk
+
+    def record_offsets(self, rows_per_range):
+        # Byte offset of every rows_per_range-th record, found in one pass so a
+        # range can later be read by seeking to it. A newline only ends a record
+        # when the quotes before it are balanced, tweets may span several lines
+        offsets = []
+        rows = 0
+
+        with open(self.file_name, "rb") as file:
+            position = len(file.readline())
+            record_start = position
+            quotes = 0
+
+            for line in file:
+                if quotes == 0 and rows % rows_per_range == 0:
+                    offsets.append(record_start)
+
+                position += len(line)
+                quotes += line.count(b'"')
+
+                if quotes % 2 == 0:
+                    quotes = 0
+                    rows += 1
+                    record_start = position
+
+        return offsets, rows
+
+    def read_rows(self, offset, count):
+        header = pd.read_csv(self.file_name, nrows=0).columns
+
+        with open(self.file_name, "rb") as file:
+            file.seek(offset)
+            tweet_objects = pd.read_csv(
+                file,
+                header=None,
+                names=header,
+                index_col=0,
+                usecols=[self.index_column] + self.columns,
+                nrows=count,
+                dtype={"id_str": str},
+            )
+
+        tweet_objects.index.name = None
+        for column in self.missing_optional_columns:
+            tweet_objects[column] = float("nan")
+
+        return tweet_objects
+
+
+class IncrementalCsvWriter:
+    def __init__(self, file_name, columns):
+        self.file_name = file_name
+        self.columns = columns
+        self.rows_written = 0
+
+    def write(self, tweet_objects):
+        # Every chunk gets the same columns, so the appended rows line up
+        tweet_objects.reindex(columns=self.columns).to_csv(
+            self.file_name,
+            mode="a" if self.rows_written else "w",
+            header=not self.rows_written,
+        )
+        self.rows_written += len(tweet_objects)
@@ -0,0 +1,59 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The modules sit next to each other and import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backends import LocalBackend  # noqa: E402
+from benchmark import MockLLMServer, SyntheticTweets  # noqa: E402
+from chatgpt import Utility  # noqa: E402
+from retry import CircuitBreaker, RetryPolicy  # noqa: E402
+
+
+@pytest.fixture
+def mock_server():
+    server = MockLLMServer(latency_median_ms=1, latency_sigma=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def backend(mock_server, monkeypatch):
+    # Every test starts without a cache or instrumentation, on a backend of its
+    # own that talks to the mock server
+    backend = LocalBackend(mock_server.url, pool_size=8)
+
+    monkeypatch.setattr(Utility, "backends", {"local": backend})
+    monkeypatch.setattr(Utility, "response_cache", None)
+    monkeypatch.setattr(Utility, "instrumentation", None)
+    monkeypatch.setattr(Utility, "rate_limiter", None)
+    monkeypatch.setattr(Utility, "rate_limiters", {})
+    monkeypatch.setattr(
+        Utility,
+        "retry_policy",
+        RetryPolicy(
+            base_delay_seconds=0.01,
+            max_delay_seconds=0.1,
+            circuit_breaker=CircuitBreaker(cooldown_seconds=0.1),
+        ),
+    )
+
+    yield backend
+
+    backend.close()
+
+
+@pytest.fixture
+def tweets_file(tmp_path):
+    return SyntheticTweets.write(
+        str(tmp_path / "tweets.csv"), 60, labeled_fraction=0.5, seed=1
+    )
@@ -0,0 +1,84 @@
+import json
+
+from benchmark import MockLLMServer
+from bulk import BulkJob
+from chatgpt import Category1, ClaimExistence
+from journal import PredictionJournal
+
+
+def expected_predictions(request_file_name):
+    # The mock server labels a tweet by the hash of its message
+    expected = {}
+
+    with open(request_file_name, encoding="utf-8") as file:
+        for line in file:
+            request = json.loads(line)
+            _, _, index = BulkJob.parse_custom_id(request["custom_id"])
+            label = MockLLMServer.label_of(request["body"]["messages"])
+            expected[index] = 1 if label == "#" else 0
+
+    return expected
+
+
+def run_bulk_job(bulk_job, tmp_path, journal, reverse_results=True):
+    request_file_name = str(tmp_path / f"{bulk_job.classifier.task}-requests.jsonl")
+    result_file_name = str(tmp_path / f"{bulk_job.classifier.task}-results.jsonl")
+
+    written = bulk_job.write_requests(request_file_name, journal)
+    BulkJob.run_requests_locally(
+        request_file_name, result_file_name, concurrency=4, backend="local"
+    )
+
+    # The bulk endpoint returns results in any order, the custom ids place them
+    if reverse_results:
+        with open(result_file_name, encoding="utf-8") as file:
+            lines = file.readlines()
+        with open(result_file_name, "w", encoding="utf-8") as file:
+            file.writelines(reversed(lines))
+
+    metrics = bulk_job.ingest_results(result_file_name, journal)
+
+    return written, request_file_name, metrics
+
+
+def test_custom_ids_round_trip(backend, tweets_file, tmp_path):
+    classifier = ClaimExistence("mock-llm", tweets_file, "local")
+    bulk_job = BulkJob(classifier)
+    journal_file_name = str(tmp_path / "predictions.journal")
+
+    with PredictionJournal(journal_file_name) as journal:
+        written, request_file_name, metrics = run_bulk_job(bulk_job, tmp_path, journal)
+
+    assert written == len(classifier.tweet_objects)
+    assert classifier.tweet_objects[
+        bulk_job.prediction_column_name
+    ].to_dict() == expected_predictions(request_file_name)
+    assert metrics["Accuracy"] > 0
+
+    # A new job over the same journal has nothing left to send
+    resumed_job = BulkJob(ClaimExistence("mock-llm", tweets_file, "local"))
+    with PredictionJournal(journal_file_name) as journal:
+        assert resumed_job.write_requests(str(tmp_path / "again.jsonl"), journal) == 0
+
+
+def test_categories_are_gated_by_claim_existence(backend, tweets_file, tmp_path):
+    journal_file_name = str(tmp_path / "predictions.journal")
+
+    with PredictionJournal(journal_file_name) as journal:
+        claim_job = BulkJob(ClaimExistence("mock-llm", tweets_file, "local"))
+        run_bulk_job(claim_job, tmp_path, journal)
+
+        category_job = BulkJob(Category1("mock-llm", tweets_file, "local"))
+        written, request_file_name, _ = run_bulk_job(category_job, tmp_path, journal)
+
+    claims = claim_job.classifier.tweet_objects[claim_job.prediction_column_name]
+    categories = category_job.classifier.tweet_objects[
+        category_job.prediction_column_name
+    ]
+    expected = expected_predictions(request_file_name)
+
+    # Only tweets with a claim are sent, the rest get 0 without a request
+    assert written == (claims == 1).sum()
+    assert set(expected) == set(claims[claims == 1].index)
+    assert categories[claims == 0].eq(0).all()
+    assert categories[claims == 1].to_dict() == expected
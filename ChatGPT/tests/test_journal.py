@@ -0,0 +1,110 @@
+import os
+
+import pandas as pd
+import pytest
+
+from chatgpt import Category1, ClaimExistence
+from journal import PredictionJournal
+from pipeline import FusedPipeline, PipelineStopped
+
+
+def run_pipeline(tweets_file, output_file_name, concurrency=1):
+    pipeline = FusedPipeline(
+        ClaimExistence("mock-llm", tweets_file, "local"),
+        [Category1("mock-llm", None, "local")],
+    )
+    return pipeline.generate_metrics(output_file_name, concurrency=concurrency)
+
+
+def served_requests(mock_server):
+    return mock_server.responses.get("200", 0)
+
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_corrupt_line_costs_only_its_record(tmp_path, in_memory):
+    journal_file_name = str(tmp_path / "predictions.journal")
+
+    with PredictionJournal(journal_file_name) as journal:
+        journal.append(0, "mock-llm", "claim", 1, "#")
+    with open(journal_file_name, "a", encoding="utf-8") as file:
+        file.write('{"index": 1, "model": "mock-llm", "ta\n')
+    with PredictionJournal(journal_file_name) as journal:
+        journal.append(2, "mock-llm", "claim", 0, "@", score=0.25)
+
+    # A crash in the middle of a write leaves a partial last line
+    with open(journal_file_name, "a", encoding="utf-8") as file:
+        file.write('{"index": 3, "model": "mock-llm", "task": "cl')
+
+    with PredictionJournal(journal_file_name, in_memory=in_memory) as journal:
+        assert journal.predictions_for("mock-llm", "claim") == {0: 1, 2: 0}
+        assert journal.scores_for("mock-llm", "claim") == {2: 0.25}
+
+        journal.append(3, "mock-llm", "claim", 1, "#")
+
+    with open(journal_file_name, encoding="utf-8") as file:
+        lines = file.read().split("\n")
+
+    # The partial line is gone, the record written after recovery is whole
+    assert lines[-1] == ""
+    assert len(lines) == 5
+    assert '"index": 3' in lines[3]
+
+
+def test_resume_after_crash_makes_no_new_calls(
+    backend, mock_server, tweets_file, tmp_path
+):
+    output_file_name = str(tmp_path / "predictions.csv")
+    journal_file_name = f"{output_file_name}.journal"
+
+    metrics = run_pipeline(tweets_file, output_file_name)
+    first_output = pd.read_csv(output_file_name, index_col=0, dtype={"id_str": str})
+    requests = served_requests(mock_server)
+
+    with open(journal_file_name, "ab") as file:
+        file.write(b'{"index": 0, "model": "mock-llm", "task": "cat')
+
+    os.remove(output_file_name)
+    resumed_metrics = run_pipeline(tweets_file, output_file_name, concurrency=4)
+
+    assert served_requests(mock_server) == requests
+    pd.testing.assert_frame_equal(
+        pd.read_csv(output_file_name, index_col=0, dtype={"id_str": str}),
+        first_output,
+    )
+    for task in metrics:
+        assert resumed_metrics[task]["Accuracy"] == metrics[task]["Accuracy"]
+
+
+def test_resume_after_stop_finishes_the_remaining_rows(
+    backend, mock_server, tweets_file, tmp_path
+):
+    output_file_name = str(tmp_path / "predictions.csv")
+    cold_output_file_name = str(tmp_path / "cold.csv")
+
+    run_pipeline(tweets_file, cold_output_file_name)
+    cold_requests = served_requests(mock_server)
+
+    # Stopped part way, as a worker that lost its lease would be
+    polls = []
+    pipeline = FusedPipeline(
+        ClaimExistence("mock-llm", tweets_file, "local"),
+        [Category1("mock-llm", None, "local")],
+    )
+    with pytest.raises(PipelineStopped):
+        pipeline.generate_metrics(
+            output_file_name,
+            should_stop=lambda: polls.append(None) or len(polls) > 30,
+        )
+    stopped_requests = served_requests(mock_server) - cold_requests
+
+    run_pipeline(tweets_file, output_file_name, concurrency=4)
+    resumed_requests = served_requests(mock_server) - cold_requests - stopped_requests
+
+    # Requests answered before the stop are not sent again, except the one
+    # whose answer the stop kept from the journal
+    assert stopped_requests > 0
+    assert resumed_requests <= cold_requests - stopped_requests + 1
+    pd.testing.assert_frame_equal(
+        pd.read_csv(output_file_name, index_col=0, dtype={"id_str": str}),
+        pd.read_csv(cold_output_file_name, index_col=0, dtype={"id_str": str}),
+    )
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.metrics import average_precision_score, roc_auc_score
+
+from chatgpt import Category1, ClaimExistence, Utility
+from journal import PredictionJournal
+from metrics import MetricsAccumulator
+from pipeline import FusedPipeline
+
+
+def assert_same_metrics(metrics, expected):
+    for name in ("Accuracy", "Precision", "Recall", "F1"):
+        assert metrics[name] == pytest.approx(expected[name]), name
+
+    np.testing.assert_array_equal(
+        metrics["Confusion Matrix"], expected["Confusion Matrix"]
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_accumulator_matches_sklearn(seed):
+    generator = np.random.default_rng(seed)
+    ground_truth = generator.integers(2, size=200)
+    # Mostly right, as a classifier would be, with some rows never predicted 1
+    predicted = np.where(
+        generator.random(200) < 0.8, ground_truth, generator.integers(2, size=200)
+    )
+
+    metrics = MetricsAccumulator()
+    for pair in zip(ground_truth, predicted):
+        metrics.add(*pair)
+
+    assert_same_metrics(
+        metrics.calculate_metrics(),
+        Utility.calculate_metrics(ground_truth, predicted),
+    )
+
+
+def test_merged_accumulators_match_sklearn():
+    generator = np.random.default_rng(0)
+    ground_truth = generator.integers(2, size=300)
+    predicted = generator.integers(2, size=300)
+
+    # Shards are counted on their own and summed, as ShardedRun.merge does
+    merged = MetricsAccumulator()
+    for start in range(0, 300, 70):
+        shard_metrics = MetricsAccumulator()
+        for pair in zip(
+            ground_truth[start : start + 70], predicted[start : start + 70]
+        ):
+            shard_metrics.add(*pair)
+        merged.merge(shard_metrics)
+
+    assert_same_metrics(
+        merged.calculate_metrics(),
+        Utility.calculate_metrics(ground_truth, predicted),
+    )
+
+
+@pytest.mark.parametrize("use_logprobs", [False, True])
+def test_pipeline_metrics_match_sklearn(backend, tweets_file, tmp_path, use_logprobs):
+    output_file_name = str(tmp_path / "predictions.csv")
+    pipeline = FusedPipeline(
+        ClaimExistence("mock-llm", tweets_file, "local"),
+        [Category1("mock-llm", None, "local")],
+    )
+
+    stage_metrics = pipeline.generate_metrics(
+        output_file_name, concurrency=4, use_logprobs=use_logprobs
+    )
+    tweet_objects = pd.read_csv(output_file_name, index_col=0, dtype={"id_str": str})
+
+    for stage in pipeline.stages:
+        prediction_column = PredictionJournal.prediction_column_name(
+            "mock-llm", stage.task
+        )
+        labeled = tweet_objects[tweet_objects[stage.ground_truth_column].notna()]
+        ground_truth = labeled[stage.ground_truth_column].astype(int)
+
+        assert_same_metrics(
+            stage_metrics[stage.task],
+            Utility.calculate_metrics(ground_truth, labeled[prediction_column]),
+        )
+
+        if not use_logprobs:
+            continue
+
+        score_column = PredictionJournal.score_column_name("mock-llm", stage.task)
+        scored = labeled[labeled[score_column].notna()]
+
+        assert stage_metrics[stage.task]["ROC AUC"] == pytest.approx(
+            roc_auc_score(
+                scored[stage.ground_truth_column].astype(int), scored[score_column]
+            )
+        )
+        assert stage_metrics[stage.task]["PR AUC"] == pytest.approx(
+            average_precision_score(
+                scored[stage.ground_truth_column].astype(int), scored[score_column]
+            )
+        )
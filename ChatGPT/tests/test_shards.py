@@ -0,0 +1,145 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from chatgpt import Category1, ClaimExistence
+from pipeline import FusedPipeline, PipelineStopped
+from shards import ShardedRun, ShardLease
+
+
+def read_output(file_name):
+    return pd.read_csv(file_name, index_col=0, dtype={"id_str": str})
+
+
+def run_serially(tweets_file, output_file_name):
+    pipeline = FusedPipeline(
+        ClaimExistence("mock-llm", tweets_file, "local"),
+        [Category1("mock-llm", None, "local")],
+    )
+    metrics = pipeline.generate_metrics(output_file_name)
+
+    return read_output(output_file_name), metrics
+
+
+def prediction_columns(tweet_objects):
+    return tweet_objects[
+        [column for column in tweet_objects if "-predicted-" in column]
+    ]
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    file_name = str(tmp_path / "shard-00000.lease")
+
+    first = ShardLease(file_name, "first", lease_seconds=0.3)
+    second = ShardLease(file_name, "second", lease_seconds=0.3)
+
+    assert first.acquire()
+    assert not second.acquire()
+
+    # The first worker hangs, its lease stops being renewed
+    first.stopped.set()
+    first.renewer.join()
+    time.sleep(0.4)
+
+    assert second.acquire()
+    assert ShardLease.read(file_name)["worker"] == "second"
+
+    # The first worker notices on its next renewal and leaves the lease alone
+    assert not first.renew()
+    assert first.lost
+    first.release()
+    assert ShardLease.read(file_name)["worker"] == "second"
+
+    second.release()
+    assert ShardLease.read(file_name) is None
+
+
+def test_concurrent_workers_match_the_serial_run(backend, tweets_file, tmp_path):
+    serial_output, serial_metrics = run_serially(
+        tweets_file, str(tmp_path / "serial.csv")
+    )
+
+    workers = [
+        ShardedRun(
+            tweets_file,
+            str(tmp_path / "run"),
+            "mock-llm",
+            "local",
+            shard_size=15,
+            worker_id=worker_id,
+        )
+        for worker_id in ("first", "second")
+    ]
+    threads = [
+        threading.Thread(
+            target=worker.work, kwargs={"concurrency": 4, "poll_seconds": 1}
+        )
+        for worker in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    merged_file_name = str(tmp_path / "merged.csv")
+    merged_metrics = workers[0].merge(merged_file_name)
+
+    pd.testing.assert_frame_equal(
+        prediction_columns(read_output(merged_file_name)),
+        prediction_columns(serial_output),
+    )
+    for task, metrics in serial_metrics.items():
+        for name in ("Accuracy", "Precision", "Recall", "F1"):
+            assert merged_metrics[task][name] == pytest.approx(metrics[name])
+
+
+def test_reclaimed_shard_resumes_from_the_journal(
+    backend, mock_server, tweets_file, tmp_path
+):
+    serial_output, _ = run_serially(tweets_file, str(tmp_path / "serial.csv"))
+    cold_requests = mock_server.responses["200"]
+
+    crashed, survivor = (
+        ShardedRun(
+            tweets_file,
+            str(tmp_path / "run"),
+            "mock-llm",
+            "local",
+            shard_size=30,
+            lease_seconds=0.5,
+            worker_id=worker_id,
+        )
+        for worker_id in ("crashed", "survivor")
+    )
+
+    # The first worker answers part of its shard, then stops renewing its lease
+    shard, lease = crashed.claim()
+    lease.stopped.set()
+    lease.renewer.join()
+
+    crashed.pipeline.tweet_objects = crashed.stream.read_rows(
+        crashed.manifest["offsets"][shard], crashed.manifest["shard_size"]
+    )
+    polls = []
+    with pytest.raises(PipelineStopped):
+        crashed.pipeline.generate_metrics(
+            f"{crashed.output_file_name(shard)}.crashed.partial",
+            journal_file_name=crashed.journal_file_name(shard),
+            should_stop=lambda: polls.append(None) or len(polls) > 20,
+        )
+    crashed_requests = mock_server.responses["200"] - cold_requests
+
+    assert survivor.work(concurrency=4, poll_seconds=1) == survivor.shard_count
+
+    survivor_requests = mock_server.responses["200"] - cold_requests - crashed_requests
+    assert crashed_requests > 0
+    assert survivor_requests <= cold_requests - crashed_requests + 1
+
+    merged_file_name = str(tmp_path / "merged.csv")
+    survivor.merge(merged_file_name)
+    pd.testing.assert_frame_equal(
+        prediction_columns(read_output(merged_file_name)),
+        prediction_columns(serial_output),
+    )
@@ -0,0 +1,143 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import ResponseCache
+from retry import UnparsableResponse
+
+
+class SelfConsistency:
+    # Majority vote over sampled answers. Every round only asks for as many
+    # samples as could still decide the vote, so a unanimous start costs
+    # samples // 2 + 1 calls and the vote never runs past the samples
+    def __init__(self, samples=5, temperature=0.7, mode="parallel", max_workers=64):
+        if samples < 1 or samples % 2 == 0:
+            raise ValueError(f"Samples must be a positive odd number, got {samples}")
+
+        if mode not in ("parallel", "n"):
+            raise ValueError(f"Unknown mode = {mode}, expected parallel or n")
+
+        self.samples = samples
+        self.temperature = temperature
+        self.mode = mode
+        self.required_votes = samples // 2 + 1
+
+        # Shared by every worker of the engine, which waits on its own samples
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.lock = threading.Lock()
+        self.tweets = 0
+        self.samples_drawn = 0
+        self.early_stops = 0
+
+    def describe(self):
+        return f"self-consistency samples={self.samples} temperature={self.temperature}"
+
+    @staticmethod
+    def extract_contents(response):
+        return json.dumps(
+            [choice["message"]["content"] for choice in response["choices"]],
+            ensure_ascii=False,
+        )
+
+    def sample(self, utility, messages, model, task, backend, seed, n):
+        # The seed keeps every sample its own cache entry, so a rerun replays
+        # the same votes instead of collapsing them into one answer
+        parameters = {"seed": seed}
+        if self.mode == "n":
+            parameters["n"] = n
+
+        def attempt():
+            contents = json.loads(
+                utility.request_completion(
+                    messages,
+                    model,
+                    self.temperature,
+                    task,
+                    SelfConsistency.extract_contents,
+                    backend,
+                    **parameters,
+                )
+            )
+
+            try:
+                return [
+                    utility.extract_type_from_response(content) for content in contents
+                ], contents
+            except UnparsableResponse:
+                if utility.response_cache is not None:
+                    utility.response_cache.delete(
+                        ResponseCache.make_key(
+                            messages,
+                            model,
+                            temperature=self.temperature,
+                            **parameters,
+                        )
+                    )
+                raise
+
+        # The tweet is counted once by predict, not once per sample
+        return utility.retry_policy.call(attempt, task, model, tweet_count=0)
+
+    def predict(self, utility, messages, model, task, backend="openai"):
+        # utility is the Utility of the caller, so samples share its cache, rate
+        # limiters, backends, retry policy and instrumentation
+        votes = {"#": 0, "@": 0}
+        responses = []
+        samples_drawn = 0
+
+        while max(votes.values()) < self.required_votes:
+            needed = self.required_votes - max(votes.values())
+
+            if self.mode == "n":
+                rounds = [
+                    self.sample(
+                        utility, messages, model, task, backend, samples_drawn, needed
+                    )
+                ]
+            else:
+                rounds = list(
+                    self.executor.map(
+                        lambda seed: self.sample(
+                            utility, messages, model, task, backend, seed, 1
+                        ),
+                        range(samples_drawn, samples_drawn + needed),
+                    )
+                )
+
+            # A server that ignores n answers once, the loop simply asks again
+            for labels, contents in rounds:
+                for label in labels:
+                    votes[label] += 1
+                responses += contents
+                samples_drawn += len(labels)
+
+        with self.lock:
+            self.tweets += 1
+            self.samples_drawn += samples_drawn
+            self.early_stops += samples_drawn < self.samples
+
+        for listener in utility.retry_policy.listeners:
+            listener.record_success(task, model, 1)
+
+        response = json.dumps({"votes": votes, "responses": responses})
+
+        print("Response = ", response)
+
+        # The share of # votes is the score, so the vote margin is |2 * score - 1|
+        return (
+            1 if votes["#"] > votes["@"] else 0,
+            response,
+            votes["#"] / samples_drawn,
+        )
+
+    def stats(self):
+        with self.lock:
+            return {
+                "Tweets": self.tweets,
+                "Samples": self.samples_drawn,
+                "Samples per Tweet": self.samples_drawn / self.tweets
+                if self.tweets
+                else 0,
+                "Early Stops": self.early_stops,
+            }